@@ -0,0 +1,214 @@
+"""
+Asyncio flavour of the pipelines. The operations are the same loaders,
+transformers and writers, but instead of running as threads linked by
+queues they run as tasks linked by AsyncChannels, driven through their
+generator mode (see Loader.iterate, Transformer._process and Writer.consume).
+
+Calls into the operations, which may block on I/O or use the CPU for long,
+are offloaded to an executor, so the event loop stays responsive. The tasks
+themselves are cheap, so many pipelines can run in one process without an
+OS thread per stage:
+
+    await asyncio.gather(*(AsyncPipeline(build(path)).run() for path in paths))
+"""
+import asyncio
+import time
+
+from processing.operation import queue_list
+from processing.loaders import Loader
+from processing.transformers import Transformer, Merge
+from processing.writers import Writer
+
+
+class AsyncChannel(asyncio.Queue):
+    """
+    An asyncio queue with an end of stream: putting None closes the channel,
+    after which every get returns None once the channel is empty.
+    """
+
+    def __init__(self, maxsize=0):
+        super().__init__(maxsize)
+        self._closed = False
+
+    @property
+    def closed(self):
+        return self._closed
+
+    async def get(self):
+        if self._closed and self.empty():
+            return None
+        item = await super().get()
+        if item is None:
+            self._closed = True
+        return item
+
+
+class AsyncOperation:
+    """
+    Runs an operation as an asyncio task.
+    """
+
+    def __init__(self, operation, offload=True, executor=None):
+        """
+        :param operation: the operation to run
+        :param offload: run the calls into the operation in the executor instead of the event loop,
+            only cheap operations should run in the event loop
+        :param executor: the executor to offload to, the default executor of the loop if None
+        """
+        self._operation = operation
+        self._offload = offload
+        self._executor = executor
+        self.inputs = []
+        self.outputs = []
+
+    @property
+    def operation(self):
+        return self._operation
+
+    async def _call(self, fn, *args):
+        if not self._offload:
+            return fn(*args)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def _close_outputs(self):
+        for output in self.outputs:
+            await output.put(None)
+
+    async def run(self):
+        raise NotImplementedError
+
+
+class AsyncLoader(AsyncOperation):
+
+    async def run(self):
+        items = self._operation.iterate()
+        while True:
+            item = await self._call(next, items, None)
+            if item is None:
+                await self._close_outputs()
+                return
+            await self.outputs[0].put(item)
+
+
+class AsyncTransformer(AsyncOperation):
+
+    def _process(self, item):
+        return list(self._operation._process(item))
+
+    async def run(self):
+        if isinstance(self._operation, Merge):
+            await self._run_merge()
+            return
+
+        while True:
+            items = tuple([await input.get() for input in self.inputs])
+            item = self._operation._combine(items) if len(items) > 1 else items[0]
+            if item is None:
+                await self._close_outputs()
+                return
+
+            for i, out in await self._call(self._process, item):
+                await self.outputs[i].put(out)
+
+    async def _run_merge(self):
+        gets = {asyncio.ensure_future(input.get()): input for input in self.inputs}
+        try:
+            while gets:
+                done, _ = await asyncio.wait(gets, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    input = gets.pop(future)
+                    item = future.result()
+                    if item is not None:
+                        await self.outputs[0].put(item)
+                        gets[asyncio.ensure_future(input.get())] = input
+        finally:
+            for future in gets:
+                future.cancel()
+        await self._close_outputs()
+
+
+class AsyncWriter(AsyncOperation):
+
+    async def run(self):
+        await self._call(self._operation._begin)
+        while True:
+            item = await self.inputs[0].get()
+            if item is None:
+                await self._call(self._operation._end)
+                return
+            await self._call(self._operation._consume_item, item)
+
+
+class AsyncPipeline:
+    """
+    Runs the operations of a pipeline as asyncio tasks. Every queue linking
+    two operations is replaced by an AsyncChannel of the same maximum number
+    of elements. If any operation fails, the others are cancelled and the
+    error is raised by run.
+    """
+
+    def __init__(self, operations, offload=True, executor=None):
+        """
+        :param operations: the loaders, transformers and writers of the pipeline
+        :param offload: whether calls into the operations are run in the executor, either for all
+            operations or as a collection of the names of the operation classes to offload
+        :param executor: the executor to offload to, the default executor of the loop if None
+        """
+        self._start = None
+        self._end = None
+
+        channels = {}
+
+        def channel(queue):
+            if id(queue) not in channels:
+                channels[id(queue)] = AsyncChannel(max(getattr(queue, 'maxsize', 0), 0))
+            return channels[id(queue)]
+
+        self._operations = []
+        for operation in operations:
+            operation = getattr(operation, 'operation', operation)
+            if isinstance(operation, Loader):
+                kind = AsyncLoader
+            elif isinstance(operation, Transformer):
+                kind = AsyncTransformer
+            elif isinstance(operation, Writer):
+                kind = AsyncWriter
+            else:
+                raise ValueError('Can not run {} asynchronously'.format(type(operation).__name__))
+
+            if isinstance(offload, bool):
+                offloaded = offload
+            else:
+                offloaded = type(operation).__name__ in offload
+
+            async_operation = kind(operation, offloaded, executor)
+            async_operation.inputs = [channel(queue) for queue in queue_list(getattr(operation, 'input', None))]
+            async_operation.outputs = [channel(queue) for queue in queue_list(getattr(operation, 'output', None))]
+            self._operations.append(async_operation)
+
+    @property
+    def operations(self):
+        return list(self._operations)
+
+    @property
+    def elapsed(self):
+        if self._start is None:
+            return 0.0
+        return (self._end or time.perf_counter()) - self._start
+
+    async def run(self):
+        self._start = time.perf_counter()
+        tasks = [asyncio.ensure_future(operation.run()) for operation in self._operations]
+        try:
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+            for task in done:
+                if task.exception() is not None:
+                    raise task.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+            self._end = time.perf_counter()
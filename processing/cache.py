@@ -0,0 +1,289 @@
+"""
+Content-addressed cache of the output of pipeline stages. The output stream
+of a stage is stored under a key hashed from the contents of the input files
+and the parameters of the stages producing it, so running a pipeline again
+with the same inputs and parameters can replay the stream from disk instead
+of e.g. decoding and resizing a video again.
+
+    cache = StageCache('/tmp/stages', max_bytes=2**36)
+    key = cache.key([video_path], stage='resize', size=size)
+    try:
+        frames = CacheLoader(cache, key)
+    except KeyError:
+        ... pipeline with a Duplicate of the resized frames feeding CacheWriter(input, cache, key)
+
+Entries are written to a temporary file and only moved in place once the
+stream has ended, so an interrupted run never leaves a partial entry. When
+the cache grows past its size the least recently used entries are removed.
+An entry that is already being replayed can still be read to the end.
+"""
+import os
+import json
+import time
+import pickle
+import hashlib
+import tempfile
+
+from processing.loaders import Loader
+from processing.writers import Writer
+from processing.checkpoint import write_atomic
+
+# Changing the format of entries or the output of the cached stages invalidates old entries
+CACHE_VERSION = 1
+ENTRY_EXTENSION = '.pkl'
+HASHES_DIR = 'hashes'
+STALE_AGE = 24*60*60
+
+
+def _hash_file(path, block_size=2**20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class StageCache:
+    """
+    A directory of cached stage outputs, bounded in size. Can be shared by
+    several processes, e.g. the workers of create_multiprocessing_job.
+    """
+
+    def __init__(self, path, max_bytes=2**35):
+        """
+        :param path: the cache directory, created if it doesn't exist
+        :param max_bytes: total size of the entries above which the least recently used ones are removed
+        """
+        os.makedirs(os.path.join(path, HASHES_DIR), exist_ok=True)
+        self._path = path
+        self.max_bytes = max_bytes
+
+    @property
+    def path(self):
+        return self._path
+
+    def file_hash(self, path):
+        """
+        :return: the hash of the contents of the file. Hashes are remembered
+            by path, size and modification time, so an unchanged file is only read once.
+        """
+        stat = os.stat(path)
+        # One file per path, so processes hashing different files don't overwrite each other's hashes
+        name = os.path.abspath(path)
+        known = os.path.join(self._path, HASHES_DIR, hashlib.sha256(name.encode()).hexdigest() + '.json')
+        version = [stat.st_size, stat.st_mtime_ns]
+        try:
+            with open(known) as f:
+                hashed = json.load(f)
+            if hashed['path'] == name and hashed['version'] == version:
+                return hashed['hash']
+        except (IOError, ValueError, KeyError):
+            pass
+
+        digest = _hash_file(path)
+        write_atomic(known, json.dumps({'path': name, 'version': version, 'hash': digest}))
+        return digest
+
+    def key(self, files, **params):
+        """
+        :param files: paths of the input files of the cached stages
+        :param params: the parameters of the cached stages, anything JSON serializable
+        :return: the key of the output of the stages
+        """
+        description = {
+            'version': CACHE_VERSION,
+            'files': [self.file_hash(path) for path in files],
+            'params': params
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self._path, key + ENTRY_EXTENSION)
+
+    def __contains__(self, key):
+        return os.path.exists(self._entry(key))
+
+    def open(self, key):
+        """
+        :return: the file of the entry opened for reading, or None if the cache doesn't
+            have the key. The opened entry stays readable if it is evicted meanwhile.
+        """
+        fname = self._entry(key)
+        try:
+            f = open(fname, 'rb')
+        except FileNotFoundError:
+            return None
+        # The modification time of an entry is the time it was last used
+        try:
+            os.utime(fname)
+        except FileNotFoundError:
+            pass
+        return f
+
+    def replay(self, key):
+        """
+        :return: generator of the elements stored under the key
+        :raises KeyError: if the cache doesn't have the key
+        """
+        f = self.open(key)
+        if f is None:
+            raise KeyError(key)
+        return _read_entry(f)
+
+    def record(self, key):
+        """
+        :return: a CacheEntry to write the elements of the key to
+        """
+        return CacheEntry(self, key)
+
+    def _commit(self, tmp_path, key):
+        os.replace(tmp_path, self._entry(key))
+        self.evict()
+
+    def entries(self):
+        """
+        :return: list of (key, size in bytes, last used time) of the entries
+        """
+        out = []
+        for fname in os.listdir(self._path):
+            if not fname.endswith(ENTRY_EXTENSION) or fname.startswith('.'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self._path, fname))
+            except FileNotFoundError:
+                continue
+            out.append((fname[:-len(ENTRY_EXTENSION)], stat.st_size, stat.st_mtime))
+        return out
+
+    @property
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits its size,
+        as well as temporary files left behind by interrupted runs.
+        """
+        now = time.time()
+        for fname in os.listdir(self._path):
+            fname = os.path.join(self._path, fname)
+            if os.path.basename(fname).startswith('.tmp-'):
+                try:
+                    if now - os.stat(fname).st_mtime > STALE_AGE:
+                        os.unlink(fname)
+                except FileNotFoundError:
+                    pass
+
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        for key, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(self._entry(key))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        for key, _, _ in self.entries():
+            os.unlink(self._entry(key))
+
+
+def _read_entry(f):
+    with f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+class CacheEntry:
+    """
+    An entry being written. The elements only become visible in the cache
+    when the entry is committed.
+    """
+
+    def __init__(self, cache, key):
+        self._cache = cache
+        self._key = key
+        fd, self._tmp_path = tempfile.mkstemp(dir=cache.path, prefix='.tmp-')
+        self._file = os.fdopen(fd, 'wb')
+
+    def write(self, elem):
+        pickle.dump(elem, self._file, pickle.HIGHEST_PROTOCOL)
+
+    def commit(self):
+        self._file.close()
+        self._cache._commit(self._tmp_path, self._key)
+
+    def discard(self):
+        self._file.close()
+        os.unlink(self._tmp_path)
+
+
+def open_cache(cache):
+    """
+    :param cache: a StageCache, the path of its directory or None
+    :return: the StageCache, or None if cache is None
+    """
+    if cache is None or isinstance(cache, StageCache):
+        return cache
+    return StageCache(cache)
+
+
+class CacheLoader(Loader):
+    """
+    Replays the elements of a cache entry. The entry is opened when the loader
+    is created, which raises a KeyError if the cache doesn't have it, e.g.
+    because it was evicted after checking for it.
+    """
+
+    def __init__(self, cache, key, output=None, chunk_size=None, start=0):
+        """
+        :param cache: the StageCache
+        :param key: the key of the entry to replay
+        :param output: the queue to put the elements on
+        :param chunk_size: if set, elements are put in chunks of this many elements
+        :param start: number of elements to skip
+        """
+        super().__init__(key, output, chunk_size)
+        self._elements = cache.replay(key)
+        self._start = start
+
+    def _iterate(self):
+        for i, elem in enumerate(self._elements):
+            if i >= self._start:
+                yield elem
+
+
+class CacheWriter(Writer):
+    """
+    Stores its input in the cache under a key. Chunks are stored as the
+    elements they contain. The entry is only added when the input ends, an
+    interrupted run adds nothing.
+    """
+
+    def __init__(self, input, cache, key):
+        super().__init__(input, key)
+        self._cache = cache
+        self._entry = None
+
+    def _open(self):
+        self._entry = self._cache.record(self._path)
+
+    def _consume(self, elem):
+        self._entry.write(elem)
+
+    def _finish(self):
+        self._entry.commit()
+        self._entry = None
+
+    def run(self):
+        try:
+            super().run()
+        finally:
+            if self._entry is not None:
+                self._entry.discard()
+                self._entry = None
@@ -0,0 +1,107 @@
+"""
+Checkpoints make interrupted runs resumable. A checkpoint is a small JSON
+file recording which jobs or writers have completed and how many elements
+each unfinished writer has written. It is replaced atomically every time it
+is saved, so a crash never leaves a corrupt checkpoint behind.
+"""
+import os
+import json
+import time
+import tempfile
+from threading import Lock
+
+
+def write_atomic(path, text):
+    """
+    Write a text file by writing a temporary file next to it and moving it in
+    place, so readers only ever see the old or the complete new version.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class Checkpoint:
+    """
+    Progress of a run, keyed by e.g. the inputs of a job or the output path of
+    a writer. Progress updates are saved at most every interval seconds,
+    completions are saved right away.
+
+    Can be shared by the threads of a pipeline. Saving merges the state with
+    the one on disk, so writers running in their own process, each with a
+    copy of the checkpoint, don't undo each other's progress.
+    """
+
+    def __init__(self, path, interval=5.0):
+        """
+        :param path: the checkpoint file, loaded if it exists
+        :param interval: minimum number of seconds between saves of progress updates
+        """
+        self._path = path
+        self._interval = interval
+        self._lock = Lock()
+        self._saved = time.monotonic()
+
+        self._completed, self._written = self._load()
+
+    def _load(self):
+        if not os.path.exists(self._path):
+            return set(), {}
+        with open(self._path) as f:
+            state = json.load(f)
+        return set(state.get('completed', [])), state.get('written', {})
+
+    @property
+    def path(self):
+        return self._path
+
+    def is_completed(self, key):
+        with self._lock:
+            return key in self._completed
+
+    def complete(self, key):
+        with self._lock:
+            self._completed.add(key)
+            self._written.pop(key, None)
+            self._save()
+
+    def written(self, key):
+        """
+        :return: the number of elements recorded as written for the key
+        """
+        with self._lock:
+            return self._written.get(key, 0)
+
+    def update(self, key, written):
+        """
+        Record the number of elements written for the key.
+        """
+        with self._lock:
+            self._written[key] = written
+            if time.monotonic() - self._saved >= self._interval:
+                self._save()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        completed, written = self._load()
+        self._completed |= completed
+        for key, n in written.items():
+            self._written[key] = max(self._written.get(key, 0), n)
+        for key in self._completed:
+            self._written.pop(key, None)
+
+        state = {
+            'completed': sorted(self._completed),
+            'written': self._written
+        }
+        write_atomic(self._path, json.dumps(state))
+        self._saved = time.monotonic()
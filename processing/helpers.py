@@ -1,6 +1,8 @@
 import numpy as np
 from queue import Queue
+from threading import Condition, get_ident
 from typing import Generator
+from processing.operation import Chunk
 from processing.writers import *
 
 
@@ -9,7 +11,8 @@ def queue_generator(queue: Queue) -> Generator:
     Create a generator using a blocking queue. This is especially
     useful if you need to interface the processing library with
     some python code expecting Iterables. Another use is simply
-    making looping over the queue values prettier.
+    making looping over the queue values prettier. Chunks are taken
+    apart into the elements they contain.
 
     :param queue: The queue to create a generator for
     :return: The generator
@@ -18,26 +21,115 @@ def queue_generator(queue: Queue) -> Generator:
         elem = queue.get()
         if elem is None:
             break
-        yield elem
 
+        if isinstance(elem, Chunk):
+            yield from elem
+        else:
+            yield elem
 
-def batch_queue_generator(queue: Queue, shape, batch_size) -> Generator[np.ndarray, np.ndarray, None]:
-    buffer = np.zeros((batch_size, *shape))
 
-    i = 0
-    while True:
-        elem = queue.get()
-        if elem is None:
-            yield buffer[:i]
-            break
+class BatchRing:
+    """
+    A ring of preallocated batch buffers. Buffers are handed out in turn, so
+    a batch stays valid until the ring comes around to its buffer again.
 
-        if i < batch_size:
-            buffer[i] = elem
-        else:
-            yield buffer
-            buffer = np.zeros((batch_size, *shape))
+    If pinned, a buffer is only handed out again once the consumer of its
+    batch has released it, e.g. after copying it to the GPU, and acquire
+    blocks until then. When every buffer is held by the thread acquiring the
+    next one and no other thread has released a buffer so far, e.g. with a
+    pipeline running inline, nobody could ever release one and acquire
+    raises a RuntimeError instead of blocking forever.
+    """
+
+    def __init__(self, batch_size, shape, dtype, size=2, pinned=False):
+        self.buffers = [np.empty((batch_size, *shape), dtype) for _ in range(size)]
+        self._next = 0
+        self._pinned = pinned
+        self._in_use = [False]*size
+        self._owners = [None]*size
+        self._released_elsewhere = False
+        self._released = Condition()
+
+    def acquire(self):
+        """
+        :return: the index of the next buffer to fill
+        """
+        index = self._next
+        self._next = (self._next + 1) % len(self.buffers)
+        if self._pinned:
+            with self._released:
+                if self._in_use[index] and self._stuck():
+                    raise RuntimeError('All {} batch buffers are held by the thread taking the next batch, release '
+                                       'a batch before taking the next one'.format(len(self.buffers)))
+                self._released.wait_for(lambda: not self._in_use[index])
+                self._in_use[index] = True
+                self._owners[index] = get_ident()
+        return index
+
+    def _stuck(self):
+        thread = get_ident()
+        return not self._released_elsewhere and all(
+            in_use and owner == thread for in_use, owner in zip(self._in_use, self._owners))
 
+    def release(self, index):
+        with self._released:
+            if self._owners[index] != get_ident():
+                self._released_elsewhere = True
+            self._in_use[index] = False
+            self._released.notify_all()
+
+
+def batch_queue_generator(queue: Queue, shape=None, batch_size=32, dtype=None, ring_size=2,
+                          pinned=False) -> Generator:
+    """
+    Collect the elements of a queue into batches. The batches are views of a
+    small ring of buffers allocated once, in the dtype of the elements, so
+    no memory is allocated per batch. A batch is overwritten once ring_size
+    more batches have been taken, copy it to keep it longer or use pinned.
+
+    :param queue: the queue of array elements, which may be chunked
+    :param shape: shape of the elements, taken from the first element if None
+    :param batch_size: number of elements per batch, the last batch may be smaller
+    :param dtype: dtype of the batches, taken from the first element if None
+    :param ring_size: number of batch buffers
+    :param pinned: yield (batch, release) pairs instead of batches, where release must be
+        called when the batch isn't used anymore. A buffer isn't reused before that.
+    :return: generator of the batches
+    """
+    ring = None
+    index = None
+    i = 0
+    for elem in queue_generator(queue):
+        elem = np.asarray(elem)
+        if ring is None:
+            ring = BatchRing(batch_size, elem.shape if shape is None else shape,
+                             elem.dtype if dtype is None else dtype, ring_size, pinned)
+
+        if index is None:
+            index = ring.acquire()
+        ring.buffers[index][i] = elem
         i += 1
 
+        if i == batch_size:
+            yield _batch(ring, index, i, pinned)
+            index = None
+            i = 0
+
+    if i > 0:
+        yield _batch(ring, index, i, pinned)
+
+
+def _batch(ring, index, n, pinned):
+    batch = ring.buffers[index][:n]
+    if not pinned:
+        return batch
+
+    released = []
 
+    def release():
+        # Releasing more than once mustn't free the buffer of another batch
+        if not released:
+            released.append(True)
+            ring.release(index)
 
+    return batch, release
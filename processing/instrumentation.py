@@ -0,0 +1,261 @@
+"""
+Instrumentation of running pipelines. A Monitor times the queue operations
+of every stage and samples the depth of every queue, which shows where a
+pipeline stalls: a stage that is busy most of the time while its input queue
+is full and its output queue is empty is the bottleneck.
+
+Stages are timed through their queues rather than their run methods, so
+every operation is covered, including ones running in their own process.
+"""
+import json
+import time
+from contextlib import contextmanager
+from threading import Thread, Event, Lock
+
+from processing.operation import Chunk, queue_list
+
+
+def _count(elem):
+    if elem is None:
+        return 0
+    elif isinstance(elem, Chunk):
+        return len(elem)
+    return 1
+
+
+class StageStats:
+    """
+    Counters of a single stage of a pipeline. Items are counted as
+    elements, so a chunk counts as the elements it contains.
+    """
+
+    def __init__(self, name, start):
+        self.name = name
+        self.start = start
+        self.finished = None
+        self.items_in = 0
+        self.items_out = 0
+        self.get_wait = 0.0
+        self.put_wait = 0.0
+        self._lock = Lock()
+
+    def record_get(self, elem, wait):
+        with self._lock:
+            self.items_in += _count(elem)
+            self.get_wait += wait
+            if elem is None:
+                self.finished = time.perf_counter()
+
+    def record_wait(self, wait):
+        """
+        Count time spent waiting for any of several inputs as waiting for input.
+        """
+        with self._lock:
+            self.get_wait += wait
+
+    def record_put(self, elem, wait):
+        with self._lock:
+            self.items_out += _count(elem)
+            self.put_wait += wait
+            if elem is None:
+                self.finished = time.perf_counter()
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.perf_counter()) - self.start
+
+    @property
+    def processing(self):
+        """
+        Time spent neither waiting for input nor for room in the output.
+        """
+        return max(self.elapsed - self.get_wait - self.put_wait, 0.0)
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'elapsed': self.elapsed,
+            'items_in': self.items_in,
+            'items_out': self.items_out,
+            'processing': self.processing,
+            'get_wait': self.get_wait,
+            'put_wait': self.put_wait
+        }
+
+
+def _timed_get(get, record):
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        elem = get(*args, **kwargs)
+        record(elem, time.perf_counter() - start)
+        return elem
+    return timed
+
+
+def _timed_put(put, record):
+    def timed(elem, *args, **kwargs):
+        start = time.perf_counter()
+        put(elem, *args, **kwargs)
+        record(elem, time.perf_counter() - start)
+    return timed
+
+
+def _timed_wait(wait, record):
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return wait(*args, **kwargs)
+        finally:
+            record(time.perf_counter() - start)
+    return timed
+
+
+class Monitor:
+    """
+    Collects StageStats for the operations of a pipeline and samples the
+    depth of their queues while it runs.
+
+    Usage:
+        monitor = Monitor(live=True)
+        with monitor.watch(operations):
+            run(operations)
+        monitor.save('stats.json')
+    """
+
+    def __init__(self, interval=1.0, live=False, path=None):
+        """
+        :param interval: seconds between samples of the queue depths
+        :param live: print a line per stage every sample and the summary when done
+        :param path: if set, the statistics are saved as JSON to this path when done
+        """
+        self._interval = interval
+        self._live = live
+        self._path = path
+        self._stages = []
+        self._queues = []
+        self._queue_names = []
+        self._samples = []
+        self._patched = []
+        self._stop = Event()
+        self._thread = None
+        self._start = None
+
+    @property
+    def stages(self):
+        return self._stages
+
+    def attach(self, operations):
+        """
+        Start timing the queue operations of the operations. Must be called
+        before the operations are started.
+        """
+        self._start = time.perf_counter()
+        names = {}
+        for i, operation in enumerate(operations):
+            inner = getattr(operation, 'operation', operation)
+            stats = StageStats('{}:{}'.format(i, type(inner).__name__), self._start)
+            self._stages.append(stats)
+
+            for queue in queue_list(getattr(operation, 'input', None)):
+                self._patch(queue, 'get', _timed_get, stats.record_get)
+            if hasattr(inner, '_wait'):
+                # Stages with several inputs wait for them in _wait before getting from the ready ones
+                self._patch(inner, '_wait', _timed_wait, stats.record_wait)
+            for j, queue in enumerate(queue_list(getattr(operation, 'output', None))):
+                self._patch(queue, 'put', _timed_put, stats.record_put)
+                names[id(queue)] = '{}.{}'.format(stats.name, j)
+                self._queues.append(queue)
+
+        self._queue_names = [names[id(queue)] for queue in self._queues]
+        self._thread = Thread(target=self._sample, name='Monitor', daemon=True)
+        self._thread.start()
+
+    def _patch(self, target, method, timed, record):
+        # The timed method shadows the method of the class until it is removed again in detach
+        setattr(target, method, timed(getattr(target, method), record))
+        self._patched.append((target, method))
+
+    def detach(self):
+        """
+        Stop sampling and timing. Writes and prints the results if configured to.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        for target, method in self._patched:
+            vars(target).pop(method, None)
+        self._patched = []
+
+        if self._live:
+            print(self.report())
+        if self._path:
+            self.save(self._path)
+
+    @contextmanager
+    def watch(self, operations):
+        """
+        Attach to the operations for the duration of the block.
+        """
+        self.attach(operations)
+        try:
+            yield self
+        finally:
+            self.detach()
+
+    def _sample(self):
+        while True:
+            self._samples.append((time.perf_counter() - self._start, [queue.qsize() for queue in self._queues]))
+            if self._live:
+                print(self._live_line())
+            if self._stop.wait(self._interval):
+                return
+
+    def _live_line(self):
+        parts = []
+        for stats in self._stages:
+            parts.append('{} {}/{}'.format(stats.name, stats.items_in, stats.items_out))
+        depths = self._samples[-1][1] if self._samples else []
+        return '[{:.1f}s] {} | queues {}'.format(time.perf_counter() - self._start, ', '.join(parts), depths)
+
+    def queue_depths(self):
+        """
+        :return: mapping from queue name to the (mean, max) of its sampled depth
+        """
+        out = {}
+        for i, name in enumerate(self._queue_names):
+            depths = [sizes[i] for _, sizes in self._samples]
+            out[name] = (sum(depths) / len(depths), max(depths)) if depths else (0.0, 0)
+        return out
+
+    def report(self):
+        """
+        :return: a table of the statistics of every stage, as fractions of its elapsed time
+        """
+        lines = ['{:<28} {:>10} {:>10} {:>10} {:>7} {:>7} {:>7}'.format(
+            'stage', 'in', 'out', 'out/s', 'busy', 'get', 'put')]
+        for stats in self._stages:
+            elapsed = stats.elapsed or 1e-9
+            lines.append('{:<28} {:>10} {:>10} {:>10.1f} {:>6.0%} {:>6.0%} {:>6.0%}'.format(
+                stats.name, stats.items_in, stats.items_out, stats.items_out / elapsed,
+                stats.processing / elapsed, stats.get_wait / elapsed, stats.put_wait / elapsed))
+
+        lines.append('{:<28} {:>10} {:>10}'.format('queue', 'mean', 'max'))
+        for name, (mean, maximum) in self.queue_depths().items():
+            lines.append('{:<28} {:>10.1f} {:>10}'.format(name, mean, maximum))
+        return '\n'.join(lines)
+
+    def to_dict(self):
+        return {
+            'stages': [stats.to_dict() for stats in self._stages],
+            'queues': {name: {'mean': mean, 'max': maximum}
+                       for name, (mean, maximum) in self.queue_depths().items()},
+            'samples': {
+                'time': [t for t, _ in self._samples],
+                'depth': {name: [sizes[i] for _, sizes in self._samples]
+                          for i, name in enumerate(self._queue_names)}
+            }
+        }
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f)
@@ -0,0 +1,201 @@
+import codecs
+import json
+import re
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_SEPARATOR = re.compile(r'[ \t\n\r]*([,\]])[ \t\n\r]*')
+
+
+class JsonStream:
+    """
+    Reads JSON incrementally from a binary file, keeping only a block of
+    the text in memory at a time. Values are decoded one at a time with the
+    standard library decoder, so arrays can be iterated over without loading
+    them completely.
+    """
+
+    def __init__(self, file, offset=0, block_size=2**16):
+        """
+        :param file: file opened in binary mode
+        :param offset: byte offset in the file to start reading from
+        :param block_size: number of bytes to read at a time
+        """
+        file.seek(offset)
+        self._file = file
+        self._block_size = block_size
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._json = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._offset = offset
+        self._eof = False
+
+    @property
+    def offset(self):
+        """
+        The byte offset in the file of the next value.
+        """
+        self._skip_whitespace()
+        return self._offset + len(self._buffer[:self._pos].encode('utf-8'))
+
+    def _fill(self):
+        if self._eof:
+            return False
+
+        self._offset += len(self._buffer[:self._pos].encode('utf-8'))
+        block = self._file.read(self._block_size)
+        self._buffer = self._buffer[self._pos:] + self._decoder.decode(block, final=not block)
+        self._pos = 0
+        self._eof = not block
+        return True
+
+    def _skip_whitespace(self):
+        while True:
+            self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer) or not self._fill():
+                return
+
+    def _peek(self):
+        self._skip_whitespace()
+        if self._pos < len(self._buffer):
+            return self._buffer[self._pos]
+        return ''
+
+    def _expect(self, *chars):
+        char = self._peek()
+        if char not in chars:
+            raise ValueError('Expected one of {} at byte {}, found {!r}'.format(chars, self.offset, char))
+        self._pos += 1
+        return char
+
+    def value(self):
+        """
+        Decode the next value completely.
+        """
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = self._json.raw_decode(self._buffer, self._pos)
+                # A value ending with the buffer, like a number, might continue in the next block
+                if end < len(self._buffer) or self._eof:
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            self._fill()
+
+    def elements(self):
+        """
+        Iterate over the array at the current position. Before every step
+        the stream is positioned at the next element, which the caller
+        must consume, e.g. with value().
+        """
+        self._expect('[')
+        if self._peek() == ']':
+            self._pos += 1
+            return
+
+        while True:
+            yield
+            if self._expect(',', ']') == ']':
+                return
+
+    def values(self):
+        """
+        Iterate over the decoded elements of the array at the current position.
+        """
+        self._expect('[')
+        if self._peek() == ']':
+            self._pos += 1
+            return
+
+        scan = self._json.scan_once
+        while True:
+            # Decode all elements that are followed by a separator in the buffer without refilling
+            self._skip_whitespace()
+            buffer, pos = self._buffer, self._pos
+            while True:
+                try:
+                    value, end = scan(buffer, pos)
+                except (StopIteration, json.JSONDecodeError):
+                    break
+                separator = _SEPARATOR.match(buffer, end)
+                if separator is None:
+                    break
+
+                yield value
+                pos = separator.end()
+                if separator.group(1) == ']':
+                    self._pos = pos
+                    return
+
+            # The next element continues in the next block
+            self._pos = pos
+            yield self.value()
+            if self._expect(',', ']') == ']':
+                return
+
+    def members(self):
+        """
+        Iterate over the keys of the object at the current position. After every
+        key the stream is positioned at its value, which the caller must consume.
+        """
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+            return
+
+        while True:
+            key = self.value()
+            self._expect(':')
+            yield key
+            if self._expect(',', '}') == '}':
+                return
+
+
+def scan_tracks(file, names=None):
+    """
+    Find the tracks of a track file without loading their data.
+
+    :param file: track file opened in binary mode
+    :param names: if given, scanning stops as soon as the tracks with these names
+        are found, which avoids reading through the rest of the file when the track
+        names come before the data
+    :return: list of dicts with the name and type of each track as well as
+        the byte offset of its data array
+    """
+    stream = JsonStream(file)
+    missing = set(names) if names else None
+    tracks = []
+    for key in stream.members():
+        if key != 'tracks':
+            stream.value()
+            continue
+
+        for _ in stream.elements():
+            track = {}
+            for track_key in stream.members():
+                if track_key == 'data':
+                    track['offset'] = stream.offset
+                else:
+                    track[track_key] = stream.value()
+
+                # The last wanted track is done once its name, type and data offset are known,
+                # in whatever order its keys come
+                if missing is not None and len(missing) == 1 and track.get('name') in missing \
+                        and 'type' in track and 'offset' in track:
+                    tracks.append(track)
+                    return tracks
+
+                if track_key == 'data':
+                    for _ in stream.values():
+                        pass
+
+            tracks.append(track)
+            if missing is not None:
+                missing.discard(track.get('name'))
+                if not missing:
+                    return tracks
+
+    return tracks
@@ -1,10 +1,18 @@
 import os
 import json
 import glob
+import itertools
+import threading
 import cv2 as cv
 import numpy as np
 from queue import Queue
-from processing.operation import Operation
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+from processing.operation import Operation, Chunk, ordered_map
+from processing.jsonstream import JsonStream, scan_tracks
+from processing.tracks import read_tracks, to_dicts
+from processing.shards import ShardReader
+from processing.queues import make_queue
 from abc import abstractmethod
 
 
@@ -15,7 +23,7 @@ class Loader(Operation):
     elements for other Operations to use.
     """
 
-    def __init__(self, path, output=None):
+    def __init__(self, path, output=None, chunk_size=None):
         """
         Most often a Loader reads from some path and writes to
         a single output queue. This constructor sets up this common
@@ -23,13 +31,17 @@ class Loader(Operation):
 
         :param path: The path (any kind of object really) to the resources to load.
         :param output: The queue that the loader will fill with loaded elements.
+        :param chunk_size: If set, elements are put in chunks of this many elements
+            instead of one at a time.
         """
         super().__init__()
         self._path = path
+        self._chunk_size = chunk_size
+        self._chunk = Chunk()
         if output:
             self._output = output
         else:
-            self._output = Queue(1000)
+            self._output = make_queue()
 
     @property
     def output(self) -> Queue:
@@ -40,130 +52,442 @@ class Loader(Operation):
         """
         return self._output
 
+    def _emit(self, elem):
+        """
+        Put a loaded element on the output, collecting it into the current
+        chunk if the loader is chunked.
+        """
+        if self._chunk_size is None:
+            self.output.put(elem)
+            return
+
+        self._chunk.append(elem)
+        if len(self._chunk) >= self._chunk_size:
+            self.output.put(self._chunk)
+            self._chunk = Chunk()
+
+    def _close(self):
+        """
+        Put any remaining elements followed by the shutdown signal.
+        """
+        if self._chunk:
+            self.output.put(self._chunk)
+            self._chunk = Chunk()
+        self.output.put(None)
+
+    def _iterate(self):
+        """
+        Generate the loaded elements. Loaders implement this, or run if
+        they need to put elements on the output themselves.
+        """
+        raise NotImplementedError
+
+    def iterate(self):
+        """
+        Load in the calling thread instead of running the loader as a thread.
+
+        :return: generator of the items the loader puts on its output, i.e.
+            elements or chunks of elements if the loader is chunked
+        """
+        if self._chunk_size is None:
+            yield from self._iterate()
+            return
+
+        chunk = Chunk()
+        for elem in self._iterate():
+            chunk.append(elem)
+            if len(chunk) >= self._chunk_size:
+                yield chunk
+                chunk = Chunk()
+        if chunk:
+            yield chunk
+
+    def run(self):
+        for elem in self._iterate():
+            self._emit(elem)
+        self._close()
+
+
+class FrameSelection:
+    """
+    Selects which frames, or rows of tracks, a loader outputs. Loaders of
+    frames and tracks belonging together should use the same selection to
+    stay aligned.
+    """
+
+    def __init__(self, skip_pattern=None, stop=None, ranges=None):
+        """
+        :param skip_pattern: tuple (n_do, n_skip), repeatedly select n_do+1 frames and skip n_skip+1 frames
+        :param stop: only select frames before this index
+        :param ranges: only select frames within these (start, end) index ranges, end excluded,
+            or None for a range lasting until the last frame
+        """
+        self.skip_pattern = skip_pattern
+        self.stop = stop
+        self.ranges = sorted(ranges) if ranges else None
+
+    def __contains__(self, index):
+        if self.stop is not None and index >= self.stop:
+            return False
+        if self.ranges is not None and not any(start <= index and (end is None or index < end)
+                                               for start, end in self.ranges):
+            return False
+        if self.skip_pattern is not None:
+            n_do, n_skip = self.skip_pattern
+            return index % (n_do+n_skip+2) < n_do+1
+        return True
+
+    def runs(self, length=None):
+        """
+        Iterate over runs of consecutive selected frames.
+
+        :param length: total number of frames if known
+        :return: (start, end) tuples with end excluded, or None as end for a run
+            lasting until the last frame
+        """
+        end = length
+        if self.stop is not None:
+            end = self.stop if end is None else min(end, self.stop)
+
+        ranges = self.ranges or [(0, None)]
+        for range_start, range_end in ranges:
+            if end is not None:
+                range_end = end if range_end is None else min(range_end, end)
+            if range_end is not None and range_start >= range_end:
+                continue
+
+            if self.skip_pattern is None:
+                yield range_start, range_end
+                continue
+
+            n_do, n_skip = self.skip_pattern
+            period = n_do+n_skip+2
+            for base in itertools.count(range_start - range_start % period, period):
+                if range_end is not None and base >= range_end:
+                    break
+                start = max(range_start, base)
+                stop = base+n_do+1 if range_end is None else min(range_end, base+n_do+1)
+                if start < stop:
+                    yield start, stop
+
 
 class TrackFileLoader(Loader):
 
-    def __init__(self, path, track_names=None, keep_names=False, skip_pattern=None, stop=None):
-        super().__init__(path)
-        self._skip_pattern = skip_pattern
-        self._stop_steps = stop
+    def __init__(self, path, track_names=None, keep_names=False, skip_pattern=None, stop=None, chunk_size=None,
+                 streaming=False, ranges=None):
+        """
+        Loads a track file and outputs it row by row, each row being a list of
+        (type, data) tuples with one element per track.
+
+        :param path: path to the track file
+        :param track_names: names of the tracks to load, all tracks if None
+        :param keep_names: output (type, data, name) tuples instead
+        :param skip_pattern: rows to output and skip in turn, see FrameSelection
+        :param stop: only load the rows before this index
+        :param chunk_size: if set, rows are put in chunks of this many rows
+        :param streaming: parse the track data incrementally instead of loading the whole file
+            first. Rows are output while the file is being parsed and only a small part of the
+            file is kept in memory at a time.
+        :param ranges: only load the rows within these (start, end) index ranges
+        """
+        super().__init__(path, chunk_size=chunk_size)
+        self._selection = FrameSelection(skip_pattern, stop, ranges)
         self._track_names = track_names
         self._keep_names = keep_names
+        self._streaming = streaming
 
-    def run(self):
-        with open(self._path) as track_file:
-            track_file = json.load(track_file)
-
-            if self._track_names:
-                track_dict = {track['name']: (track['type'], track['data'])
-                              for track in track_file['tracks']}
-                track_data_list = [track_dict[name][1] for name in self._track_names]
-                track_type_list = [track_dict[name][0] for name in self._track_names]
-                track_name_list = self._track_names
+    def _load_rows(self, track_file):
+        track_file = json.load(track_file)
+
+        if self._track_names:
+            track_dict = {track['name']: (track['type'], track['data'])
+                          for track in track_file['tracks']}
+            track_data_list = [track_dict[name][1] for name in self._track_names]
+            track_type_list = [track_dict[name][0] for name in self._track_names]
+            track_name_list = self._track_names
+        else:
+            track_data_list = [track['data'] for track in track_file['tracks']]
+            track_type_list = [track['type'] for track in track_file['tracks']]
+            track_name_list = [track['name'] for track in track_file['tracks']]
+
+        return track_type_list, track_name_list, zip(*track_data_list)
+
+    def _stream_rows(self, track_file, stack):
+        tracks = scan_tracks(track_file, self._track_names)
+
+        if self._track_names:
+            track_dict = {track['name']: track for track in tracks}
+            tracks = [track_dict[name] for name in self._track_names]
+
+        # Each track is read by its own stream, so the rows can be put together while reading
+        streams = [JsonStream(stack.enter_context(open(self._path, 'rb')), track['offset'])
+                   for track in tracks]
+
+        track_type_list = [track['type'] for track in tracks]
+        track_name_list = [track['name'] for track in tracks]
+        return track_type_list, track_name_list, zip(*(stream.values() for stream in streams))
+
+    def _iterate(self):
+        with open(self._path, 'rb') as track_file, ExitStack() as stack:
+            if self._streaming:
+                track_type_list, track_name_list, rows = self._stream_rows(track_file, stack)
             else:
-                track_data_list = [track['data'] for track in track_file['tracks']]
-                track_type_list = [track['type'] for track in track_file['tracks']]
-                track_name_list = [track['name'] for track in track_file['tracks']]
-
-            i = 0
-            total = 0
-            skip = False
-            for data_row in list(zip(*track_data_list)):
+                track_type_list, track_name_list, rows = self._load_rows(track_file)
+
+            stop = self._selection.stop
+            for index, data_row in enumerate(rows):
+                if stop is not None and index >= stop:
+                    break
+                if index not in self._selection:
+                    continue
+
                 if self._keep_names:
-                    out = list(zip(track_type_list, data_row, track_name_list))
+                    yield list(zip(track_type_list, data_row, track_name_list))
                 else:
-                    out = list(zip(track_type_list, data_row))
-
-                if self._skip_pattern is not None:
-                    n_do, n_skip = self._skip_pattern
-                    if skip and i > n_skip:
-                        skip = False
-                        i = 0
-                    elif not skip and i > n_do:
-                        skip = True
-                        i = 0
-
-                    if not skip:
-                        self.output.put(out)
-                    i += 1
+                    yield list(zip(track_type_list, data_row))
+
+
+class TrackArrayLoader(Loader):
+
+    def __init__(self, path, track_names=None, keep_names=False, skip_pattern=None, stop=None, chunk_size=None,
+                 block_size=None, ranges=None):
+        """
+        Loads tracks stored in the columnar format of processing.tracks. By default
+        the output is the same as that of TrackFileLoader for the same tracks.
+
+        :param path: directory containing the tracks
+        :param track_names: names of the tracks to load, all tracks if None
+        :param keep_names: output (type, data, name) tuples instead
+        :param skip_pattern: rows to output and skip in turn, see FrameSelection
+        :param stop: only load the rows before this index
+        :param chunk_size: if set, rows are put in chunks of this many rows
+        :param block_size: if set, rows are put in blocks of this many rows, where a block is
+            a list with a (type, data) tuple per track and data is a structured array
+            holding the rows of the block
+        :param ranges: only load the rows within these (start, end) index ranges
+        """
+        super().__init__(path, chunk_size=chunk_size)
+        self._selection = FrameSelection(skip_pattern, stop, ranges)
+        self._track_names = track_names
+        self._keep_names = keep_names
+        self._block_size = block_size
+
+    def _selected_rows(self, length):
+        runs = [np.arange(start, end) for start, end in self._selection.runs(length)]
+        return np.concatenate(runs) if runs else np.arange(0)
+
+    def _iterate(self):
+        meta = read_tracks(self._path)
+        tracks = meta['tracks']
+        if self._track_names:
+            track_dict = {track['name']: track for track in tracks}
+            tracks = [track_dict[name] for name in self._track_names]
+
+        types = [track['type'] for track in tracks]
+        names = [track['name'] for track in tracks]
+
+        rows = self._selected_rows(meta['length'])
+        block_size = self._block_size or 4096
+        for start in range(0, len(rows), block_size):
+            index = rows[start:start+block_size]
+            if len(index) == index[-1] - index[0] + 1:
+                index = slice(index[0], index[-1]+1)
+            blocks = [track['data'][index] for track in tracks]
+
+            if self._block_size:
+                if self._keep_names:
+                    yield list(zip(types, blocks, names))
                 else:
-                    self.output.put(out)
+                    yield list(zip(types, blocks))
+                continue
 
-                if self._stop_steps is not None and self._stop_steps < total:
-                    break
+            columns = [to_dicts(type, block) for type, block in zip(types, blocks)]
+            for data_row in zip(*columns):
+                if self._keep_names:
+                    yield list(zip(types, data_row, names))
+                else:
+                    yield list(zip(types, data_row))
+
+
+class _Capture:
+    """
+    A video capture that keeps track of its position, so it only seeks when necessary.
+    """
 
-            self.output.put(None)
+    def __init__(self, path, seek_threshold):
+        self.video = cv.VideoCapture(path)
+        self.position = 0
+        self._seek_threshold = seek_threshold
+
+    def read(self, runs):
+        """
+        Decode the frames of the given runs. Frames between runs are grabbed without
+        being decoded, or skipped by seeking if there are many of them.
+        """
+        for start, end in runs:
+            if start < self.position or start - self.position > self._seek_threshold:
+                self.video.set(cv.CAP_PROP_POS_FRAMES, start)
+                self.position = start
+            while self.position < start:
+                if not self.video.grab():
+                    return
+                self.position += 1
+
+            indices = itertools.count(start) if end is None else range(start, end)
+            for _ in indices:
+                ret, frame = self.video.read()
+                if not ret:
+                    return
+                self.position += 1
+                yield frame
+
+    def release(self):
+        self.video.release()
 
 
 class VideoLoader(Loader):
 
-    def __init__(self, path, output=None, skip_pattern=None, stop=None):
-        self._skip_pattern = skip_pattern
-        self._stop_steps = stop
-        super().__init__(path, output)
+    def __init__(self, path, output=None, skip_pattern=None, stop=None, chunk_size=None, ranges=None, workers=1,
+                 segment_size=256, seek_threshold=64):
+        """
+        Decodes the frames of a video file.
+
+        :param path: path to the video file
+        :param output: the queue to put the frames on
+        :param skip_pattern: frames to output and skip in turn, see FrameSelection
+        :param stop: only output the frames before this index
+        :param chunk_size: if set, frames are put in chunks of this many frames
+        :param ranges: only output the frames within these (start, end) index ranges
+        :param workers: number of threads decoding segments of the video in parallel, each
+            with its own capture. The frames are still output in order.
+        :param segment_size: number of frames decoded by a worker at a time
+        :param seek_threshold: seek instead of grabbing frames when skipping more frames than this
+        """
+        self._selection = FrameSelection(skip_pattern, stop, ranges)
+        self._workers = workers
+        self._segment_size = segment_size
+        self._seek_threshold = seek_threshold
+        super().__init__(path, output, chunk_size)
 
+    def _segments(self, length):
+        """
+        Group the selected runs of frames into segments spanning at most segment_size frames.
 
-    def run(self):
-        video = cv.VideoCapture(self._path)
-
-        i = 0
-        total = 0
-        skip = False
-        while True:
-            ret, frame = video.read()
-            if not ret:
-                self.output.put(None)
+        The frame count of many containers is only an estimate, so it is not
+        used as a limit: the runs from the counted length on form a last
+        segment, which is decoded until the end of the video.
+        """
+        runs = self._selection.runs()
+        segment = []
+        for start, end in runs:
+            rest = None
+            if start >= length:
+                rest = start, end
+                start = end = None
+            elif end is None or end > length:
+                rest = length, end
+                end = length
+
+            while start is not None and end - start > self._segment_size:
+                if segment:
+                    yield segment
+                    segment = []
+                yield [(start, start+self._segment_size)]
+                start += self._segment_size
+
+            if start is not None:
+                if segment and end - segment[0][0] > self._segment_size:
+                    yield segment
+                    segment = []
+                segment.append((start, end))
+
+            if rest is not None:
+                if segment:
+                    yield segment
+                yield itertools.chain([rest], runs)
                 return
 
-            if self._skip_pattern is not None:
-                n_do, n_skip = self._skip_pattern
-                if skip and i > n_skip:
-                    skip = False
-                    i = 0
-                elif not skip and i > n_do:
-                    skip = True
-                    i = 0
-
-                if not skip:
-                    self.output.put(frame)
-                i += 1
-            else:
-                self.output.put(frame)
+        if segment:
+            yield segment
 
-            if self._stop_steps is not None and self._stop_steps < total:
-                self.output.put(None)
-                return
+    def _iterate_parallel(self, length):
+        local = threading.local()
+        captures = []
+
+        def decode(segment):
+            if not hasattr(local, 'capture'):
+                local.capture = _Capture(self._path, self._seek_threshold)
+                captures.append(local.capture)
+            return list(local.capture.read(segment))
 
-            total += 1
+        try:
+            with ThreadPoolExecutor(self._workers) as executor:
+                for frames in ordered_map(executor, decode, self._segments(length), 2*self._workers):
+                    yield from frames
+        finally:
+            for capture in captures:
+                capture.release()
+
+    def _iterate(self):
+        capture = _Capture(self._path, self._seek_threshold)
+        length = int(capture.video.get(cv.CAP_PROP_FRAME_COUNT))
+
+        if self._workers > 1 and length > 0:
+            capture.release()
+            yield from self._iterate_parallel(length)
+            return
+
+        # The frame count may be an estimate, so the video is read until its end unless the selection ends earlier
+        try:
+            yield from capture.read(self._selection.runs())
+        finally:
+            capture.release()
 
 
 class SequenceLoader(Loader):
 
-    def __init__(self, path, pattern, output=None, loop=False):
-        super().__init__(path, output)
+    def __init__(self, path, pattern, output=None, loop=False, chunk_size=None, workers=1):
+        """
+        Loads every file matching a pattern in a directory, in order of the file names.
+
+        :param path: the directory to load files from
+        :param pattern: glob pattern of the files to load
+        :param output: the queue to put the loaded elements on
+        :param loop: start over from the first file after the last one, forever
+        :param chunk_size: if set, elements are put in chunks of this many elements
+        :param workers: number of threads loading files in parallel, the order of
+            the elements is preserved
+        """
+        super().__init__(path, output, chunk_size)
         self._pattern = pattern
         self._loop = loop
+        self._workers = workers
 
     @abstractmethod
     def _load(self, fname):
+        """
+        :return: the element loaded from the file
+        """
         pass
 
-    def run(self):
+    def _fnames(self):
+        complete = os.path.join(self._path, self._pattern)
+        # TODO: implement proper sorting
+        fnames = sorted(glob.glob(complete), key=os.path.basename)
+        if self._loop:
+            return itertools.cycle(fnames) if fnames else iter(())
+        return fnames
+
+    def _iterate(self):
         if not os.path.exists(self._path):
             raise IOError("Can't find specified path")
 
-        def inner():
-            complete = os.path.join(self._path, self._pattern)
-            # TODO: implement proper sorting
-            for fname in sorted(glob.glob(complete), key=os.path.basename):
-                self._load(fname)
-
-        if self._loop:
-            while True:
-                inner()
+        if self._workers > 1:
+            with ThreadPoolExecutor(self._workers) as executor:
+                yield from ordered_map(executor, self._load, self._fnames(), 2*self._workers)
         else:
-            inner()
-            self.output.put(None)
+            for fname in self._fnames():
+                yield self._load(fname)
 
 
 class FileNameLoader(SequenceLoader):
@@ -172,18 +496,42 @@ class FileNameLoader(SequenceLoader):
     """
 
     def _load(self, fname):
-        self.output.put(fname)
+        return fname
 
 
 class ArraySequenceLoader(SequenceLoader):
+    """
+    Loads .npy files, or the array of compressed .npz files as written by ArraySequenceWriter.
+    """
 
     def _load(self, fname):
-        arr = np.load(fname)
-        self.output.put(arr)
+        if fname.endswith('.npz'):
+            with np.load(fname) as data:
+                return data['arr_0']
+        return np.load(fname)
 
 
 class ImageSequenceLoader(SequenceLoader):
 
     def _load(self, fname):
-        image = cv.imread(fname)
-        self.output.put(image)
+        return cv.imread(fname)
+
+
+class ShardLoader(Loader):
+    """
+    Loads the samples of a shard set written by ShardWriter, in the order they were written.
+    """
+
+    def __init__(self, path, output=None, chunk_size=None, copy=True):
+        """
+        :param path: directory of the shard set
+        :param output: the queue to put the samples on
+        :param chunk_size: if set, samples are put in chunks of this many samples
+        :param copy: put copies of the samples instead of read-only views of the memory mapped shards
+        """
+        super().__init__(path, output, chunk_size)
+        self._copy = copy
+
+    def _iterate(self):
+        for sample in ShardReader(self._path):
+            yield sample.copy() if self._copy else sample
@@ -1,26 +1,284 @@
 import glob
 import os
+import json
 import time
-from itertools import zip_longest
-from concurrent.futures import ProcessPoolExecutor
+import inspect
+import traceback
+import multiprocessing
+from itertools import count, zip_longest
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
 
+from processing.checkpoint import Checkpoint
 
-def create_multiprocessing_job(pipeline, base_path, patterns, arguments):
-    pattern_list = [glob.glob(os.path.join(base_path, path))
+
+class JobResult:
+    """
+    The outcome of running a pipeline on one set of inputs.
+    """
+
+    def __init__(self, kwargs, attempts, duration, error=None):
+        """
+        :param kwargs: the input arguments the pipeline was called with
+        :param attempts: number of times the job was run
+        :param duration: duration in seconds of the last attempt
+        :param error: formatted traceback of the last attempt if it failed
+        """
+        self.kwargs = kwargs
+        self.attempts = attempts
+        self.duration = duration
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def to_dict(self):
+        return {
+            'inputs': self.kwargs,
+            'attempts': self.attempts,
+            'duration': self.duration,
+            'error': self.error
+        }
+
+
+class JobSummary:
+    """
+    Results and throughput of a batch of jobs.
+    """
+
+    def __init__(self, results, elapsed, skipped=0):
+        """
+        :param results: the JobResult of every job that was run
+        :param elapsed: wall time of the batch in seconds
+        :param skipped: number of jobs skipped because a checkpoint recorded them as completed
+        """
+        self.results = results
+        self.elapsed = elapsed
+        self.skipped = skipped
+
+    @property
+    def succeeded(self):
+        return [result for result in self.results if result.ok]
+
+    @property
+    def failed(self):
+        return [result for result in self.results if not result.ok]
+
+    @property
+    def throughput(self):
+        """
+        :return: completed jobs per minute
+        """
+        return len(self.results) / self.elapsed * 60 if self.elapsed > 0 else 0.0
+
+    def report(self):
+        lines = ['{} jobs in {:.1f}s ({:.2f} jobs/min): {} succeeded, {} failed, {} skipped'.format(
+            len(self.results), self.elapsed, self.throughput, len(self.succeeded), len(self.failed), self.skipped)]
+        for result in self.failed:
+            lines.append('Failed after {} attempt(s): {}'.format(result.attempts, result.kwargs))
+            lines.append(result.error)
+        return '\n'.join(lines)
+
+    def to_dict(self):
+        return {
+            'elapsed': self.elapsed,
+            'throughput': self.throughput,
+            'succeeded': len(self.succeeded),
+            'failed': len(self.failed),
+            'skipped': self.skipped,
+            'jobs': [result.to_dict() for result in self.results]
+        }
+
+
+def create_jobs(base_path, patterns, arguments):
+    """
+    Find the inputs of every job. Each pattern is matched in the base path
+    and the sorted matches of all patterns are paired up in order.
+
+    :param base_path: the directory all patterns and paths are relative to
+    :param patterns: mapping from pipeline argument name to glob pattern
+    :param arguments: fixed pipeline arguments, arguments with 'path' in their name are made relative to base_path
+    :return: the per-job input arguments and the fixed arguments
+    """
+    pattern_list = [sorted(glob.glob(os.path.join(base_path, path)))
                     for path in patterns.values()]
     names = list(patterns.keys())
-    print(pattern_list)
+
+    arguments = dict(arguments)
     for key, val in arguments.items():
         if 'path' in key:
             arguments[key] = os.path.join(base_path, val)
 
-    pool = ProcessPoolExecutor(8)
+    jobs = [dict(zip(names, args)) for args in zip_longest(*pattern_list)]
+    return jobs, arguments
+
+
+def job_key(kwargs):
+    """
+    :return: the key a job is recorded under in a checkpoint
+    """
+    return json.dumps(kwargs, sort_keys=True)
+
+
+def _accepts(pipeline, name):
+    try:
+        return name in inspect.signature(pipeline).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+_started = None
+
+
+def _init_worker(started):
+    global _started
+    _started = started
+
+
+def _run_job(pipeline, kwargs, arguments, token=None):
+    # Tell the parent the job is running, so the jobs that could have crashed their worker
+    # can be told apart from the jobs that only fail because the pool broke
+    if _started is not None and token is not None:
+        _started.put(token)
+
+    start = time.perf_counter()
+    pipeline(**kwargs, **arguments)
+    return time.perf_counter() - start
+
+
+def create_multiprocessing_job(pipeline, base_path, patterns, arguments, workers=8, max_in_flight=None,
+                               retries=0, progress=True, checkpoint=None):
+    """
+    Run a pipeline on every set of inputs matched by the patterns, spread over
+    a number of worker processes. Failing jobs are retried and their errors
+    collected instead of stopping the batch.
+
+    With a checkpoint, every completed job is recorded and skipped when the
+    batch is run again. Pipelines taking a checkpoint argument are also told
+    to checkpoint their writers, so jobs interrupted halfway resume where
+    they stopped instead of starting over.
+
+    :param pipeline: the pipeline function, must be importable by the workers
+    :param base_path: the directory all patterns and paths are relative to
+    :param patterns: mapping from pipeline argument name to glob pattern
+    :param arguments: fixed pipeline arguments
+    :param workers: number of worker processes
+    :param max_in_flight: maximum number of submitted but unfinished jobs, defaults to twice the number of workers
+    :param retries: number of times a failed job is run again
+    :param progress: print a line for every finished job
+    :param checkpoint: path of the checkpoint file recording the completed jobs
+    :return: a JobSummary of all jobs
+    """
+    jobs, arguments = create_jobs(base_path, patterns, arguments)
+    max_in_flight = max_in_flight or 2*workers
+
+    skipped = 0
+    if checkpoint is not None:
+        checkpoint = Checkpoint(checkpoint)
+        remaining = [kwargs for kwargs in jobs if not checkpoint.is_completed(job_key(kwargs))]
+        skipped = len(jobs) - len(remaining)
+        jobs = remaining
+        if _accepts(pipeline, 'checkpoint'):
+            arguments.setdefault('checkpoint', True)
+        if progress and skipped:
+            print('Skipping {} job(s) completed before'.format(skipped))
+
+    pending = list(reversed(jobs))
+    attempts = {}
+    results = []
+    in_flight = {}
+
+    started = multiprocessing.SimpleQueue()
+    tokens = count()
+    running = set()
+    charged = set()
+
+    def new_pool():
+        return ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(started,))
+
+    start = time.perf_counter()
+    pool = new_pool()
+
+    def replace_pool(broken):
+        """
+        Replace the pool once a worker died. Every job in flight fails with it, but only
+        the jobs that were running could have crashed the worker and are charged an attempt.
+        If none is known to have been running, all of them are.
+        """
+        nonlocal pool
+        if broken is not pool:
+            return
+        while not started.empty():
+            running.add(started.get())
+        broken_tokens = [token for _, _, submitted_pool, token in in_flight.values() if submitted_pool is broken]
+        charged.update([token for token in broken_tokens if token in running] or broken_tokens)
+
+        pool.shutdown(wait=False)
+        pool = new_pool()
+
+    try:
+        while pending or in_flight:
+            while pending and len(in_flight) < max_in_flight:
+                kwargs = pending.pop()
+                key = id(kwargs)
+                token = next(tokens)
+                try:
+                    future = pool.submit(_run_job, pipeline, kwargs, arguments, token)
+                except BrokenProcessPool:
+                    # The pool broke before the failed futures were handed back
+                    pending.append(kwargs)
+                    replace_pool(pool)
+                    continue
+                attempts[key] = attempts.get(key, 0) + 1
+                in_flight[future] = (kwargs, time.perf_counter(), pool, token)
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                kwargs, submitted, submitted_pool, token = in_flight[future]
+                key = id(kwargs)
+                try:
+                    result = JobResult(kwargs, attempts[key], future.result())
+                except Exception as e:
+                    error = ''.join(traceback.format_exception(type(e), e, e.__traceback__))
+                    if isinstance(e, BrokenProcessPool):
+                        replace_pool(submitted_pool)
+                        if token not in charged:
+                            # The job was only in flight alongside the crashed one, so it isn't charged an attempt
+                            del in_flight[future]
+                            attempts[key] -= 1
+                            pending.append(kwargs)
+                            continue
+                    del in_flight[future]
+                    if attempts[key] <= retries:
+                        pending.append(kwargs)
+                        continue
+                    result = JobResult(kwargs, attempts[key], time.perf_counter() - submitted, error)
+                else:
+                    del in_flight[future]
+                running.discard(token)
+
+                if result.ok and checkpoint is not None:
+                    checkpoint.complete(job_key(kwargs))
+                results.append(result)
+                if progress:
+                    elapsed = time.perf_counter() - start
+                    print('[{}/{}] {} {} ({:.1f}s, {:.2f} jobs/min)'.format(
+                        len(results), len(jobs), 'done' if result.ok else 'FAILED', kwargs,
+                        result.duration, len(results) / elapsed * 60))
+    finally:
+        pool.shutdown(wait=True)
+
+    return JobSummary(results, time.perf_counter() - start, skipped)
 
-    for args in zip_longest(*pattern_list):
-        kwargs = dict(zip(names, args))
-        pipeline(**kwargs, **arguments)
 
-        #pool.submit(pipeline, **kwargs, **arguments)
-        time.sleep(0.2)
+def run_spec(spec, module, workers=8, max_in_flight=None, retries=0, progress=True, checkpoint=None):
+    """
+    Run a job described by a spec with the keys 'pipeline' (name of the
+    pipeline function in module), 'path', 'patterns' and 'arguments'.
 
-    return pool
+    :return: a JobSummary of all jobs
+    """
+    pipeline = getattr(module, spec['pipeline'])
+    return create_multiprocessing_job(pipeline, spec['path'], spec['patterns'], spec['arguments'],
+                                      workers, max_in_flight, retries, progress, checkpoint)
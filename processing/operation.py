@@ -1,6 +1,26 @@
+"""
+The base of all operations, and what operations have in common: the Chunk
+elements are batched in, the Cancelled exception stopping the operations of
+a cancelled pipeline, queue_list to treat single and multiple inputs or
+outputs alike, and ordered_map to run the work of an operation in parallel.
+"""
+from collections import deque
 from threading import Thread
 
 
+class Chunk(list):
+    """
+    A list of elements that is passed through a queue as a single item.
+    Sending elements in chunks amortizes the cost of the queue operations
+    (locking and waking up threads) over many elements, which matters
+    when the elements themselves are cheap to process, e.g. track rows.
+
+    Operations treat a chunk as the elements it contains, in order.
+    """
+
+    pass
+
+
 class Operation(Thread):
     """
     A subclass of Thread that represents a kind of data operation.
@@ -8,8 +28,51 @@ class Operation(Thread):
     produce and/or consume, making pipelining common data operations
     easy.
 
-    This superclass is mostly just a placeholder since Thread already
-    includes the necessary methods for this to work.
+    Thread already provides starting and joining, so subclasses only
+    implement run. Loaders, transformers and writers all build on it.
     """
 
     pass
+
+
+class Cancelled(Exception):
+    """
+    Raised by the queues of a pipeline that was cancelled, which stops the
+    operations still using them.
+    """
+
+    pass
+
+
+def queue_list(queues):
+    """
+    :param queues: the input or output of an operation, a single queue, a sequence of queues or None
+    :return: list of the queues
+    """
+    if queues is None:
+        return []
+    elif isinstance(queues, (tuple, list)):
+        return list(queues)
+    return [queues]
+
+
+def ordered_map(executor, fn, iterable, window):
+    """
+    Like executor.map, but only keeps up to window calls running ahead of
+    the results that have been consumed, which bounds the memory used by
+    pending results when the input is long or endless.
+
+    :param executor: the executor to run the calls in
+    :param fn: the function to call for every item
+    :param iterable: the items
+    :param window: the maximum number of pending calls
+    :return: generator of the results in the order of the items
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
@@ -1,34 +1,87 @@
+import time
+import functools
+from threading import Event
+
+import numpy as np
+
 from processing.loaders import *
 from processing.transformers import *
+from processing.transformers.image import *
+from processing.transformers.track import *
 from processing.writers import *
+from processing.operation import Cancelled, queue_list
+from processing.process import ProcessOperation
+from processing.queues import Channel, queue_defaults
+from processing.checkpoint import Checkpoint
+from processing.cache import CacheLoader, CacheWriter, open_cache
+
 
+def configurable_queues(pipeline):
+    """
+    Let a pipeline function take a queue_options argument, with the settings
+    of the queues it creates, see queues.queue_defaults. This bounds e.g. the
+    memory used by the queues of a pipeline processing large frames:
 
+        image_sequence_pipeline(..., queue_options={'max_bytes': 2**27})
+    """
+    @functools.wraps(pipeline)
+    def wrapper(*args, queue_options=None, **kwargs):
+        with queue_defaults(**(queue_options or {})):
+            return pipeline(*args, **kwargs)
+    return wrapper
+
+
+@configurable_queues
 def region_position_map_pipeline(track_path,
                                  track_names,
                                  output_path,
                                  img_size,
                                  positionmap_size,
                                  region_size,
-                                 output_folder=''):
-    loader = TrackFileLoader(track_path, track_names)
-
+                                 output_folder='',
+                                 output_format='files',
+                                 chunk_size=None,
+                                 backends=None,
+                                 monitor=None,
+                                 checkpoint=False,
+                                 cache=None,
+                                 map_mode='dense',
+                                 map_dtype='float64',
+                                 sigma=1.0,
+                                 compressed=False):
     scaling = positionmap_size[0]/img_size[0], positionmap_size[1]/img_size[1]
-    transformer = PositionMapGenerator(loader.output, positionmap_size, scaling)
 
-    splitter = Split(transformer.output, (60, 20, 20))
-    operations = [loader, transformer, splitter]
+    def build():
+        loader = TrackFileLoader(track_path, track_names, chunk_size=chunk_size)
+        transformer = PositionMapGenerator(loader.output, positionmap_size, scaling, map_mode, map_dtype, sigma)
+        return [loader, transformer]
+
+    cache = open_cache(cache)
+    key = cache.key([track_path], stage='position_map', track_names=track_names,
+                    positionmap_size=list(positionmap_size), scaling=list(scaling), mode=map_mode,
+                    dtype=np.dtype(map_dtype).str, sigma=sigma) if cache is not None else None
+    operations, maps = cached_stages(build, cache, key, chunk_size)
+
+    splitter = Split(maps, (60, 20, 20))
+    operations.append(splitter)
 
     if not os.path.exists(output_path):
         os.mkdir(output_path)
 
+    name = os.path.splitext(os.path.basename(track_path))[0]
+    checkpoint = pipeline_checkpoint(output_path, name) if checkpoint else None
+
     dirs = tuple([os.path.join(path, output_folder) for path in ('train', 'test', 'val')])
     for out, dir in zip(splitter.output, dirs):
-        writer = ArraySequenceWriter(out, os.path.join(output_path, dir), '')
+        writer = sequence_writer(ArraySequenceWriter, out, os.path.join(output_path, dir), '', output_format,
+                                 checkpoint=checkpoint, compressed=compressed)
         operations.append(writer)
 
-    run(operations)
+    if not completed(operations):
+        run(with_backends(operations, backends), monitor, fuse=True)
 
 
+@configurable_queues
 def window_radius_pipeline(video_path,
                            output_path,
                            image_size,
@@ -38,24 +91,39 @@ def window_radius_pipeline(video_path,
                            radius_negative=5,
                            radius_positive=3,
                            track_name='eye_left',
-                           negative_restrict=None):
-    video_loader = VideoLoader(video_path)
-
+                           negative_restrict=None,
+                           vectorized=False,
+                           output_format='files',
+                           chunk_size=None,
+                           backends=None,
+                           monitor=None,
+                           checkpoint=False,
+                           cache=None):
     track_path = os.path.splitext(video_path)[0] + '.json'
-    track_loader = TrackFileLoader(track_path, track_names=[track_name])
 
-    resize = ImageResize(video_loader.output, tuple(image_size))
+    def build():
+        video_loader = VideoLoader(video_path, chunk_size=chunk_size)
+        track_loader = TrackFileLoader(track_path, track_names=[track_name], chunk_size=chunk_size)
+        resize = Resize(video_loader.output, tuple(image_size))
+        window_trans = WindowGenerator(resize.output, track_loader.output, tuple(window_size), scaling, stride,
+                                       radius_negative, vectorized)
+        return [video_loader, track_loader, resize, window_trans]
 
-    window_trans = WindowGenerator(resize.output, track_loader.output, tuple(window_size), scaling, stride, radius_negative)
-    splitter = Split(window_trans.output, (60, 20, 20))
+    cache = open_cache(cache)
+    key = cache.key([video_path, track_path], stage='windows', track_name=track_name, image_size=list(image_size),
+                    window_size=list(window_size), scaling=list(scaling), stride=stride, radius=radius_negative,
+                    vectorized=vectorized) if cache is not None else None
+    operations, windows = cached_stages(build, cache, key, chunk_size)
 
-    operations = [video_loader, track_loader, resize, window_trans, splitter]
+    splitter = Split(windows, (60, 20, 20))
+    operations.append(splitter)
 
     if not os.path.exists(output_path):
         os.mkdir(output_path)
 
     dirs = ('train', 'test', 'val')
     prefix = os.path.splitext(os.path.basename(video_path))[0]
+    checkpoint = pipeline_checkpoint(output_path, prefix) if checkpoint else None
     for out, dir in zip(splitter.output, dirs):
         radius_trans = SplitPredicate(out, lambda dist: dist < radius_positive)
         out_dir = os.path.join(output_path, dir)
@@ -64,42 +132,450 @@ def window_radius_pipeline(video_path,
         positive_dir = os.path.join(out_dir, 'positive')
         negative_dir = os.path.join(out_dir, 'negative')
 
-        writer_positive = ImageSequenceWriter(radius_trans.positive, positive_dir, prefix)
-        writer_negative = ImageSequenceWriter(radius_trans.negative, negative_dir, prefix)
+        writer_positive = sequence_writer(ImageSequenceWriter, radius_trans.positive, positive_dir, prefix, output_format,
+                                          checkpoint=checkpoint)
+        writer_negative = sequence_writer(ImageSequenceWriter, radius_trans.negative, negative_dir, prefix, output_format,
+                                          checkpoint=checkpoint)
         operations.append(radius_trans)
         operations.append(writer_positive)
         operations.append(writer_negative)
 
-    run(operations)  # TODO: Make into decorator
-
-
-def image_sequence_pipeline(video_path, output_path, size):
-    loader = VideoLoader(video_path)
-    transformer = ImageResize(loader.output, tuple(size))
-    splitter = Split(transformer.output, (60, 20, 20))
+    # The number of windows differs per frame, so a partial run can't be resumed from a frame, but the
+    # writers skip the windows they already wrote
+    if not completed(operations):
+        run(with_backends(operations, backends), monitor, fuse=True)
 
-    operations = [loader, transformer, splitter]
 
-    dirs = ('train', 'test', 'val')
+@configurable_queues
+def image_sequence_pipeline(video_path, output_path, size, output_format='files', chunk_size=None, backends=None,
+                            monitor=None, checkpoint=False, cache=None):
+    split = (60, 20, 20)
+    dirs = [os.path.join(output_path, dir) for dir in ('train', 'test', 'val')]
     if not os.path.exists(output_path):
         os.mkdir(output_path)
 
     prefix = os.path.splitext(os.path.basename(video_path))[0]
-    for out, dir in zip(splitter.output, dirs):
-        writer = ImageSequenceWriter(out, os.path.join(output_path, dir), prefix)
+    checkpoint = pipeline_checkpoint(output_path, prefix) if checkpoint else None
+
+    # Every frame is written as one file, so a partial run continues from the first frame
+    # that isn't written yet, with every writer continuing from its share of the frames before it
+    start = 0
+    if checkpoint is not None and output_format == 'files':
+        start = split_resume_point(split, [checkpoint.written(os.path.join(dir, prefix)) for dir in dirs])
+
+    def build():
+        loader = VideoLoader(video_path, chunk_size=chunk_size, ranges=[(start, None)] if start else None)
+        transformer = Resize(loader.output, tuple(size))
+        return [loader, transformer]
+
+    cache = open_cache(cache)
+    key = cache.key([video_path], stage='frames', size=list(size)) if cache is not None else None
+    operations, frames = cached_stages(build, cache, key, chunk_size, start)
+
+    splitter = Split(frames, split, start)
+    operations.append(splitter)
+
+    for out, dir, start_index in zip(splitter.output, dirs, split_counts(split, start)):
+        writer = sequence_writer(ImageSequenceWriter, out, dir, prefix, output_format, start_index, checkpoint)
         operations.append(writer)
 
-    run(operations)  # TODO: Make into decorator
+    if not completed(operations):
+        run(with_backends(operations, backends), monitor, fuse=True)
 
 
-def start(operations):
+def sequence_writer(writer, input, path, prefix, output_format='files', start_index=0, checkpoint=None, **options):
+    """
+    Create the writer of a dataset output.
+
+    :param writer: the SequenceWriter class used for the 'files' format
+    :param input: the queue of samples to write
+    :param path: the directory to write to
+    :param prefix: prefix of the file names, with the 'shards' format the
+        samples are written to a shard set in a subdirectory with this name
+    :param output_format: 'files' to write every sample to its own file,
+        'shards' to pack them into a shard set
+    :param start_index: index of the first sample with the 'files' format
+    :param checkpoint: the Checkpoint the writer records its progress in
+    :param options: further arguments of the writer used for the 'files' format
+    """
+    if output_format == 'files':
+        return writer(input, path, prefix, start_index=start_index, checkpoint=checkpoint, **options)
+    elif output_format == 'shards':
+        return ShardWriter(input, os.path.join(path, prefix) if prefix else path, checkpoint=checkpoint)
+    raise ValueError('Unknown output format: {}'.format(output_format))
+
+
+def pipeline_checkpoint(output_path, name):
+    """
+    The checkpoint of the writers of a pipeline run, kept in its output
+    directory. Passing checkpoint=True to a pipeline function makes the
+    writers record their progress in it, so an interrupted run picks up
+    where it stopped when run again.
+
+    :param output_path: the output directory of the pipeline
+    :param name: name of the input, e.g. the name of the video
+    """
+    return Checkpoint(os.path.join(output_path, '.checkpoint-{}.json'.format(name)))
+
+
+def cached_stages(build, cache=None, key=None, chunk_size=None, start=0):
+    """
+    Create the stages producing a stream, or replay the stream instead if the
+    cache has it, see processing.cache. On a miss, the stream is added to the
+    cache as it passes through.
+
+    :param build: function creating the operations of the stages, the output of the last one is the stream
+    :param cache: the StageCache, or None to always create the stages
+    :param key: the key of the stream in the cache
+    :param chunk_size: if set, the replayed elements are put in chunks of this many elements
+    :param start: number of elements at the start of the stream the stages skip. Only
+        complete streams are added to the cache.
+    :return: the operations and the queue of the stream
+    """
+    if cache is not None:
+        try:
+            loader = CacheLoader(cache, key, chunk_size=chunk_size, start=start)
+            return [loader], loader.output
+        except KeyError:
+            # Not cached, or evicted since
+            pass
+
+    operations = build()
+    output = operations[-1].output
+    if cache is not None and not start:
+        duplicate = Duplicate(output)
+        operations += [duplicate, CacheWriter(duplicate.nth(1), cache, key)]
+        output = duplicate.nth(0)
+    return operations, output
+
+
+def completed(operations):
+    """
+    :return: whether the checkpoints of all writers of the operations record them as completed
+    """
+    writers = [operation for operation in operations
+               if isinstance(operation, Writer) and not isinstance(operation, CacheWriter)]
+    return bool(writers) and all(writer.completed for writer in writers)
+
+
+def with_backends(operations, backends=None):
+    """
+    Select how each operation is executed. Operations run in their own thread
+    by default, but can be moved to their own process instead.
+
+    :param operations: the operations of the pipeline
+    :param backends: mapping from operation class name to either 'thread' or 'process'
+    :return: the operations, with the process operations wrapped in ProcessOperation
+    """
+    if not backends:
+        return operations
+
+    out = []
     for operation in operations:
+        backend = backends.get(type(operation).__name__, 'thread')
+        if backend == 'process':
+            out.append(ProcessOperation(operation))
+        elif backend == 'thread':
+            out.append(operation)
+        else:
+            raise ValueError('Unknown backend: {}'.format(backend))
+    return out
+
+
+class Pipeline:
+    """
+    A graph of operations that is started, watched and shut down as a whole.
+    The edges of the graph are found by matching the output queues of the
+    operations to their input queues.
+
+    If any operation fails, the whole pipeline is cancelled: its channels are
+    cancelled, which stops every operation with a Cancelled exception as soon
+    as it waits on or uses one of them, and the error is raised again by
+    run/wait. The queues linking the operations must therefore be Channels,
+    as created by make_queue.
+    """
+
+    def __init__(self, operations=(), backends=None, shutdown_timeout=10.0, fuse=False):
+        """
+        :param operations: the operations of the pipeline
+        :param backends: mapping from operation class name to either 'thread' or 'process', see with_backends
+        :param shutdown_timeout: seconds to wait for the operations to stop after a failure
+        :param fuse: run linked element-wise transformers in a single thread when started, see fuse
+        """
+        self._backends = backends
+        self._fuse = fuse
+        self._shutdown_timeout = shutdown_timeout
+        self._operations = []
+        self._failed = Event()
+        self._error = None
+        self._start = None
+        self._end = None
+        self.add(*operations)
+
+    def add(self, *operations):
+        """
+        Add operations to the pipeline.
+
+        :return: the last added operation, for chaining
+        """
+        if self._start is not None:
+            raise RuntimeError('Operations must be added before the pipeline is started')
+        self._operations += with_backends(list(operations), self._backends)
+        return operations[-1] if operations else None
+
+    @property
+    def operations(self):
+        return list(self._operations)
+
+    @property
+    def edges(self):
+        """
+        :return: list of (producer, consumer, queue) tuples, one for every queue linking two operations
+        """
+        producers = {}
+        for operation in self._operations:
+            for queue in queue_list(getattr(operation, 'output', None)):
+                producers[id(queue)] = operation
+
+        edges = []
+        for operation in self._operations:
+            for queue in queue_list(getattr(operation, 'input', None)):
+                if id(queue) in producers:
+                    edges.append((producers[id(queue)], operation, queue))
+        return edges
+
+    @property
+    def queues(self):
+        queues = {}
+        for operation in self._operations:
+            for queue in queue_list(getattr(operation, 'input', None)) + queue_list(getattr(operation, 'output', None)):
+                queues[id(queue)] = queue
+        return list(queues.values())
+
+    @property
+    def elapsed(self):
+        """
+        Wall time in seconds since the pipeline was started, until it stopped.
+        """
+        if self._start is None:
+            return 0.0
+        return (self._end or time.perf_counter()) - self._start
+
+    def _guard(self, operation):
+        run = operation.run
+
+        def guarded():
+            try:
+                run()
+            except Cancelled:
+                pass
+            except BaseException as e:
+                self._fail(e)
+
+        operation.run = guarded
+
+    def _fail(self, error):
+        if self._error is None:
+            self._error = error
+        self._failed.set()
+
+    def start(self):
+        for queue in self.queues:
+            if not isinstance(queue, Channel):
+                raise TypeError('The queues of a pipeline must be Channels, create them with make_queue, '
+                                'not {}'.format(type(queue).__name__))
+
+        if self._fuse:
+            self._operations = fuse(self._operations)
+
+        self._start = time.perf_counter()
+        for operation in self._operations:
+            if not isinstance(operation, ProcessOperation):
+                self._guard(operation)
+                # A stuck operation mustn't keep the interpreter alive after its pipeline failed
+                operation.daemon = True
+        start(self._operations)
+
+    def _check_processes(self):
+        for operation in self._operations:
+            if isinstance(operation, ProcessOperation) and operation.exitcode not in (None, 0):
+                self._fail(RuntimeError('{} failed in its process with exit code {}:\n{}'.format(
+                    operation.name, operation.exitcode, operation.error or '')))
+
+    def wait(self):
+        """
+        Wait for all operations to finish, raising the error of the first failed operation.
+        """
+        try:
+            while any(operation.is_alive() for operation in self._operations):
+                self._check_processes()
+                if self._failed.wait(0.1):
+                    break
+            self._check_processes()
+
+            if self._error is not None:
+                self.cancel()
+                raise self._error
+
+            join(self._operations)
+        finally:
+            self._end = time.perf_counter()
+
+    def cancel(self):
+        """
+        Stop all operations as quickly as possible, discarding the elements in the queues.
+        """
+        # Cancelling the channels wakes up everyone waiting on them
+        for queue in self.queues:
+            queue.cancel()
+
+        for operation in self._operations:
+            if isinstance(operation, ProcessOperation):
+                operation.terminate()
+
+        deadline = time.perf_counter() + self._shutdown_timeout
+        while time.perf_counter() < deadline:
+            for operation in self._operations:
+                operation.join(0.01)
+            if not any(operation.is_alive() for operation in self._operations):
+                break
+
+    def run_inline(self):
+        """
+        Run the pipeline in the calling thread, see run_inline.
+        """
+        self._start = time.perf_counter()
+        try:
+            run_inline(self._operations)
+        finally:
+            self._end = time.perf_counter()
+
+    def run(self, monitor=None):
+        """
+        Start the pipeline and wait for it to finish.
+
+        :param monitor: a Monitor to collect statistics of the run with
+        """
+        if monitor is None:
+            self.start()
+            self.wait()
+            return
+
+        # Fuse first, so the monitor sees the operations that actually run
+        if self._fuse:
+            self._operations = fuse(self._operations)
+
+        with monitor.watch(self._operations):
+            self.start()
+            self.wait()
+
+
+def fuse(operations):
+    """
+    Replace every sequence of linked element-wise transformers by a Chain
+    running them in a single thread. Transformers are only linked if the
+    queue between them isn't read by any other operation.
+
+    :param operations: the operations of a pipeline
+    :return: the operations, with the fused transformers replaced by their chain
+    """
+    readers = {}
+    for operation in operations:
+        for queue in queue_list(getattr(operation, 'input', None)):
+            readers[id(queue)] = readers.get(id(queue), 0) + 1
+
+    by_input = {id(operation.input): operation for operation in operations if is_elementwise(operation)}
+
+    def successor(operation):
+        if not is_elementwise(operation) or readers.get(id(operation.output)) != 1:
+            return None
+        return by_input.get(id(operation.output))
+
+    linked = set(id(successor(operation)) for operation in operations if successor(operation) is not None)
+
+    out = []
+    for operation in operations:
+        if id(operation) in linked:
+            continue
+
+        chain = [operation]
+        while successor(chain[-1]) is not None:
+            chain.append(successor(chain[-1]))
+        out.append(Chain(*chain) if len(chain) > 1 else operation)
+    return out
+
+
+def run_inline(operations):
+    """
+    Run the operations of a pipeline in the calling thread, without starting
+    any threads or processes. The loaders take turns producing an item, which
+    is pushed through the transformers to the writers right away, so only the
+    items of inputs waiting for each other are held back. The output is the
+    same as when the pipeline runs threaded.
+
+    Items put on queues that no operation of the pipeline reads are discarded.
+
+    :param operations: the operations of the pipeline
+    """
+    operations = [getattr(operation, 'operation', operation) for operation in operations]
+
+    readers = {}
+    for operation in operations:
+        for index, queue in enumerate(queue_list(getattr(operation, 'input', None))):
+            readers[id(queue)] = (operation, index)
+
+    def push(queue, item):
+        if id(queue) not in readers:
+            return
+
+        operation, index = readers[id(queue)]
+        if isinstance(operation, Writer):
+            if item is None:
+                operation._end()
+            else:
+                operation._consume_item(item)
+            return
+
+        outputs = queue_list(operation.output)
+        for i, out in operation._feed(index, item):
+            push(outputs[i], out)
+
+    for operation in operations:
+        if isinstance(operation, Writer):
+            operation._begin()
+
+    sources = [(operation, operation.iterate()) for operation in operations if isinstance(operation, Loader)]
+    while sources:
+        for source in list(sources):
+            operation, items = source
+            item = next(items, None)
+            push(operation.output, item)
+            if item is None:
+                sources.remove(source)
+
+
+def start(operations):
+    # Processes are forked before any thread is started, their bridges included,
+    # so no locks are held while forking
+    processes = [operation for operation in operations if isinstance(operation, ProcessOperation)]
+    for operation in processes:
         operation.start()
+    for operation in processes:
+        operation.start_bridges()
+    for operation in operations:
+        if not isinstance(operation, ProcessOperation):
+            operation.start()
 
 def join(operations):
     for operation in operations:
         operation.join()
 
-def run(operations):
-    start(operations)
-    join(operations)
\ No newline at end of file
+def run(operations, monitor=None, fuse=False):
+    """
+    Run the operations of a pipeline until they are all done, see Pipeline.
+
+    :param operations: the operations of the pipeline
+    :param monitor: a Monitor to collect statistics of the run with
+    :param fuse: run linked element-wise transformers in a single thread, see fuse
+    """
+    Pipeline(operations, fuse=fuse).run(monitor)
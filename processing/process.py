@@ -0,0 +1,292 @@
+import queue
+import traceback
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from threading import Thread, Event
+
+import numpy as np
+
+from processing.operation import Chunk, Cancelled, queue_list
+
+
+class _Slot:
+    """
+    Reference to an array stored in a slot of a SharedArrayQueue.
+    """
+
+    __slots__ = ('index', 'shape', 'dtype')
+
+    def __init__(self, index, shape, dtype):
+        self.index = index
+        self.shape = shape
+        self.dtype = dtype
+
+
+class SharedArrayQueue:
+    """
+    A queue between processes that moves NumPy arrays through a ring of
+    shared memory slots instead of pickling them. Only a small reference
+    to the slot is sent through the underlying multiprocessing queue.
+
+    Arrays are moved through shared memory when they are put on their own,
+    in tuples or in chunks. All other elements, arrays that don't fit in a
+    slot and arrays put while all slots are taken are pickled as usual.
+    """
+
+    def __init__(self, slot_size=2**23, slots=8, maxsize=1000, context=None):
+        """
+        :param slot_size: size in bytes of each slot, the default fits a 1080p RGB frame
+        :param slots: number of slots in the ring
+        :param maxsize: maximum number of elements in the queue
+        :param context: multiprocessing context to create the queue with
+        """
+        context = context or mp.get_context()
+        self._slot_size = slot_size
+        self._memory = shared_memory.SharedMemory(create=True, size=slot_size*slots)
+        self._used = context.Array('b', slots)
+        self._queue = context.Queue(maxsize)
+        self._unlinked = False
+
+    def _claim(self):
+        with self._used.get_lock():
+            for i, used in enumerate(self._used.get_obj()):
+                if not used:
+                    self._used[i] = 1
+                    return i
+        return None
+
+    def _release(self, index):
+        with self._used.get_lock():
+            self._used[index] = 0
+
+    def _slot_array(self, index, shape, dtype):
+        return np.ndarray(shape, dtype, buffer=self._memory.buf, offset=index*self._slot_size)
+
+    def _pack(self, obj):
+        if isinstance(obj, np.ndarray):
+            if obj.dtype.hasobject or obj.nbytes > self._slot_size:
+                return obj
+            index = self._claim()
+            if index is None:
+                return obj
+            self._slot_array(index, obj.shape, obj.dtype)[...] = obj
+            return _Slot(index, obj.shape, obj.dtype.str)
+        elif isinstance(obj, Chunk):
+            return Chunk(self._pack(elem) for elem in obj)
+        elif isinstance(obj, tuple):
+            return tuple(self._pack(elem) for elem in obj)
+        return obj
+
+    def _unpack(self, obj):
+        if isinstance(obj, _Slot):
+            array = self._slot_array(obj.index, obj.shape, obj.dtype).copy()
+            self._release(obj.index)
+            return array
+        elif isinstance(obj, Chunk):
+            return Chunk(self._unpack(elem) for elem in obj)
+        elif isinstance(obj, tuple):
+            return tuple(self._unpack(elem) for elem in obj)
+        return obj
+
+    def put(self, elem):
+        self._queue.put(self._pack(elem))
+
+    def get(self):
+        return self._unpack(self._queue.get())
+
+    def drain(self):
+        """
+        Discard the elements in the queue without unpacking them, waking up a
+        process blocked putting on the full queue.
+        """
+        try:
+            while True:
+                self._queue.get(block=False)
+        except queue.Empty:
+            pass
+
+    def abandon(self):
+        """
+        Don't wait for the elements still being sent to be received when the
+        process exits, for queues whose receiving process is gone.
+        """
+        self._queue.cancel_join_thread()
+
+    def unlink(self):
+        """
+        Remove the shared memory from the system. Processes that still have it
+        mapped can keep using it until they close the queue.
+        """
+        if not self._unlinked:
+            self._memory.unlink()
+            self._unlinked = True
+
+    def close(self):
+        """
+        Release the shared memory. Must be called by the process that created the queue
+        once no other process uses it anymore.
+        """
+        # Elements nobody will get anymore mustn't keep the process from exiting
+        self._queue.cancel_join_thread()
+        self._queue.close()
+        self._memory.close()
+        self.unlink()
+
+
+def _forward(source, target, stopped=None):
+    try:
+        while stopped is None or not stopped.is_set():
+            elem = source.get()
+            if stopped is not None and stopped.is_set():
+                return
+            target.put(elem)
+            if elem is None:
+                return
+    except Cancelled:
+        return
+
+
+class ProcessOperation:
+    """
+    Runs an operation in its own process instead of a thread, so CPU bound
+    Python code isn't serialized by the GIL. The operation keeps using its
+    own queues: bridge threads on both sides of the process boundary move
+    the elements through SharedArrayQueues.
+
+    The process is forked, so the operation doesn't need to be picklable.
+    All ProcessOperations of a pipeline should be started before any threads
+    are, their bridges included, which pipeline.start takes care of.
+    """
+
+    def __init__(self, operation, slot_size=2**23, slots=8):
+        """
+        :param operation: the operation to run in a separate process
+        :param slot_size: size in bytes of the shared memory slots of each queue
+        :param slots: number of shared memory slots of each queue
+        """
+        context = mp.get_context('fork')
+        self._operation = operation
+        self._inputs = queue_list(getattr(operation, 'input', None))
+        self._outputs = queue_list(getattr(operation, 'output', None))
+        self._shared_inputs = [SharedArrayQueue(slot_size, slots, context=context) for _ in self._inputs]
+        self._shared_outputs = [SharedArrayQueue(slot_size, slots, context=context) for _ in self._outputs]
+        self._errors = context.SimpleQueue()
+        self._error = None
+        self._process = context.Process(target=self._run_child, name=operation.name, daemon=True)
+        self._bridges = []
+        self._stopped = Event()
+        self._closed = False
+
+    @property
+    def operation(self):
+        return self._operation
+
+    @property
+    def name(self):
+        return self._operation.name
+
+    @property
+    def input(self):
+        return self._operation.input
+
+    @property
+    def output(self):
+        return self._operation.output
+
+    @property
+    def exitcode(self):
+        return self._process.exitcode
+
+    @property
+    def error(self):
+        """
+        The formatted traceback of the exception the operation raised in its process, if any.
+        """
+        if self._error is None and not self._errors.empty():
+            self._error = self._errors.get()
+        return self._error
+
+    def _run_child(self):
+        # The queues were copied in whatever state they were in when forking, and
+        # their locks may be held by threads that don't exist in this process.
+        for queue in self._inputs + self._outputs:
+            if hasattr(queue, 'reset'):
+                queue.reset()
+            else:
+                queue.__init__(queue.maxsize)
+
+        bridges = [Thread(target=_forward, args=(shared, queue), daemon=True)
+                   for shared, queue in zip(self._shared_inputs, self._inputs)]
+        outputs = [Thread(target=_forward, args=(queue, shared), daemon=True)
+                   for queue, shared in zip(self._outputs, self._shared_outputs)]
+        for bridge in bridges + outputs:
+            bridge.start()
+
+        try:
+            self._operation.run()
+        except BaseException:
+            self._errors.put(traceback.format_exc())
+            raise
+
+        for bridge in outputs:
+            bridge.join()
+
+    def start(self):
+        """
+        Fork the process. The elements only move once start_bridges is called too.
+        """
+        self._process.start()
+
+    def start_bridges(self):
+        """
+        Start the threads moving the elements between the queues of the pipeline
+        and the process. Threads hold locks a process forked later would copy,
+        so this should be called once every process of the pipeline is started.
+        """
+        self._bridges = [Thread(target=_forward, args=(queue, shared, self._stopped), daemon=True)
+                         for queue, shared in zip(self._inputs, self._shared_inputs)]
+        self._bridges += [Thread(target=_forward, args=(shared, queue, self._stopped), daemon=True)
+                          for shared, queue in zip(self._shared_outputs, self._outputs)]
+        for bridge in self._bridges:
+            bridge.start()
+
+    def join(self, timeout=None):
+        self._process.join(timeout)
+        if self._process.is_alive() or self._closed:
+            return
+
+        for bridge in self._bridges:
+            bridge.join(timeout)
+            if bridge.is_alive():
+                return
+        for shared in self._shared_inputs + self._shared_outputs:
+            shared.close()
+        self._closed = True
+
+    def terminate(self, timeout=1.0):
+        """
+        Stop the process without waiting for it to finish its input, e.g.
+        because another operation of the pipeline failed, and stop the bridges.
+
+        The shared memory is unlinked right away and closed once the bridges
+        have stopped. Bridges waiting on an input of the pipeline only stop
+        once the pipeline wakes them up, join closes the memory after that.
+
+        :param timeout: seconds to wait for the bridges to stop
+        """
+        self._process.terminate()
+        self._process.join()
+
+        self._stopped.set()
+        for shared in self._shared_inputs + self._shared_outputs:
+            shared.abandon()
+            shared.unlink()
+        # Wake up the bridges blocked on a full input or an empty output of the process
+        for shared in self._shared_inputs:
+            shared.drain()
+        for shared in self._shared_outputs:
+            shared.put(None)
+        self.join(timeout)
+
+    def is_alive(self):
+        return self._process.is_alive()
@@ -0,0 +1,359 @@
+"""
+Queues linking the operations of a pipeline.
+
+Channel adds an explicit end of stream and cancellation to the standard
+queue, and wait_any lets a consumer wait on several of them at once.
+
+Counting items alone is a poor bound: a thousand 1080p frames take
+gigabytes while a thousand track rows take almost nothing. BoundedQueue,
+a Channel, is bounded by the number of bytes its elements take as well,
+and can adapt its capacity to how fast its consumer takes elements out.
+
+Operations create their queues with make_queue, which uses pipeline-wide
+defaults that can be changed with queue_defaults:
+
+    with queue_defaults(max_bytes=2**30):
+        pipeline = ...
+
+and the queue of a single edge can be changed with BoundedQueue.resize.
+"""
+import sys
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from queue import Queue, Empty, Full
+from threading import Event
+
+import numpy as np
+
+from processing.operation import Cancelled
+
+_defaults = ContextVar('queue_defaults', default={
+    'maxsize': 1000,
+    'max_bytes': 2**28,
+    'adaptive': False,
+    'target_latency': 1.0,
+    'min_size': 8
+})
+
+
+def nbytes(elem):
+    """
+    :return: the approximate number of bytes an element takes, counting the arrays it contains
+    """
+    if elem is None:
+        return 0
+    elif isinstance(elem, np.ndarray):
+        return elem.nbytes
+    elif isinstance(elem, (bytes, bytearray, str)):
+        return len(elem)
+    elif isinstance(elem, (list, tuple)):
+        return sum(nbytes(part) for part in elem)
+    return sys.getsizeof(elem)
+
+
+class Channel(Queue):
+    """
+    A queue with an explicit end of stream and cancellation.
+
+    Putting None, the shutdown signal of the pipeline, closes the channel.
+    Once a closed channel is empty, every get returns None right away, so
+    the end of stream can be seen any number of times. Cancelling the channel
+    wakes up everyone waiting on it and makes every following get and put
+    raise Cancelled.
+
+    wait_any waits on several channels at once, which is what lets a
+    consumer take elements from whichever input is ready without polling.
+    """
+
+    def __init__(self, maxsize=0):
+        super().__init__(maxsize)
+        self._closed = False
+        self._cancelled = False
+        self._waiters = set()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    def _wake(self):
+        self.not_empty.notify_all()
+        for waiter in self._waiters:
+            waiter.set()
+
+    def close(self):
+        """
+        End the stream. Elements already in the channel can still be taken out.
+        """
+        with self.mutex:
+            self._closed = True
+            self._wake()
+
+    def cancel(self):
+        """
+        Abort the stream, discarding the elements in the channel.
+        """
+        with self.mutex:
+            self._cancelled = True
+            self.queue.clear()
+            self.not_full.notify_all()
+            self._wake()
+
+    def ready(self):
+        """
+        :return: whether a get would return without waiting
+        """
+        with self.mutex:
+            return self._qsize() > 0 or self._closed or self._cancelled
+
+    def _entry(self, item):
+        return item
+
+    def _full(self, entry):
+        return 0 < self.maxsize <= self._qsize()
+
+    def _waited(self, seconds):
+        """
+        Called by wait_any after its caller waited on this channel among others.
+        """
+        pass
+
+    def put(self, item, block=True, timeout=None):
+        if item is None:
+            if self._cancelled:
+                raise Cancelled()
+            self.close()
+            return
+
+        entry = self._entry(item)
+        with self.not_full:
+            if self._closed:
+                raise ValueError('Put on a closed channel')
+
+            if not block:
+                if self._full(entry) and not self._cancelled:
+                    raise Full
+            elif timeout is None:
+                while self._full(entry) and not self._cancelled:
+                    self.not_full.wait()
+            elif timeout < 0:
+                raise ValueError("'timeout' must be a non-negative number")
+            else:
+                endtime = time.monotonic() + timeout
+                while self._full(entry) and not self._cancelled:
+                    remaining = endtime - time.monotonic()
+                    if remaining <= 0.0:
+                        raise Full
+                    self.not_full.wait(remaining)
+
+            if self._cancelled:
+                raise Cancelled()
+            self._put(entry)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+            for waiter in self._waiters:
+                waiter.set()
+
+    def get(self, block=True, timeout=None):
+        with self.not_empty:
+            if not block:
+                if not self._qsize() and not self._closed and not self._cancelled:
+                    raise Empty
+            elif timeout is None:
+                while not self._qsize() and not self._closed and not self._cancelled:
+                    self.not_empty.wait()
+            elif timeout < 0:
+                raise ValueError("'timeout' must be a non-negative number")
+            else:
+                endtime = time.monotonic() + timeout
+                while not self._qsize() and not self._closed and not self._cancelled:
+                    remaining = endtime - time.monotonic()
+                    if remaining <= 0.0:
+                        raise Empty
+                    self.not_empty.wait(remaining)
+
+            if self._cancelled:
+                raise Cancelled()
+            if not self._qsize():
+                return None
+            item = self._get()
+            self.not_full.notify()
+            return item
+
+
+def wait_any(channels):
+    """
+    Wait until at least one of the channels is ready, i.e. has an element,
+    has ended or was cancelled.
+
+    :return: list of the ready channels, in the order they were given
+    """
+    for channel in channels:
+        if not isinstance(channel, Channel):
+            raise TypeError('Can only wait on Channels, not {}'.format(type(channel).__name__))
+
+    event = Event()
+    for channel in channels:
+        with channel.mutex:
+            channel._waiters.add(event)
+    start = None
+    try:
+        while True:
+            event.clear()
+            ready = [channel for channel in channels if channel.ready()]
+            if ready:
+                return ready
+            if start is None:
+                start = time.perf_counter()
+            event.wait()
+    finally:
+        for channel in channels:
+            with channel.mutex:
+                channel._waiters.discard(event)
+        if start is not None:
+            waited = time.perf_counter() - start
+            for channel in channels:
+                channel._waited(waited)
+
+
+class BoundedQueue(Channel):
+    """
+    A queue bounded by the number of elements and by the total number of
+    bytes of the elements in it. An element is always admitted into an empty
+    queue, so elements larger than max_bytes still pass one at a time.
+
+    In adaptive mode the number of elements is further limited to what the
+    consumer takes out in target_latency seconds, measured from the time it
+    spends between taking elements out. Buffering more than that only costs
+    memory when the producer is faster, while a slower producer keeps the
+    queue near empty anyway.
+    """
+
+    def __init__(self, maxsize=0, max_bytes=0, adaptive=False, target_latency=1.0, min_size=8):
+        """
+        :param maxsize: maximum number of elements, 0 for no limit
+        :param max_bytes: maximum total size of the elements in bytes, 0 for no limit
+        :param adaptive: limit the number of elements by the measured consumer rate
+        :param target_latency: seconds of consumption to buffer in adaptive mode
+        :param min_size: lowest limit on the number of elements in adaptive mode
+        """
+        super().__init__(maxsize)
+        self.max_bytes = max_bytes
+        self.adaptive = adaptive
+        self.target_latency = target_latency
+        self.min_size = min_size
+        self._bytes = 0
+        self._capacity = maxsize
+        self._service_time = None
+        self._last_get = None
+
+    def reset(self):
+        """
+        Empty the queue and recreate its locks, keeping its settings. Used after forking.
+        """
+        self.__init__(self.maxsize, self.max_bytes, self.adaptive, self.target_latency, self.min_size)
+
+    @property
+    def bytes(self):
+        return self._bytes
+
+    @property
+    def capacity(self):
+        """
+        The current limit on the number of elements, 0 for no limit.
+        """
+        return self._capacity
+
+    def resize(self, maxsize=None, max_bytes=None):
+        """
+        Change the limits of the queue, waking up producers if there is room now.
+        """
+        with self.mutex:
+            if maxsize is not None:
+                self.maxsize = maxsize
+                self._capacity = maxsize
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            self.not_full.notify_all()
+
+    def full(self):
+        with self.mutex:
+            return self._full((None, 0))
+
+    def _entry(self, item):
+        return item, nbytes(item)
+
+    def _full(self, entry):
+        n = self._qsize()
+        if n == 0:
+            return False
+        return 0 < self._capacity <= n or 0 < self.max_bytes < self._bytes + entry[1]
+
+    def get(self, block=True, timeout=None):
+        if self.adaptive:
+            self._measure()
+        item = super().get(block, timeout)
+        if self.adaptive:
+            self._last_get = time.perf_counter()
+        return item
+
+    def _waited(self, seconds):
+        # Time the consumer spent waiting in wait_any is not time spent on the previous element
+        if self._last_get is not None:
+            self._last_get += seconds
+
+    def _measure(self):
+        # Time since the previous get returned is the time the consumer spent on that element
+        if self._last_get is None:
+            return
+        service_time = time.perf_counter() - self._last_get
+        if self._service_time is None:
+            self._service_time = service_time
+        else:
+            self._service_time += 0.1*(service_time - self._service_time)
+
+        capacity = max(self.min_size, int(self.target_latency / max(self._service_time, 1e-9)))
+        if self.maxsize > 0:
+            capacity = min(capacity, self.maxsize)
+        with self.mutex:
+            if capacity > self._capacity > 0:
+                self.not_full.notify_all()
+            self._capacity = capacity
+
+    def _get(self):
+        item, size = self.queue.popleft()
+        self._bytes -= size
+        return item
+
+    def _put(self, item):
+        self.queue.append(item)
+        self._bytes += item[1]
+
+
+@contextmanager
+def queue_defaults(**settings):
+    """
+    Change the settings of the queues created by make_queue within the block,
+    see BoundedQueue for the available settings.
+    """
+    unknown = set(settings) - set(_defaults.get())
+    if unknown:
+        raise ValueError('Unknown queue settings: {}'.format(', '.join(sorted(unknown))))
+
+    token = _defaults.set({**_defaults.get(), **settings})
+    try:
+        yield
+    finally:
+        _defaults.reset(token)
+
+
+def make_queue(**settings):
+    """
+    Create a queue for an edge of a pipeline with the current defaults,
+    overridden by the given settings.
+    """
+    return BoundedQueue(**{**_defaults.get(), **settings})
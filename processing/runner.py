@@ -1,51 +1,39 @@
 import json
-import glob
-import os
 import argparse
-from itertools import zip_longest
-from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import importlib
 
-# TODO: Really fix before you die
-#from processing import pipeline
-#from models.slidingeye.dataset import pipeline
-import processing.pipelines.simple_pupil_generator as pipeline
+from processing.multiprocessing import run_spec
 
-parser = argparse.ArgumentParser()
-parser.add_argument('spec', help='Path to spec file')
-args = parser.parse_args()
 
-f = open(args.spec)
-spec = json.load(f)
+def main():
+    parser = argparse.ArgumentParser(description='Run a pipeline on every set of inputs described by a spec file.')
+    parser.add_argument('spec', help='Path to spec file')
+    parser.add_argument('--module', default=None,
+                        help='Module containing the pipeline, overrides the "module" key of the spec')
+    parser.add_argument('--workers', type=int, default=8, help='Number of worker processes')
+    parser.add_argument('--max-in-flight', type=int, default=None,
+                        help='Maximum number of unfinished jobs, defaults to twice the number of workers')
+    parser.add_argument('--retries', type=int, default=0, help='Number of times a failed job is run again')
+    parser.add_argument('--summary', default=None, help='Write a JSON summary of all jobs to this path')
+    parser.add_argument('--checkpoint', default=None,
+                        help='Record completed jobs in this file and skip them when run again')
+    args = parser.parse_args()
 
-pipe = getattr(pipeline, spec['pipeline'])
+    with open(args.spec) as f:
+        spec = json.load(f)
 
-base_path = spec['path']
+    module = importlib.import_module(args.module or spec.get('module', 'processing.pipeline'))
+    summary = run_spec(spec, module, args.workers, args.max_in_flight, args.retries,
+                       checkpoint=args.checkpoint)
 
-base_args = spec['arguments']
+    print(summary.report())
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump(summary.to_dict(), f)
 
-patterns = [glob.glob(os.path.join(base_path, path))
-            for path in spec['patterns'].values()]
-
-names = list(spec['patterns'].keys())
-
-# Kinda shitty way to add the base path to arguments containing paths
-for key, val in base_args.items():
-    if 'path' in key:
-        base_args[key] = os.path.join(base_path, val)
-
-
-pool = ProcessPoolExecutor(8)
-
-for args in zip_longest(*patterns):
-    kwargs = dict(zip(names, args))
-    #p = pipe(**kwargs, **base_args)
-    #ops = tfunc(**kwargs, **base_args)
-    #pipe(**kwargs, **base_args)
-    pool.submit(pipe, **kwargs, **base_args)
-
-
-pool.shutdown(True)
-
-print('Done!')
+    if summary.failed:
+        raise SystemExit(1)
 
 
+if __name__ == '__main__':
+    main()
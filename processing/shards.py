@@ -0,0 +1,150 @@
+"""
+Packed on-disk format for datasets of many small arrays, like the windows
+generated by the window pipelines. Instead of one file per sample, samples
+are appended to a few large raw binary shards. An index stores the shard,
+byte offset and shape of every sample, so a single sample can be read
+without touching the others, and shards are memory mapped when read.
+
+A shard set is a directory with a metadata file, the index and the shards.
+All samples in a set have the same dtype, but can have different shapes.
+"""
+import os
+import json
+
+import numpy as np
+
+METADATA_FILE = 'shards.json'
+INDEX_FILE = 'index.npy'
+MAX_DIMS = 4
+
+INDEX_DTYPE = np.dtype([
+    ('shard', np.int32),
+    ('offset', np.int64),
+    ('ndim', np.int8),
+    ('shape', np.int64, (MAX_DIMS,))
+])
+
+
+class ShardAppender:
+    """
+    Appends samples to a shard set, starting a new shard whenever the
+    current one would grow past shard_size. The index and metadata are
+    written when the appender is closed.
+    """
+
+    def __init__(self, path, shard_size=2**30):
+        """
+        :param path: directory to write the shard set to
+        :param shard_size: maximum size in bytes of each shard, a shard is
+            only larger if it contains a single larger sample
+        """
+        if not os.path.exists(path):
+            os.makedirs(path, exist_ok=True)
+        elif not os.path.isdir(path):
+            raise RuntimeError('Path is not a directory. Shards need a directory to write to.')
+
+        self._path = path
+        self._shard_size = shard_size
+        self._dtype = None
+        self._shards = []
+        self._file = None
+        self._size = 0
+        self._index = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self._index)
+
+    def _next_shard(self):
+        if self._file is not None:
+            self._file.close()
+        fname = '{:05d}.bin'.format(len(self._shards))
+        self._shards.append(fname)
+        self._file = open(os.path.join(self._path, fname), 'wb')
+        self._size = 0
+
+    def append(self, sample):
+        # ascontiguousarray would turn scalars into arrays of one element
+        sample = np.asarray(sample, order='C')
+        if sample.ndim > MAX_DIMS:
+            raise ValueError('Samples can have at most {} dimensions'.format(MAX_DIMS))
+        if self._dtype is None:
+            self._dtype = sample.dtype
+        elif sample.dtype != self._dtype:
+            raise ValueError('All samples must have the same dtype, expected {} but got {}'.format(
+                self._dtype, sample.dtype))
+
+        if self._file is None or (self._size > 0 and self._size + sample.nbytes > self._shard_size):
+            self._next_shard()
+
+        shape = sample.shape + (0,)*(MAX_DIMS - sample.ndim)
+        self._index.append((len(self._shards) - 1, self._size, sample.ndim, shape))
+        self._file.write(sample.data)
+        self._size += sample.nbytes
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+        np.save(os.path.join(self._path, INDEX_FILE), np.array(self._index, dtype=INDEX_DTYPE))
+        meta = {
+            'length': len(self._index),
+            'dtype': self._dtype.str if self._dtype is not None else None,
+            'shards': self._shards
+        }
+        with open(os.path.join(self._path, METADATA_FILE), 'w') as f:
+            json.dump(meta, f)
+
+
+class ShardReader:
+    """
+    Random access to the samples of a shard set. Samples are read-only
+    views of the memory mapped shards, copy them to modify them.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: directory the shard set was written to
+        """
+        with open(os.path.join(path, METADATA_FILE)) as f:
+            meta = json.load(f)
+
+        self._path = path
+        self._dtype = np.dtype(meta['dtype']) if meta['dtype'] is not None else None
+        self._index = np.load(os.path.join(path, INDEX_FILE))
+        self._shards = [np.memmap(os.path.join(path, fname), np.uint8, 'r')
+                        if os.path.getsize(os.path.join(path, fname)) > 0 else np.empty(0, np.uint8)
+                        for fname in meta['shards']]
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    def __len__(self):
+        return len(self._index)
+
+    def shape(self, index):
+        entry = self._index[index]
+        return tuple(int(n) for n in entry['shape'][:entry['ndim']])
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Sample index out of range')
+
+        entry = self._index[index]
+        shape = self.shape(index)
+        offset = int(entry['offset'])
+        size = int(np.prod(shape, dtype=np.int64))*self._dtype.itemsize
+        return self._shards[entry['shard']][offset:offset + size].view(self._dtype).reshape(shape)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
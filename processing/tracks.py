@@ -0,0 +1,118 @@
+"""
+Columnar on-disk format for tracks. A track collection is stored as a
+directory containing a metadata file and one structured NumPy array per
+track, with one field per value of the track type. The arrays are memory
+mapped when read, so loading even very long tracks is nearly free.
+"""
+import os
+import json
+
+import numpy as np
+
+TRACK_FIELDS = {
+    'point': ('x', 'y'),
+    'inscribed_circle': ('cx', 'cy', 'width', 'height', 'angle'),
+    'rectangle_region': ('x', 'y', 'width', 'height'),
+}
+
+METADATA_FILE = 'tracks.json'
+
+
+def track_fields(type):
+    if type not in TRACK_FIELDS:
+        raise ValueError('Unknown track type: {}'.format(type))
+    return TRACK_FIELDS[type]
+
+
+def track_dtype(type, base=np.float64):
+    """
+    :param type: track type
+    :param base: dtype of every field
+    :return: the structured dtype used to store tracks of the given type
+    """
+    return np.dtype([(field, base) for field in track_fields(type)])
+
+
+def to_array(type, data):
+    """
+    Convert track data given as a list of dicts to a structured array.
+    """
+    fields = track_fields(type)
+    return np.array([tuple(elem[field] for field in fields) for elem in data], dtype=track_dtype(type))
+
+
+def to_dicts(type, array):
+    """
+    Convert a structured array of track data to a list of dicts.
+    """
+    fields = track_fields(type)
+    return [dict(zip(fields, row)) for row in array.tolist()]
+
+
+def write_tracks(path, tracks, resolution):
+    """
+    Write tracks in the columnar format.
+
+    :param path: directory to write the tracks to
+    :param tracks: list of (name, type, data) tuples, where data is a structured array
+    :param resolution: (height, width) of the video the tracks belong to, if known
+    """
+    if not os.path.exists(path):
+        os.mkdir(path)
+
+    length = len(tracks[0][2]) if tracks else 0
+    meta = []
+    for i, (name, type, data) in enumerate(tracks):
+        if len(data) != length:
+            raise ValueError('All tracks must have the same length')
+        fname = '{}.npy'.format(i)
+        np.save(os.path.join(path, fname), np.asarray(data, dtype=track_dtype(type)))
+        meta.append({'name': name, 'type': type, 'file': fname})
+
+    out = {
+        'length': length,
+        'tracks': meta
+    }
+    if resolution is not None:
+        out['video_resolution'] = {
+            'width': resolution[1],
+            'height': resolution[0]
+        }
+
+    with open(os.path.join(path, METADATA_FILE), 'w') as f:
+        json.dump(out, f)
+
+
+def read_tracks(path, mmap=True):
+    """
+    Read tracks written in the columnar format.
+
+    :param path: directory the tracks were written to
+    :param mmap: memory map the track data instead of reading it
+    :return: the metadata dict, where each track has its structured array under 'data'
+    """
+    with open(os.path.join(path, METADATA_FILE)) as f:
+        meta = json.load(f)
+
+    for track in meta['tracks']:
+        track['data'] = np.load(os.path.join(path, track['file']), mmap_mode='r' if mmap else None)
+    return meta
+
+
+def convert_json_tracks(json_path, path):
+    """
+    Convert a track file in the JSON format to the columnar format.
+
+    :param json_path: path to the JSON track file
+    :param path: directory to write the converted tracks to
+    """
+    with open(json_path) as f:
+        track_file = json.load(f)
+
+    resolution = track_file.get('video_resolution')
+    if resolution is not None:
+        resolution = resolution['height'], resolution['width']
+
+    tracks = [(track['name'], track['type'], to_array(track['type'], track['data']))
+              for track in track_file['tracks']]
+    write_tracks(path, tracks, resolution)
@@ -1,10 +1,11 @@
 import itertools
-from queue import Queue
+from collections import deque
 from typing import Tuple
 
 import numpy as np
 
-from processing.operation import Operation
+from processing.operation import Operation, Chunk, queue_list
+from processing.queues import Channel, make_queue, wait_any
 
 
 class Transformer(Operation):
@@ -12,6 +13,10 @@ class Transformer(Operation):
     Transformers apply a transformation to the input data and outputs
     the result. Although Python provides no way of ensuring this, all
     transformers should be pure functions.
+
+    Subclasses implement _transform (one output per input element) or
+    _expand (any number of outputs per input element). The run loop takes
+    care of reading the input, handling chunks and shutting down.
     """
 
     def __init__(self, input, output=None):
@@ -24,7 +29,7 @@ class Transformer(Operation):
         super().__init__()
         self._input = input
         if output is None:
-            self._output = Queue(1000)
+            self._output = make_queue()
         else:
             self._output = output
 
@@ -36,92 +41,378 @@ class Transformer(Operation):
     def output(self):
         return self._output
 
+    def _get(self):
+        """
+        Get the next element from the input. If the transformer has several
+        inputs, an element is taken from each of them and returned as a tuple,
+        or as a chunk of tuples if the inputs are chunked.
+
+        :return: The next element or None when all inputs are done
+        """
+        if not isinstance(self.input, tuple):
+            return self.input.get()
+        return self._combine(self._gather())
+
+    def _combine(self, elems):
+        """
+        Combine an item taken from each input into a single item, see _get.
+        """
+        done = sum(elem is None for elem in elems)
+        if done == len(elems):
+            return None
+        elif done > 0:
+            raise BlockingIOError('One input queue sent shutdown signal before the other')
+
+        chunked = sum(isinstance(elem, Chunk) for elem in elems)
+        if chunked == 0:
+            return elems
+        elif chunked < len(elems) or len(set(len(elem) for elem in elems)) > 1:
+            raise BlockingIOError('Input queues are not chunked in the same way')
+        return Chunk(zip(*elems))
+
+    def _gather(self):
+        """
+        Take an element from each input. Channels are read as soon as they
+        are ready instead of in order, so an input ending before the others
+        is noticed without waiting for all of them.
+        """
+        inputs = self.input
+        if not all(isinstance(input, Channel) for input in inputs):
+            return tuple(input.get() for input in inputs)
+
+        elems = [None]*len(inputs)
+        pending = set(range(len(inputs)))
+        ended = running = False
+        while pending:
+            ready = self._wait([inputs[i] for i in sorted(pending)])
+            for i in sorted(pending):
+                if inputs[i] in ready:
+                    elems[i] = inputs[i].get()
+                    pending.discard(i)
+                    ended |= elems[i] is None
+                    running |= elems[i] is not None
+
+            if ended and running:
+                raise BlockingIOError('One input queue sent shutdown signal before the other')
+        return tuple(elems)
+
+    def _wait(self, channels):
+        """
+        Wait until one of the input channels is ready, see wait_any. Kept as
+        a method so a Monitor can count the time spent here as waiting for input.
+        """
+        return wait_any(channels)
+
+    def _transform(self, elem):
+        """
+        Transform a single element. Transformers producing exactly one output
+        element per input element implement this.
+        """
+        raise NotImplementedError
+
+    def _expand(self, elem):
+        """
+        Transform a single element into any number of output elements.
+        Transformers that filter or generate elements implement this instead
+        of _transform.
+
+        :return: An iterable of output elements
+        """
+        return self._transform(elem),
+
+    def _expand_chunk(self, chunk):
+        """
+        Transform all elements of a chunk. Override this if a whole chunk can
+        be transformed more efficiently than element by element.
+
+        :return: A list of output elements
+        """
+        return [out for elem in chunk for out in self._expand(elem)]
+
+    def _process(self, item):
+        """
+        Process an input item, an element or a chunk. Transformers with several
+        outputs implement this to direct their output items.
+
+        :return: An iterable of (output index, output item) pairs
+        """
+        if isinstance(item, Chunk):
+            out = self._expand_chunk(item)
+            return ((0, Chunk(out)),) if out else ()
+        return ((0, out) for out in self._expand(item))
+
+    def run(self):
+        outputs = queue_list(self.output)
+        while True:
+            item = self._get()
+            if item is None:
+                for output in outputs:
+                    output.put(None)
+                return
+
+            for i, out in self._process(item):
+                outputs[i].put(out)
+
+    def iterate(self, *sources):
+        """
+        Transform in the calling thread instead of running the transformer as a thread.
+
+        :param sources: an iterable of input items for every input, e.g. the generators of other stages
+        :return: generator of the output items, or a tuple with a generator for every output
+            if the transformer has several. Reading one of them far ahead of the others
+            buffers the items of the others.
+        """
+        if len(sources) != len(queue_list(self.input)):
+            raise ValueError('Expected {} sources, got {}'.format(len(queue_list(self.input)), len(sources)))
+        iterators = [iter(source) for source in sources]
+
+        def pairs():
+            while True:
+                items = tuple(next(iterator, None) for iterator in iterators)
+                item = self._combine(items) if isinstance(self.input, tuple) else items[0]
+                if item is None:
+                    return
+                yield from self._process(item)
+
+        if not isinstance(self.output, (tuple, list)):
+            return (out for _, out in pairs())
+        return _demultiplex(pairs(), len(self.output))
+
+    def _feed(self, index, item):
+        """
+        Take an item from one of the inputs when running inline, see pipeline.run_inline.
+        Items of several inputs are held back until every input has one.
+
+        :return: the resulting (output index, output item) pairs, with None as item when an output ends
+        """
+        ended = [(i, None) for i in range(len(queue_list(self.output)))]
+        if not isinstance(self.input, tuple):
+            return ended if item is None else list(self._process(item))
+
+        if not hasattr(self, '_pending'):
+            self._pending = [deque() for _ in self.input]
+        self._pending[index].append(item)
+
+        out = []
+        while all(self._pending):
+            combined = self._combine(tuple(pending.popleft() for pending in self._pending))
+            if combined is None:
+                return out + ended
+            out += self._process(combined)
+        return out
+
+
+def _demultiplex(pairs, n):
+    """
+    Split an iterator of (index, item) pairs into an iterator per index.
+    """
+    buffers = [deque() for _ in range(n)]
+
+    def output(i):
+        while True:
+            while not buffers[i]:
+                try:
+                    j, item = next(pairs)
+                except StopIteration:
+                    return
+                buffers[j].append(item)
+            yield buffers[i].popleft()
+
+    return tuple(output(i) for i in range(n))
+
 
 class Zip(Transformer):
     """
     Equivalent to performing a zip operation on a sequence of iterables.
     """
     def __init__(self, *inputs):
-        super().__init__(inputs, Queue(1000))
+        super().__init__(inputs, make_queue())
+
+    def _transform(self, elem):
+        return elem
+
+
+def is_elementwise(operation):
+    """
+    :return: whether the operation is a transformer with a single input and output
+        that is driven by the standard run loop, i.e. whether it can be part of a Chain
+    """
+    return (isinstance(operation, Transformer) and type(operation).run is Transformer.run
+            and not isinstance(operation.input, (tuple, list))
+            and not isinstance(operation.output, (tuple, list)))
+
+
+class Chain(Transformer):
+    """
+    Runs a sequence of linked element-wise transformers in a single thread,
+    calling their per-element logic back to back. This saves a thread and
+    a queue hop per transformer, which dominates the cost of cheap steps.
+
+    The chain reads the input of the first transformer and writes the output
+    of the last one, the queues in between are left unused. The chained
+    transformers must not be started themselves.
+    """
+
+    def __init__(self, *transformers):
+        if not transformers:
+            raise ValueError('A chain needs at least one transformer')
+
+        stages = []
+        for transformer in transformers:
+            if not is_elementwise(transformer):
+                raise ValueError('{} can not be chained'.format(type(transformer).__name__))
+            stages += transformer.stages if isinstance(transformer, Chain) else [transformer]
+
+        for first, second in zip(transformers, transformers[1:]):
+            if second.input is not first.output:
+                raise ValueError('{} does not read the output of {}'.format(
+                    type(second).__name__, type(first).__name__))
+
+        super().__init__(stages[0].input, stages[-1].output)
+        self._stages = stages
+
+    @property
+    def stages(self):
+        return list(self._stages)
+
+    def _expand(self, elem):
+        elems = [elem]
+        for stage in self._stages:
+            elems = [out for elem in elems for out in stage._expand(elem)]
+        return elems
+
+    def _expand_chunk(self, chunk):
+        for stage in self._stages:
+            chunk = stage._expand_chunk(chunk)
+            if not chunk:
+                break
+        return chunk
+
+
+class Merge(Transformer):
+    """
+    Merges several inputs into one output, passing elements on in the order
+    they arrive instead of taking turns. The output ends when all inputs have.
+    The inputs must be Channels.
+    """
+    def __init__(self, *inputs):
+        super().__init__(inputs, make_queue())
 
     def run(self):
-        while True:
-            elems = [input.get() for input in self.input]
-            done = 0
-            for elem in elems:
+        inputs = list(self.input)
+        while inputs:
+            for input in self._wait(inputs):
+                elem = input.get()
                 if elem is None:
-                    done += 1
+                    inputs.remove(input)
+                else:
+                    self.output.put(elem)
+
+        self.output.put(None)
+
+    def iterate(self, *sources):
+        # Without threads there is no arrival order, the inputs take turns instead
+        iterators = [iter(source) for source in sources]
+        while iterators:
+            for iterator in list(iterators):
+                item = next(iterator, None)
+                if item is None:
+                    iterators.remove(iterator)
+                else:
+                    yield item
+
+    def _feed(self, index, item):
+        if not hasattr(self, '_ended'):
+            self._ended = set()
+        if item is not None:
+            return [(0, item)]
+
+        self._ended.add(index)
+        return [(0, None)] if len(self._ended) == len(self.input) else []
+
+
+def split_counts(split, n):
+    """
+    :param split: the percentages of a Split
+    :param n: number of input elements
+    :return: the number of elements a Split puts on each output from the first n input elements
+    """
+    bases = [0] + list(itertools.accumulate(split))[:-1]
+    return [(n // 100)*size + min(max(n % 100 - base, 0), size) for size, base in zip(split, bases)]
 
-            if len(elems) == done:
-                self.output.put(None)
-                return
-            elif done > 0:
-                raise BlockingIOError('One input queue sent shutdown signal before the other')
 
-            self.output.put(tuple(elems))
+def split_resume_point(split, counts):
+    """
+    Find where to continue an interrupted split from.
+
+    :param split: the percentages of a Split
+    :param counts: number of elements already handled of each output
+    :return: the largest number of input elements of which a Split puts no more than counts on each output
+    """
+    bases = [0] + list(itertools.accumulate(split))[:-1]
+    # The input index of the element after the last handled one, for every output
+    points = [(count // size)*100 + base + count % size
+              for size, base, count in zip(split, bases, counts) if size > 0]
+    return min(points) if points else 0
 
 
 class Split(Transformer):
 
-    def __init__(self, input, split: Tuple[int, ...]):
-        output = [Queue(1000) for _ in range(len(split))]
+    def __init__(self, input, split: Tuple[int, ...], start=0):
+        """
+        Distributes the input elements over the outputs by percentage.
+
+        :param input: the input queue
+        :param split: the percentage of the elements to put on each output
+        :param start: index of the first input element, to continue a split, see split_resume_point
+        """
+        output = [make_queue() for _ in range(len(split))]
         super().__init__(input, output)
-        self._splitting = list(zip(self.output, split, [0] + list(itertools.accumulate(split))[:-1]))
+        self._splitting = list(zip(split, [0] + list(itertools.accumulate(split))[:-1]))
+        self._i = start % 100
 
-    def run(self):
-        i = 0
-        while True:
-            elem = self.input.get()
-            if elem is None:
-                for out in self.output:
-                    out.put(None)
-                return
+    def _process(self, elem):
+        if isinstance(elem, Chunk):
+            parts = [Chunk() for _ in self.output]
+            for single in elem:
+                for part, (split_size, base) in zip(parts, self._splitting):
+                    if base <= self._i < base+split_size:
+                        part.append(single)
+                self._i = (self._i+1) % 100
 
-            for q, split_size, base in self._splitting:
-                if base <= i < base+split_size:
-                    q.put(elem)
+            return [(j, part) for j, part in enumerate(parts) if part]
 
-            i = (i+1) % 100
+        out = [(j, elem) for j, (split_size, base) in enumerate(self._splitting)
+               if base <= self._i < base+split_size]
+        self._i = (self._i+1) % 100
+        return out
 
 
 class ReshapeArray(Transformer):
 
     def __init__(self, input, new_shape):
-        super().__init__(input, output=Queue(1000))
+        super().__init__(input, output=make_queue())
         self._new_shape = new_shape
 
-    def run(self):
-        while True:
-            array = self.input.get(timeout=1)
-            if array is None:
-                self.output.put(None)
-                return
-            array = np.reshape(array, self._new_shape)
-            self.output.put(array)
+    def _transform(self, array):
+        return np.reshape(array, self._new_shape)
 
 
 class Duplicate(Transformer):
     """
     Duplicates every item from its input queue. This is useful if the
     output of another operation is going to be used in multiple places.
+    Chunks are passed on as they are.
     """
 
     def __init__(self, input, n=2):
-        super().__init__(input, [Queue(10000) for _ in range(n)])
+        super().__init__(input, [make_queue(maxsize=10000) for _ in range(n)])
 
     def nth(self, n):
         return self.output[n]
 
-    def run(self):
-        while True:
-            elem = self.input.get()
-            if elem is None:
-                for out in self.output:
-                    out.put(None)
-                return
-
-            for out in self.output:
-                out.put(elem)
+    def _process(self, elem):
+        return [(j, elem) for j in range(len(self.output))]
 
 
 class SplitPredicate(Transformer):
@@ -130,11 +421,14 @@ class SplitPredicate(Transformer):
     of evaluating a provided predicate on the input. The input elements themselves
     are tuples containing first the value to evaluate the predicate with and then the data
     itself.
+
+    If the value is an array, the input is treated as a batch: the predicate is evaluated
+    on the whole array and every item of the batch is directed separately.
     """
 
     def __init__(self, input, pred):
-        self._true_out = Queue(1000)
-        self._false_out = Queue(1000)
+        self._true_out = make_queue()
+        self._false_out = make_queue()
         super().__init__(input, (self._true_out, self._false_out))
         self._pred = pred
 
@@ -146,16 +440,25 @@ class SplitPredicate(Transformer):
     def negative(self):
         return self._false_out
 
-    def run(self):
-        while True:
-            elem = self.input.get(timeout=1)
-            if elem is None:
-                for out in self.output:
-                    out.put(None)
-                return
-
-            measure, item = elem
-            if self._pred(measure):
-                self.positive.put(item)
-            else:
-                self.negative.put(item)
\ No newline at end of file
+    def _route(self, elem):
+        """
+        :return: pairs of predicate result and item for the element
+        """
+        measure, item = elem
+        if isinstance(measure, np.ndarray):
+            return zip(self._pred(measure), item)
+        return (self._pred(measure), item),
+
+    def _process(self, elem):
+        if isinstance(elem, Chunk):
+            positive, negative = Chunk(), Chunk()
+            for single in elem:
+                for keep, item in self._route(single):
+                    if keep:
+                        positive.append(item)
+                    else:
+                        negative.append(item)
+
+            return [(j, part) for j, part in enumerate((positive, negative)) if part]
+
+        return [(0 if keep else 1, item) for keep, item in self._route(elem)]
@@ -1,10 +1,10 @@
 import math
-import random
-from queue import Queue
 
 import cv2 as cv
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 
+from processing.queues import make_queue
 from processing.transformers import Transformer
 
 
@@ -19,64 +19,239 @@ class ConvertColorSpace(Transformer):
         :param input: input queue
         :param opencv_converter_code: color convertion code for the OpenCV function cvtColor
         """
-        super().__init__(input, Queue(1000))
+        super().__init__(input, make_queue())
         self._code = opencv_converter_code
 
-    def run(self):
-        while True:
-            elem = self.input.get(timeout=1)
-            if elem is None:
-                self.output.put(None)
-                return
-            out = cv.cvtColor(elem, self._code)
-            self.output.put(out)
+    def _transform(self, elem):
+        return cv.cvtColor(elem, self._code)
 
 
 class Resize(Transformer):
 
     def __init__(self, input, new_size):
-        super().__init__(input, Queue(1000))
+        super().__init__(input, make_queue())
         self._new_size = new_size
 
-    def run(self):
-        while True:
-            elem = self.input.get()
-            if elem is None:
-                self.output.put(None)
-                return
+    def _transform(self, elem):
+        return cv.resize(elem, self._new_size)
 
-            out = cv.resize(elem, self._new_size)
-            self.output.put(out)
+
+class Preprocess(Transformer):
+    """
+    Crops, resizes, converts the color space of and normalizes images in a
+    single stage, instead of a thread and a queue for every step. The
+    intermediate results are written to buffers reused for every image, and
+    the images of a chunk are written into a single preallocated array.
+
+    Usage, e.g. to feed a network trained on RGB images in [0, 1]:
+        Preprocess(loader.output, size=(224, 224), color=cv.COLOR_BGR2RGB, mean=0, std=255)
+    """
+
+    def __init__(self, input, size=None, interpolation=cv.INTER_LINEAR, color=None, dtype=None, mean=None, std=None,
+                 crop=None):
+        """
+        :param input: input queue of images
+        :param size: (width, height) to resize the images to, like Resize
+        :param interpolation: OpenCV interpolation flag used when resizing
+        :param color: OpenCV color conversion code, like ConvertColorSpace
+        :param dtype: dtype of the output, float32 when normalizing and the dtype of the input otherwise
+        :param mean: subtracted from the images, a scalar or a value per channel of the converted images
+        :param std: the images are divided by this after subtracting the mean, a scalar or a value per channel
+        :param crop: (y, x, height, width) of the part of the images to use, cropped before anything else
+        """
+        super().__init__(input, make_queue())
+        self._size = tuple(size) if size is not None else None
+        self._interpolation = interpolation
+        self._color = color
+        self._crop = crop
+        self._normalize = mean is not None or std is not None
+        self._mean = np.asarray(0.0 if mean is None else mean, dtype=np.float32)
+        self._scale = 1/np.asarray(1.0 if std is None else std, dtype=np.float32)
+        if dtype is None and self._normalize:
+            dtype = np.float32
+        self._dtype = np.dtype(dtype) if dtype is not None else None
+        self._scratch = {}
+
+    def _into(self, name, fn, src, *args, **kwargs):
+        # OpenCV writes into dst if it has the right layout and allocates a new array otherwise,
+        # which is then kept for the next image
+        out = fn(src, *args, dst=self._scratch.get(name), **kwargs)
+        self._scratch[name] = out
+        return out
+
+    def _convert(self, image):
+        """
+        Apply the crop, resize and color conversion.
+
+        :return: the result, which may be a view of the input or a reused buffer
+        """
+        if self._crop is not None:
+            y, x, height, width = self._crop
+            image = image[y:y+height, x:x+width]
+        if self._size is not None:
+            image = self._into('resize', cv.resize, image, self._size, interpolation=self._interpolation)
+        if self._color is not None:
+            image = self._into('color', cv.cvtColor, image, self._color)
+        return image
+
+    def _store(self, image, out):
+        """
+        Normalize the converted image into the output array.
+        """
+        if not self._normalize:
+            out[...] = image
+        elif np.issubdtype(out.dtype, np.floating):
+            np.subtract(image, self._mean, out=out, casting='unsafe')
+            np.multiply(out, self._scale, out=out, casting='unsafe')
+        else:
+            normalized = self._scratch.get('normalize')
+            if normalized is None or normalized.shape != image.shape:
+                normalized = self._scratch['normalize'] = np.empty(image.shape, dtype=np.float32)
+            np.subtract(image, self._mean, out=normalized, casting='unsafe')
+            np.multiply(normalized, self._scale, out=normalized)
+            out[...] = normalized
+
+    def _transform(self, elem):
+        image = self._convert(elem)
+        out = np.empty(image.shape, dtype=self._dtype or image.dtype)
+        self._store(image, out)
+        return out
+
+    def _expand_chunk(self, chunk):
+        if not chunk:
+            return []
+
+        # The first image decides the layout of the batch
+        first = self._convert(chunk[0])
+        batch = np.empty((len(chunk),) + first.shape, dtype=self._dtype or first.dtype)
+        self._store(first, batch[0])
+
+        for i, elem in enumerate(chunk[1:], 1):
+            image = self._convert(elem)
+            if image.shape != first.shape:
+                # Images of different sizes can't share a batch
+                return list(batch[:i]) + [self._transform(elem) for elem in chunk[i:]]
+            self._store(image, batch[i])
+        return list(batch)
 
 
 class PositionMapGenerator(Transformer):
 
-    def __init__(self, input, size, scaling):
-        super().__init__(input, Queue(1000))
+    def __init__(self, input, size, scaling, mode='dense', dtype=np.float64, sigma=1.0):
+        """
+        Generates a map of the center positions of the tracked regions of every frame.
+
+        :param input: input queue of track elements
+        :param size: (height, width) of the maps
+        :param scaling: scaling from track coordinates to map coordinates
+        :param mode: 'dense' for maps with the pixels at the positions set to one, 'sparse' for
+            an int32 array of shape (N, 2) with the (y, x) pixel of every position instead of
+            a map, or 'heatmap' for maps with a gaussian at every position
+        :param dtype: dtype of the maps, heatmaps are scaled to the range of integer dtypes
+            and thresholded at one half for bool
+        :param sigma: standard deviation in pixels of the gaussians of heatmaps
+        """
+        if mode not in ('dense', 'sparse', 'heatmap'):
+            raise ValueError('Unknown position map mode: {}'.format(mode))
+
+        super().__init__(input, make_queue())
         self._size = size
         self._scaling = scaling
+        self._mode = mode
+        self._dtype = np.dtype(dtype)
+        self._sigma = sigma
 
-    def run(self):
-        while True:
-            elem = self.input.get(timeout=1)
-            if elem is None:
-                self.output.put(None)
-                return
+    def _centers(self, elem):
+        """
+        :return: the map coordinates of the centers of the regions, as an array of shape (N, 2)
+        """
+        return np.array([((data['y']+data['height']/2)*self._scaling[0], (data['x']+data['width']/2)*self._scaling[1])
+                         for _, data in elem], dtype=np.float64).reshape(-1, 2)
 
-            map = np.zeros(self._size, dtype=np.float64)
+    def _pixels(self, centers):
+        """
+        :return: the pixels of the centers that are within the map
+        """
+        pixels = centers.astype(np.int32)
+        inside = np.all((centers >= 0) & (pixels < self._size[:2]), axis=1)
+        return pixels[inside]
 
-            for _, data in elem:
-                y, x = (data['y']+data['height']/2)*self._scaling[0], (data['x']+data['width']/2)*self._scaling[1]
-                map[int(y), int(x)] = 1
+    def _heatmaps(self, centers):
+        """
+        Splat gaussians for a batch of frames at once. Frames with fewer
+        positions are padded with positions that contribute nothing.
 
-            self.output.put(map)
+        :param centers: list of arrays of shape (N, 2), one for every frame
+        :return: heatmaps of shape (frames, height, width)
+        """
+        n = max([len(c) for c in centers] + [1])
+        padded = np.full((len(centers), n, 2), np.nan)
+        for frame, c in zip(padded, centers):
+            frame[:len(c)] = c
+
+        # The gaussians are separable, so every position only needs a row and a column profile.
+        # Positions are splatted one at a time to only ever hold a map per frame.
+        scale = np.float32(-0.5/self._sigma**2)
+        y, x = np.arange(self._size[0], dtype=np.float32), np.arange(self._size[1], dtype=np.float32)
+        maps = np.zeros((len(centers),) + tuple(self._size[:2]), dtype=np.float32)
+        splat = np.empty_like(maps)
+        for position in padded.astype(np.float32).transpose(1, 0, 2):
+            rows = np.nan_to_num(np.exp(scale*(y - position[:, 0, None])**2))
+            cols = np.nan_to_num(np.exp(scale*(x - position[:, 1, None])**2))
+            np.multiply(rows[:, :, None], cols[:, None, :], out=splat)
+            np.maximum(maps, splat, out=maps)
+
+        if self._dtype == np.bool_:
+            return maps >= 0.5
+        elif np.issubdtype(self._dtype, np.integer):
+            return np.round(maps*np.iinfo(self._dtype).max).astype(self._dtype)
+        return maps.astype(self._dtype)
+
+    def _transform(self, elem):
+        centers = self._centers(elem)
+
+        if self._mode == 'heatmap':
+            return self._heatmaps([centers])[0]
+
+        pixels = self._pixels(centers)
+        if self._mode == 'sparse':
+            return pixels
+
+        map = np.zeros(self._size, dtype=self._dtype)
+        map[pixels[:, 0], pixels[:, 1]] = 1
+        return map
+
+    def _expand_chunk(self, chunk):
+        if self._mode != 'heatmap':
+            return super()._expand_chunk(chunk)
+        return list(self._heatmaps([self._centers(elem) for elem in chunk]))
 
 
 class RegionExtractor(Transformer):
 
-    def __init__(self, image_input, regions_input, padding=0):
-        super().__init__((image_input, regions_input), Queue(1000))
+    def __init__(self, image_input, regions_input, padding=0, size=None, box=None, interpolation=cv.INTER_AREA):
+        """
+        Crops the tracked regions out of every image.
+
+        Without a size, a list of ((y, x), crop) tuples is put for every image, with crops
+        of the size of their region. With a size, the crops are resized to it and put as
+        a single (boxes, crops) element, where boxes has shape (N, 4) with the y, x, height
+        and width of the region in the image, and crops has shape (N, height, width, channels).
+        Regions are clipped to the image, a region outside it gives an empty box and a black crop.
+
+        :param image_input: input queue of images
+        :param regions_input: input queue of the track elements of every image, of type
+            rectangle_region, inscribed_circle (the bounding box of the circle is cropped) or point
+        :param padding: number of pixels to grow the regions by on every side
+        :param size: (width, height) to resize the crops to
+        :param box: (width, height) of the region cropped around point tracks
+        :param interpolation: OpenCV interpolation flag used when resizing the crops
+        """
+        super().__init__((image_input, regions_input), make_queue())
         self._padding = padding
+        self._size = size
+        self._box = box
+        self._interpolation = interpolation
 
     @property
     def image_input(self):
@@ -86,40 +261,82 @@ class RegionExtractor(Transformer):
     def regions_input(self):
         return self.input[1]
 
-    def run(self):
-        while True:
-            image = self.image_input.get(timeout=1)
-            regions = self.regions_input.get(timeout=1)
-            if image is None and regions is None:
-                self.output.put(None)
-                return
-            elif image is None or regions is None:
-                raise BlockingIOError('One input queue sent shutdown signal before the other')
+    def _region(self, type, data):
+        """
+        :return: y, x, height, width of the region of a track element
+        """
+        if type == 'rectangle_region':
+            y, x = int(data['y']), int(data['x'])
+            height, width = int(data['height'])+1, int(data['width'])+1
+        elif type == 'inscribed_circle':
+            height, width = int(data['height'])+1, int(data['width'])+1
+            y, x = int(data['cy'] - data['height']/2), int(data['cx'] - data['width']/2)
+        elif type == 'point':
+            if self._box is None:
+                raise ValueError('RegionExtractor needs a box size to crop around point tracks')
+            width, height = self._box
+            y, x = int(data['y']) - height//2, int(data['x']) - width//2
+        else:
+            raise ValueError('Unexpected track type! RegionExtractor can only handle regions of type: '
+                             'rectangle_region, inscribed_circle and point')
+
+        p = self._padding
+        return y-p, x-p, height+2*p, width+2*p
+
+    def _clipped_boxes(self, shape, regions):
+        """
+        :return: the regions clipped to the image, as an array of shape (N, 4)
+        """
+        boxes = np.array([self._region(type, data) for type, data in regions], dtype=np.int32).reshape(-1, 4)
+        top = np.clip(boxes[:, :2], 0, shape[:2])
+        bottom = np.clip(boxes[:, :2] + boxes[:, 2:], 0, shape[:2])
+        return np.concatenate([top, np.maximum(bottom - top, 0)], axis=1)
+
+    def _crop_batch(self, image, regions):
+        boxes = self._clipped_boxes(image.shape, regions)
+        crops = np.zeros((len(boxes), self._size[1], self._size[0]) + image.shape[2:], dtype=image.dtype)
+        for (y, x, height, width), dst in zip(boxes, crops):
+            if height == 0 or width == 0:
+                continue
+            # cv.resize drops single channel axes, which the reshape restores
+            resized = cv.resize(image[y:y+height, x:x+width], tuple(self._size), interpolation=self._interpolation)
+            dst[...] = resized.reshape(dst.shape)
+        return boxes, crops
 
-            out = []
-            for type, data in regions:
-                if type != 'rectangle_region':
-                    raise ValueError('Unexpected track type! RegionExtractor can only handle regions of type: '
-                                     'rectangle_region')
+    def _transform(self, elem):
+        image, regions = elem
 
-                y = int(data['y'])
-                x = int(data['x'])
-                height = int(data['height'])
-                width = int(data['width'])
+        if self._size is not None:
+            return self._crop_batch(image, regions)
 
-                window = image[y:y+height+1, x:x+width+1]
-                out.append(((y, x), window))
+        out = []
+        for y, x, height, width in self._clipped_boxes(image.shape, regions):
+            out.append(((int(y), int(x)), image[y:y+height, x:x+width]))
 
-            self.output.put(out)
+        return out
 
 
 class RandomNegativeWindowGenerator(Transformer):
 
-    def __init__(self, image_input, centers_input, window_size, positive_radius, n):
-        super().__init__((image_input, centers_input), Queue(1000))
+    def __init__(self, image_input, centers_input, window_size, positive_radius, n, seed=None, vectorized=False):
+        """
+        Samples windows at random positions of every image, away from the positive centers.
+
+        :param image_input: input queue of images
+        :param centers_input: input queue of the (y, x) centers of every image, (0, 0) centers are ignored
+        :param window_size: (height, width) of the windows
+        :param positive_radius: windows with their center within this distance of a center on both axes are not sampled
+        :param n: number of windows to sample from every image
+        :param seed: seed of the random positions, for reproducible samples
+        :param vectorized: if True, the windows of an image are put as a single element of
+            shape (n, height, width, channels). Otherwise each window is put as a separate element.
+        """
+        super().__init__((image_input, centers_input), make_queue())
         self._window_size = window_size
         self._positive_radius = positive_radius
         self._n = n
+        self._rng = np.random.default_rng(seed)
+        self._vectorized = vectorized
 
     @property
     def image_input(self):
@@ -129,48 +346,83 @@ class RandomNegativeWindowGenerator(Transformer):
     def centers_input(self):
         return self.input[1]
 
-    def run(self):
-        while True:
-            image = self.image_input.get()
-            centers = self.centers_input.get()
-            if image is None and centers is None:
-                self.output.put(None)
-                return
-            elif image is None or centers is None:
-                raise BlockingIOError('One input queue sent shutdown signal before the other')
-
-            current = 0
-            while current < self._n:
-                # Find random window coordinates
-                y = random.randint(0, image.shape[0]-self._window_size[0])
-                x = random.randint(0, image.shape[1]-self._window_size[1])
-
-                # Get center coordinates
-                cy = y + self._window_size[0]//2
-                cx = x + self._window_size[1]//2
-
-                # Check for overlap with positive centers
-                is_negative = True
-                for tcy, tcx in centers:
-                    if tcy == 0 and tcx == 0:
-                        continue
-                    if abs(tcy-cy) <= self._positive_radius and abs(tcx-cx) <= self._positive_radius:
-                        is_negative = False
-
-                if is_negative:
-                    # Create window slice
-                    out = image[y:y+self._window_size[0], x:x+self._window_size[1]]
-                    self.output.put(out)
-                    current += 1
+    def _valid_positions(self, shape, centers):
+        """
+        :return: mask of the window positions, indexed by the top left corner,
+            with their center further than the radius from every center
+        """
+        height, width = shape[0]-self._window_size[0]+1, shape[1]-self._window_size[1]+1
+        centers = np.asarray(centers, dtype=np.float64).reshape(-1, 2)
+        centers = centers[np.any(centers != 0, axis=1)]
+
+        cy = np.arange(height) + self._window_size[0]//2
+        cx = np.arange(width) + self._window_size[1]//2
+        near_y = np.abs(cy[:, None] - centers[None, :, 0]) <= self._positive_radius
+        near_x = np.abs(cx[:, None] - centers[None, :, 1]) <= self._positive_radius
+
+        # A position is near a center if it is near on both axes, counted for all centers at once
+        near = near_y.astype(np.int32) @ near_x.T.astype(np.int32)
+        return near == 0
+
+    def _sample(self, image, centers):
+        """
+        :return: the sampled windows, of shape (n, height, width, channels)
+        """
+        if image.shape[0] < self._window_size[0] or image.shape[1] < self._window_size[1]:
+            raise ValueError('Window is larger than the image')
+
+        valid = np.flatnonzero(self._valid_positions(image.shape, centers))
+        if len(valid) == 0:
+            raise ValueError('No window position is outside the radius of every center')
+
+        positions = self._rng.choice(valid, self._n)
+        ys, xs = np.unravel_index(positions, (image.shape[0]-self._window_size[0]+1,
+                                              image.shape[1]-self._window_size[1]+1))
+
+        view = sliding_window_view(image, self._window_size, axis=(0, 1))
+        if image.ndim == 3:
+            view = np.moveaxis(view, 2, -1)
+        return view[ys, xs]
+
+    def _expand(self, elem):
+        image, centers = elem
+        windows = self._sample(image, centers)
+        if self._vectorized:
+            return windows,
+        return iter(windows)
 
 
 class PositiveWindowGenerator(Transformer):
 
-    def __init__(self, image_input, centers_input, window_size, radius, max_n=None):
-        super().__init__((image_input, centers_input), Queue(1000))
+    def __init__(self, image_input, centers_input, window_size, radius, max_n=None, border='raise', seed=None,
+                 vectorized=False):
+        """
+        Crops windows around every center of an image, jittered by every offset within the radius.
+
+        :param image_input: input queue of images
+        :param centers_input: input queue of the (y, x) centers of every image, (0, 0) centers are ignored
+        :param window_size: (height, width) of the windows
+        :param radius: maximum offset of the windows from the center on both axes
+        :param max_n: if set, at most this many random offsets are used per center
+        :param border: what to do with windows reaching outside the image: 'raise' an error,
+            'clamp' them to the image or 'skip' them
+        :param seed: seed of the random offsets when max_n is set, for reproducible samples
+        :param vectorized: if True, the windows of a center are put as a single element of
+            shape (N, height, width, channels). Otherwise each window is put as a separate element.
+        """
+        if border not in ('raise', 'clamp', 'skip'):
+            raise ValueError('Unknown border handling: {}'.format(border))
+
+        super().__init__((image_input, centers_input), make_queue())
         self._window_size = window_size
         self._radius = radius
         self._max_n = max_n
+        self._border = border
+        self._rng = np.random.default_rng(seed)
+        self._vectorized = vectorized
+
+        dy, dx = np.mgrid[-radius:radius+1, -radius:radius+1]
+        self._offsets = dy.ravel(), dx.ravel()
 
     @property
     def image_input(self):
@@ -180,58 +432,81 @@ class PositiveWindowGenerator(Transformer):
     def centers_input(self):
         return self.input[1]
 
-    def run(self):
-        i=0
-        while True:
-            image = self.image_input.get(timeout=5)
-            centers = self.centers_input.get(timeout=5)
-
-            if image is None and centers is None:
-                self.output.put(None)
-                return
-            elif image is None or centers is None:
-                print(i)
-                raise BlockingIOError('One input queue sent shutdown signal before the other. Maybe the lengths of '
-                                      'the inputs don\'t match?')
-            i+=1
-            for tcy, tcx in centers:
-                if tcy == 0 and tcx == 0:
-                    continue
-
-                if tcy - self._radius - self._window_size[0]/2 < 0 \
-                        or tcy + self._radius + self._window_size[0]/2 > image.shape[0] \
-                        or tcx - self._radius + self._window_size[1]/2 < 0 \
-                        or tcx + self._radius + self._window_size[1]/2 > image.shape[1]:
-                    #print(tcy+self._radius+self._window_size[0]/2, tcx+self._radius+self._window_size[1]/2)
-                    raise ValueError('Selected features and radius results in window moving outside image boundaries!')
-
-                tcy = int(tcy)-self._window_size[0]//2
-                tcx = int(tcx)-self._window_size[0]//2
-                outlist = []
-                for y in range(tcy-self._radius, tcy+self._radius+1):
-                    for x in range(tcx-self._radius, tcx+self._radius+1):
-                        out = image[y:y+self._window_size[0], x:x+self._window_size[1]]
-                        outlist.append(out)
-
-                if self._max_n is not None:
-                    random.shuffle(outlist)
-                    if self._max_n < len(outlist):
-                        outlist = outlist[:self._max_n]
-
-                for out in outlist:
-                    self.output.put(out)
+    def _positions(self, shape, center):
+        """
+        :return: the top left corners of the windows around the center, as arrays of y and x
+        """
+        max_y, max_x = shape[0]-self._window_size[0], shape[1]-self._window_size[1]
+        ys = int(center[0]) - self._window_size[0]//2 + self._offsets[0]
+        xs = int(center[1]) - self._window_size[1]//2 + self._offsets[1]
+
+        inside = (ys >= 0) & (ys <= max_y) & (xs >= 0) & (xs <= max_x)
+        if not inside.all():
+            if self._border == 'raise' or max_y < 0 or max_x < 0:
+                raise ValueError('Selected features and radius results in window moving outside image boundaries!')
+            elif self._border == 'clamp':
+                ys, xs = np.clip(ys, 0, max_y), np.clip(xs, 0, max_x)
+            else:
+                ys, xs = ys[inside], xs[inside]
+
+        # Offsets are subsampled before cropping, so only the selected windows are created
+        if self._max_n is not None:
+            selected = self._rng.choice(len(ys), min(self._max_n, len(ys)), replace=False)
+            ys, xs = ys[selected], xs[selected]
+        return ys, xs
+
+    def _expand(self, elem):
+        image, centers = elem
+
+        # An image smaller than the windows has no windows, _positions tells why
+        view = None
+        if image.shape[0] >= self._window_size[0] and image.shape[1] >= self._window_size[1]:
+            view = sliding_window_view(image, self._window_size, axis=(0, 1))
+            if image.ndim == 3:
+                view = np.moveaxis(view, 2, -1)
+
+        for center in centers:
+            if center[0] == 0 and center[1] == 0:
+                continue
+
+            ys, xs = self._positions(image.shape, center)
+            if len(ys) == 0:
+                continue
+
+            windows = view[ys, xs]
+            if self._vectorized:
+                yield windows
+            else:
+                yield from windows
 
 
 class WindowGenerator(Transformer):
 
-    def __init__(self, video_input, track_input, window_size, scaling, stride=1, radius=None):
-        super().__init__((video_input, track_input), Queue(1000))
+    def __init__(self, video_input, track_input, window_size, scaling, stride=1, radius=None, vectorized=False):
+        """
+        Generates windows around the tracked position of every frame together with
+        the distance from each window center to the tracked position.
+
+        :param video_input: input queue of frames
+        :param track_input: input queue of track rows
+        :param window_size: size that all windows are resized to
+        :param scaling: scaling from track coordinates to frame coordinates
+        :param stride: step between neighbouring windows
+        :param radius: only generate windows within this radius of the tracked position
+        :param vectorized: if True, all windows of a frame are generated at once and
+            put as a single (distances, windows) element, where distances has shape (N,)
+            and windows has shape (N, height, width, channels). Otherwise each window is
+            put as a separate (distance, window) element. Like cv.resize, both drop the
+            channel axis of single channel frames.
+        """
+        super().__init__((video_input, track_input), make_queue())
         self._video_input = video_input
         self._track_input = track_input
         self._window_size = window_size
         self._stride = stride
         self._radius = radius
         self._scaling = scaling
+        self._vectorized = vectorized
 
     def _get_window_config(self, type, data):
         """
@@ -253,33 +528,77 @@ class WindowGenerator(Transformer):
 
         return region_size, pos
 
-    def run(self):
-        while True:
-            vid_elem = self._video_input.get(timeout=1)
-            track_elem = self._track_input.get(timeout=1)
-
-            if vid_elem is None and track_elem is None:
-                self.output.put(None)
-                return
-            type, data = track_elem[0]  # only use first element of tracks (TODO: maybe error handling?)
-
-            region_size, pos = self._get_window_config(type, data)
-            # Check image boundaries
-            if self._radius:
-                min_y = max(0, pos[0] - self._radius - region_size[0]//2)
-                min_x = max(0, pos[1] - self._radius - region_size[1]//2)
-                max_y = min(vid_elem.shape[0] - region_size[0], pos[0] + self._radius - region_size[0]//2)
-                max_x = min(vid_elem.shape[1] - region_size[1], pos[1] + self._radius - region_size[1]//2)
-            else:
-                min_y, min_x = 0, 0
-                max_y, max_x = vid_elem.shape[0] - region_size[0], vid_elem.shape[1] - region_size[1]
-
-            # Create windows
-            for y in range(int(min_y), int(max_y), self._stride):
-                for x in range(int(min_x), int(max_x), self._stride):
-                    window = np.array(vid_elem[y:y+region_size[0], x:x+region_size[1], :])
-                    cy, cx = y+region_size[0]//2, x+region_size[1]//2
-                    dist = math.sqrt((pos[0]-cy)**2 + (pos[1]-cx)**2)
-
-                    window = cv.resize(window, self._window_size)
-                    self.output.put((dist, window), timeout=1)
\ No newline at end of file
+    def _window_bounds(self, frame, region_size, pos):
+        if self._radius:
+            min_y = max(0, pos[0] - self._radius - region_size[0]//2)
+            min_x = max(0, pos[1] - self._radius - region_size[1]//2)
+            max_y = min(frame.shape[0] - region_size[0], pos[0] + self._radius - region_size[0]//2)
+            max_x = min(frame.shape[1] - region_size[1], pos[1] + self._radius - region_size[1]//2)
+        else:
+            min_y, min_x = 0, 0
+            max_y, max_x = frame.shape[0] - region_size[0], frame.shape[1] - region_size[1]
+
+        return int(min_y), int(min_x), int(max_y), int(max_x)
+
+    def _windows(self, frame, region_size, pos):
+        """
+        Create every window of the frame separately.
+        """
+        min_y, min_x, max_y, max_x = self._window_bounds(frame, region_size, pos)
+
+        for y in range(min_y, max_y, self._stride):
+            for x in range(min_x, max_x, self._stride):
+                window = np.array(frame[y:y+region_size[0], x:x+region_size[1], :])
+                cy, cx = y+region_size[0]//2, x+region_size[1]//2
+                dist = math.sqrt((pos[0]-cy)**2 + (pos[1]-cx)**2)
+
+                window = cv.resize(window, self._window_size)
+                yield dist, window
+
+    def _window_batch(self, frame, region_size, pos):
+        """
+        Create all windows of the frame at once from a strided view of the frame.
+
+        :return: distances of shape (N,), windows of shape (N, height, width, channels)
+        """
+        min_y, min_x, max_y, max_x = self._window_bounds(frame, region_size, pos)
+        ys = np.arange(min_y, max_y, self._stride)
+        xs = np.arange(min_x, max_x, self._stride)
+
+        channels = frame.shape[2:] if frame.shape[2:] != (1,) else ()
+        shape = (self._window_size[1], self._window_size[0]) + channels
+        # sliding_window_view can't make windows larger than the frame, which have no positions anyway
+        if len(ys) == 0 or len(xs) == 0:
+            return np.empty(0), np.empty((0,) + shape, dtype=frame.dtype)
+
+        cy = ys + region_size[0]//2
+        cx = xs + region_size[1]//2
+        dists = np.sqrt((pos[0]-cy[:, None])**2 + (pos[1]-cx[None, :])**2).ravel()
+
+        # Window axes are appended last by sliding_window_view, so move the channels back to the end
+        view = sliding_window_view(frame, region_size, axis=(0, 1))
+        if frame.ndim == 3:
+            view = np.moveaxis(view, 2, -1)
+        view = view[min_y:max(min_y, max_y):self._stride, min_x:max(min_x, max_x):self._stride]
+        n = view.shape[0]*view.shape[1]
+
+        # cv.resize takes (width, height), so an equal size means the windows are used unchanged.
+        # Flattening the strided view is then the only copy of the windows.
+        if tuple(self._window_size) == (region_size[1], region_size[0]):
+            return dists, view.reshape((n,) + shape)
+
+        out = np.empty((n,) + shape, dtype=frame.dtype)
+        windows = (view[y, x] for y in range(view.shape[0]) for x in range(view.shape[1]))
+        for window, dst in zip(windows, out):
+            cv.resize(window, self._window_size, dst=dst)
+        return dists, out
+
+    def _expand(self, elem):
+        vid_elem, track_elem = elem
+        type, data = track_elem[0]  # only use first element of tracks (TODO: maybe error handling?)
+
+        region_size, pos = self._get_window_config(type, data)
+
+        if self._vectorized:
+            return self._window_batch(vid_elem, region_size, pos),
+        return self._windows(vid_elem, region_size, pos)
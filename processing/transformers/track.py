@@ -1,15 +1,25 @@
-from queue import Queue
+import numpy as np
 
+from processing.queues import make_queue
 from processing.transformers import Transformer
+from processing.tracks import track_fields, track_dtype
+
+
+def _is_block(data):
+    """
+    Track data is either a dict for a single row or a structured array holding a block of rows.
+    """
+    return isinstance(data, np.ndarray)
 
 
 class DiscardEmpty(Transformer):
     """
     Discards rows of tracks with empty elements. Removing just empty elements would be better,
     but because track elements are put through the pipeline row by row, this is the best solution.
+    Blocks of rows are filtered as a whole.
     """
     def __init__(self, input):
-        super().__init__(input, Queue(1000))
+        super().__init__(input, make_queue())
 
     def _iszero(self, data):
         for val in data.values():
@@ -17,20 +27,25 @@ class DiscardEmpty(Transformer):
                 return False
         return True
 
-    def run(self):
-        while True:
-            elem = self.input.get()
-            if elem is None:
-                self.output.put(None)
-                return
+    @staticmethod
+    def _nonzero_rows(type, data):
+        return np.any([data[field] != 0 for field in track_fields(type)], axis=0)
+
+    def _expand(self, elem):
+        if elem and _is_block(elem[0][1]):
+            keep = np.all([self._nonzero_rows(track[0], track[1]) for track in elem], axis=0)
+            if not keep.any():
+                return ()
+            return [(track[0], track[1][keep]) + tuple(track[2:]) for track in elem],
 
-            if not self._iszero(elem[1]):
-                self.output.put(elem)
+        if any(self._iszero(track[1]) for track in elem):
+            return ()
+        return elem,
 
 
 class Translate(Transformer):
     def __init__(self, input, translation):
-        super().__init__(input, Queue(1000))
+        super().__init__(input, make_queue())
         self._translation = translation
 
     @property
@@ -38,6 +53,9 @@ class Translate(Transformer):
         return self._translation
 
     def _translate(self, type, data):
+        if _is_block(data):
+            return self._translate_block(type, data)
+
         if type == 'point':
             res = {
                 'x': data['x']+self.translation[1],
@@ -62,21 +80,26 @@ class Translate(Transformer):
             raise ValueError('Unknown track type: {}'.format(type))
         return type, res
 
-    def run(self):
-        while True:
-            elem = self.input.get(timeout=1)
-            if elem is None:
-                self.output.put(None)
-                return
+    def _translate_block(self, type, data):
+        res = np.array(data, dtype=track_dtype(type))
+        if type in ('point', 'rectangle_region'):
+            res['x'] += self.translation[1]
+            res['y'] += self.translation[0]
+        elif type == 'inscribed_circle':
+            res['cx'] += self.translation[1]
+            res['cy'] += self.translation[0]
+        else:
+            raise ValueError('Unknown track type: {}'.format(type))
+        return type, res
 
-            out = [self._translate(type, data) for type, data in elem]
-            self.output.put(out)
+    def _transform(self, elem):
+        return [self._translate(type, data) for type, data in elem]
 
 
 class Scale(Transformer):
 
     def __init__(self, input, scale):
-        super().__init__(input, Queue(1000))
+        super().__init__(input, make_queue())
         self._scale = scale
 
     @property
@@ -84,6 +107,9 @@ class Scale(Transformer):
         return self._scale
 
     def _rescale(self, type, data):
+        if _is_block(data):
+            return self._rescale_block(type, data)
+
         if type == 'point':
             res = {
                 'x': data['x']*self.scale,
@@ -108,24 +134,27 @@ class Scale(Transformer):
             raise ValueError('Unknown track type: {}'.format(type))
         return type, res
 
-    def run(self):
-        while True:
-            elem = self.input.get(timeout=5)
-            if elem is None:
-                self.output.put(None)
-                return
+    def _rescale_block(self, type, data):
+        res = np.array(data, dtype=track_dtype(type))
+        for field in track_fields(type):
+            if field != 'angle':
+                res[field] *= self.scale
+        return type, res
 
-            out = [self._rescale(type, data) for type, data in elem]
-            self.output.put(out)
+    def _transform(self, elem):
+        return [self._rescale(type, data) for type, data in elem]
 
 
 class CenterExtractor(Transformer):
 
     def __init__(self, input):
-        super().__init__(input, Queue(1000))
+        super().__init__(input, make_queue())
 
     @staticmethod
     def _track_center(type, data):
+        if _is_block(data):
+            return CenterExtractor._track_center_block(type, data)
+
         if type == 'point':
             return data['y'], data['x']
         elif type == 'inscribed_circle':
@@ -135,23 +164,34 @@ class CenterExtractor(Transformer):
         else:
             raise ValueError('Unknown track type: {}'.format(type))
 
-    def run(self):
-        while True:
-            elem = self.input.get(timeout=5)
-            if elem is None:
-                self.output.put(None)
-                return
+    @staticmethod
+    def _track_center_block(type, data):
+        """
+        :return: array of shape (N, 2) with the (y, x) center of each row
+        """
+        if type == 'point':
+            return np.stack((data['y'], data['x']), axis=1)
+        elif type == 'inscribed_circle':
+            return np.stack((data['cy'], data['cx']), axis=1)
+        elif type == 'rectangle_region':
+            return np.stack((data['y']+data['height']/2, data['x']+data['width']/2), axis=1)
+        else:
+            raise ValueError('Unknown track type: {}'.format(type))
 
-            out = [self._track_center(type, data) for type, data in elem]
-            self.output.put(out)
+    def _transform(self, elem):
+        return [self._track_center(type, data) for type, data in elem]
 
 
 class RoundToInt(Transformer):
     def __init__(self, input):
-        super().__init__(input, Queue(1000))
+        super().__init__(input, make_queue())
 
     @staticmethod
     def _rounded(type, data):
+        if _is_block(data):
+            # Casting to integers truncates towards zero like int()
+            return type, data.astype(track_dtype(type, np.int64))
+
         if type == 'point':
             res = {
                 'x': int(data['x']),
@@ -176,12 +216,5 @@ class RoundToInt(Transformer):
             raise ValueError('Unknown track type: {}'.format(type))
         return type, res
 
-    def run(self):
-        while True:
-            elem = self.input.get(timeout=5)
-            if elem is None:
-                self.output.put(None)
-                return
-
-            out = [self._rounded(type, data) for type, data in elem]
-            self.output.put(out)
\ No newline at end of file
+    def _transform(self, elem):
+        return [self._rounded(type, data) for type, data in elem]
\ No newline at end of file
@@ -10,53 +10,219 @@ from typing import List
 import cv2 as cv
 import numpy as np
 
-from processing.operation import Operation
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from processing.operation import Operation, Chunk
+from processing.tracks import to_array, write_tracks
+from processing.shards import ShardAppender
+from processing.checkpoint import write_atomic
 
 
 class Writer(Operation):
+    """
+    Base of the operations writing their input to disk.
 
-    def __init__(self, input, path):
+    With a checkpoint (see processing.checkpoint), a writer records when it
+    has completed, and a completed writer skips its input when run again.
+    Writers that can resume a partial output also record their progress.
+    """
+
+    def __init__(self, input, path, checkpoint=None):
         super().__init__()
         self._path = path
         self._input = input
+        self._checkpoint = checkpoint
+        self._skip = False
 
     @property
     def input(self):
         return self._input
 
+    @property
+    def checkpoint_key(self):
+        """
+        The key the writer is recorded under in its checkpoint.
+        """
+        return self._path
+
+    @property
+    def completed(self):
+        """
+        Whether the checkpoint records the writer as completed.
+        """
+        return self._checkpoint is not None and self._checkpoint.is_completed(self.checkpoint_key)
+
+    def _check_exists(self):
+        # Without a checkpoint there is no telling whether an existing file is complete
+        if self._checkpoint is None and os.path.exists(self._path):
+            raise RuntimeError('File already exists!')
+
+    def _elements(self):
+        """
+        Iterate over the input elements until the shutdown signal, taking
+        chunks apart into the elements they contain.
+        """
+        while True:
+            elem = self.input.get()
+            if elem is None:
+                return
+
+            if isinstance(elem, Chunk):
+                yield from elem
+            else:
+                yield elem
+
+    def _open(self):
+        """
+        Prepare for writing, called before the first element.
+        """
+        pass
+
+    def _consume(self, elem):
+        """
+        Write a single element. Writers implement this, or run if they need
+        to read the input themselves.
+        """
+        raise NotImplementedError
+
+    def _finish(self):
+        """
+        Complete writing, called after the last element.
+        """
+        pass
+
+    def _begin(self):
+        self._skip = self.completed
+        if not self._skip:
+            self._open()
+
+    def _consume_item(self, item):
+        if self._skip:
+            return
+
+        if isinstance(item, Chunk):
+            for elem in item:
+                self._consume(elem)
+        else:
+            self._consume(item)
+
+    def _end(self):
+        if self._skip:
+            return
+
+        self._finish()
+        if self._checkpoint is not None:
+            self._checkpoint.complete(self.checkpoint_key)
+
+    def run(self):
+        self._begin()
+        for elem in self._elements():
+            if not self._skip:
+                self._consume(elem)
+        self._end()
+
+    def consume(self, items):
+        """
+        Write in the calling thread instead of running the writer as a thread.
+
+        :param items: iterable of input items, elements or chunks of elements, e.g. the generator of another stage
+        """
+        self._begin()
+        for item in items:
+            self._consume_item(item)
+        self._end()
+
 
 class Dumper(Writer):
     """
     Discards any input.
     """
-    def run(self):
-        while True:
-            elem = self.input.get(timeout=1)
-            if elem is None:
-                return
+    def _consume(self, elem):
+        pass
 
 
 class SequenceWriter(Writer):
 
-    def __init__(self, input, path, prefix, extension, start_index=0):
-        super().__init__(input, path)
+    def __init__(self, input, path, prefix, extension, start_index=0, workers=1, checkpoint=None):
+        """
+        Writes every element to its own file, named by the prefix and the index of the element.
+
+        With a checkpoint, the index after the last file written is recorded
+        as the progress of the writer. When run again, the elements up to that
+        index are skipped instead of written again.
+
+        :param input: the queue of elements to write
+        :param path: the directory to write to
+        :param prefix: prefix of the file names
+        :param extension: extension of the file names
+        :param start_index: index of the first element
+        :param workers: number of threads encoding and writing files in parallel
+        :param checkpoint: the Checkpoint to record progress in
+        """
+        super().__init__(input, path, checkpoint)
         self._prefix = prefix
         self._start_index = start_index
         self._extension = extension
+        self._workers = workers
+        self._resume_index = 0
 
-    def run(self):
+    @property
+    def checkpoint_key(self):
+        return os.path.join(self._path, self._prefix)
+
+    @property
+    def written(self):
+        """
+        The index after the last file recorded as written in the checkpoint.
+        """
+        if self._checkpoint is None:
+            return 0
+        return self._checkpoint.written(self.checkpoint_key)
+
+    def _open(self):
         if not os.path.exists(self._path):
             os.mkdir(self._path)
         elif not os.path.isdir(self._path):
             raise RuntimeError('Path is not a directory. A Sequence Writer needs a directory to write to.')
 
-        while True:
-            elem = self.input.get()
-            if elem is None:
-                return
-            fname = os.path.join(self._path, '{}{}.{}'.format(self._prefix, self._start_index, self._extension))
+        self._executor = ThreadPoolExecutor(self._workers) if self._workers > 1 else None
+        self._pending = deque()
+        self._resume_index = self.written
+
+    def _record(self, index):
+        if self._checkpoint is not None:
+            self._checkpoint.update(self.checkpoint_key, index+1)
+
+    def _consume(self, elem):
+        index = self._start_index
+        self._start_index += 1
+        if index < self._resume_index:
+            return
+
+        fname = os.path.join(self._path, '{}{}.{}'.format(self._prefix, index, self._extension))
+        if self._executor is None:
             self._write(fname, elem)
-            self._start_index += 1
+            self._record(index)
+            return
+
+        # Bounding the pending writes bounds the memory held by elements waiting to be written
+        self._pending.append((index, self._executor.submit(self._write, fname, elem)))
+        if len(self._pending) >= 2*self._workers:
+            self._complete_pending()
+
+    def _complete_pending(self):
+        # Writes are completed in order, so every file before the recorded index is written
+        index, future = self._pending.popleft()
+        future.result()
+        self._record(index)
+
+    def _finish(self):
+        if self._executor is None:
+            return
+        while self._pending:
+            self._complete_pending()
+        self._executor.shutdown()
 
     @abstractmethod
     def _write(self, fname, elem):
@@ -65,8 +231,8 @@ class SequenceWriter(Writer):
 
 class ImageSequenceWriter(SequenceWriter):
 
-    def __init__(self, input, path, prefix, start_index=0, extension='png'):
-        super().__init__(input, path, prefix, extension, start_index)
+    def __init__(self, input, path, prefix, start_index=0, extension='png', workers=1, checkpoint=None):
+        super().__init__(input, path, prefix, extension, start_index, workers, checkpoint)
 
     def _write(self, fname, elem):
         cv.imwrite(fname, elem)
@@ -74,47 +240,79 @@ class ImageSequenceWriter(SequenceWriter):
 
 class ArraySequenceWriter(SequenceWriter):
 
-    def __init__(self, input, path, prefix, start_index=0, extension='npy'):
-        super().__init__(input, path, prefix, extension, start_index)
+    def __init__(self, input, path, prefix, start_index=0, extension=None, workers=1, checkpoint=None,
+                 compressed=False):
+        """
+        Writes every array to its own .npy file, or .npz file if compressed. Compressing pays
+        off for sparse arrays, like position maps, which compress by orders of magnitude.
+        """
+        if extension is None:
+            extension = 'npz' if compressed else 'npy'
+        super().__init__(input, path, prefix, extension, start_index, workers, checkpoint)
+        self._compressed = compressed
 
     def _write(self, fname, elem):
-        np.save(fname, elem)
+        if self._compressed:
+            with open(fname, 'wb') as f:
+                np.savez_compressed(f, elem)
+        else:
+            np.save(fname, elem)
+
+
+class ShardWriter(Writer):
+    """
+    Appends every element to a packed shard set instead of writing it to
+    its own file, see processing.shards. A shard set can't be appended to
+    later, so an incomplete set is written again from the start.
+    """
+
+    def __init__(self, input, path, shard_size=2**30, checkpoint=None):
+        super().__init__(input, path, checkpoint)
+        self._shard_size = shard_size
+
+    def _open(self):
+        self._shards = ShardAppender(self._path, self._shard_size)
+
+    def _consume(self, elem):
+        self._shards.append(elem)
+
+    def _finish(self):
+        self._shards.close()
 
 
 class TrackFileWriter(Writer):
 
-    def __init__(self, input, path, resolution, track_names=None):
-        super().__init__(input, path)
+    def __init__(self, input, path, resolution, track_names=None, checkpoint=None):
+        """
+        Writes track rows to a JSON track file. The file must not exist
+        unless a checkpoint is given, then an incomplete file is replaced.
+        """
+        super().__init__(input, path, checkpoint)
         self._track_names = track_names
         self._types = None
         self._resolution = resolution
 
-    def run(self):
-        if os.path.exists(self._path):
-            raise RuntimeError('File already exists!')
-
-        elements = []
-        while True:
-            single = self.input.get()
-            if single is None:
-                break
+    def _open(self):
+        self._check_exists()
+        self._rows = []
 
-            element_data = [elem[1] for elem in single]
+    def _consume(self, single):
+        element_data = [elem[1] for elem in single]
 
-            # TODO: Not pretty!!
-            if not self._types:
-                self._types = [elem[0] for elem in single]
+        # TODO: Not pretty!!
+        if not self._types:
+            self._types = [elem[0] for elem in single]
 
-            if not self._track_names:
-                self._track_names = [elem[2] for elem in single]
+        if not self._track_names:
+            self._track_names = [elem[2] for elem in single]
 
-            elements.append(element_data)
+        self._rows.append(element_data)
 
+    def _finish(self):
+        elements = self._rows
         length = len(elements)
 
-        data = np.array(elements).T
-        print(data.shape)
-        data = data.tolist()
+        data = np.array(elements).T.tolist()
 
         tracks = []
         for name, type, dat in zip(self._track_names, self._types, data):
@@ -133,44 +331,68 @@ class TrackFileWriter(Writer):
             }
         }
 
-        f = open(self._path, 'w')
-        f.write(json.dumps(total))
-        f.close()
+        write_atomic(self._path, json.dumps(total))
 
 
-class ArraySequenceToJsonWriter(Writer):
+class TrackArrayWriter(Writer):
+    """
+    Writes track rows in the columnar format of processing.tracks. Accepts
+    rows with dicts as data, like TrackFileWriter, as well as blocks of rows
+    with structured arrays as data.
+    """
 
-    def __init__(self, input, base_path, name):
-        super().__init__(input, os.path.join(base_path, name))
-        self.base_path = base_path
+    def __init__(self, input, path, resolution, track_names=None, checkpoint=None):
+        super().__init__(input, path, checkpoint)
+        self._track_names = track_names
+        self._resolution = resolution
 
-    def run(self):
-        if os.path.exists(self._path):
-            raise RuntimeError('File already exists!')
+    def _open(self):
+        self._check_exists()
+        self._types = None
+        self._columns = None
 
-        elements = []
+    def _consume(self, single):
+        if self._types is None:
+            self._types = [elem[0] for elem in single]
+            self._columns = [[] for _ in single]
+            if not self._track_names:
+                self._track_names = [elem[2] for elem in single]
 
-        i = 0
-        while True:
-            elem = self.input.get()
-            if elem is None:
-                break
+        for column, elem in zip(self._columns, single):
+            column.append(elem[1])
+
+    def _finish(self):
+        tracks = []
+        for name, type, column in zip(self._track_names or [], self._types or [], self._columns or []):
+            if column and isinstance(column[0], np.ndarray):
+                data = np.concatenate(column)
+            else:
+                data = to_array(type, column)
+            tracks.append((name, type, data))
 
-            path, label = elem
+        write_tracks(self._path, tracks, self._resolution)
 
-            elements.append(elem)
 
-            if i % 10000 == 0:
-                print(i)
+class ArraySequenceToJsonWriter(Writer):
+
+    def __init__(self, input, base_path, name, checkpoint=None):
+        super().__init__(input, os.path.join(base_path, name), checkpoint)
+        self.base_path = base_path
+
+    def _open(self):
+        self._check_exists()
+        self._entries = []
 
-            i += 1
+    def _consume(self, elem):
+        path, label = elem
+        self._entries.append(elem)
 
+    def _finish(self):
+        elements = self._entries
         out = {
             'base_path': self.base_path,
             'len': len(elements),
             'elements': elements
         }
 
-        f = open(self._path, 'w')
-        f.write(json.dumps(out))
-        f.close()
\ No newline at end of file
+        write_atomic(self._path, json.dumps(out))
\ No newline at end of file
@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+
+from processing.aio import AsyncChannel, AsyncPipeline
+from processing.loaders import Loader
+from processing.pipeline import run
+from processing.transformers import Transformer, Duplicate, Merge, Zip
+from processing.writers import Writer
+
+
+class Items(Loader):
+
+    def __init__(self, items, chunk_size=None):
+        super().__init__(None, chunk_size=chunk_size)
+        self.items = items
+
+    def _iterate(self):
+        return iter(self.items)
+
+
+class Double(Transformer):
+
+    def _transform(self, elem):
+        return 2*elem
+
+
+class Fail(Transformer):
+
+    def _transform(self, elem):
+        raise ValueError('failed on {}'.format(elem))
+
+
+class Collect(Writer):
+
+    def __init__(self, input):
+        super().__init__(input, None)
+        self.items = []
+
+    def _consume(self, elem):
+        self.items.append(elem)
+
+
+def graph(chunk_size):
+    numbers = Items(list(range(40)), chunk_size)
+    letters = Items([chr(ord('a') + i % 26) for i in range(40)], chunk_size)
+    double = Double(numbers.output)
+    duplicate = Duplicate(double.output)
+    zipped = Zip(duplicate.nth(0), letters.output)
+    pairs, doubled = Collect(zipped.output), Collect(duplicate.nth(1))
+    return [numbers, letters, double, duplicate, zipped, pairs, doubled], [pairs, doubled]
+
+
+@pytest.mark.parametrize('offload', [True, False, ('Double',)])
+@pytest.mark.parametrize('chunk_size', [None, 6])
+def test_async_pipeline_equals_threaded(chunk_size, offload):
+    operations, writers = graph(chunk_size)
+    run(operations)
+    threaded = [writer.items for writer in writers]
+
+    operations, writers = graph(chunk_size)
+    asyncio.run(AsyncPipeline(operations, offload=offload).run())
+    assert [writer.items for writer in writers] == threaded
+    assert not any(operation.is_alive() for operation in operations)
+
+
+def test_pipelines_run_concurrently():
+    def pipeline(n):
+        source = Items(list(range(n)))
+        double = Double(source.output)
+        sink = Collect(double.output)
+        return AsyncPipeline([source, double, sink]), sink
+
+    async def main():
+        pipelines = [pipeline(n) for n in range(20)]
+        await asyncio.gather(*(pipeline.run() for pipeline, _ in pipelines))
+        return [sink.items for _, sink in pipelines]
+
+    assert asyncio.run(main()) == [[2*i for i in range(n)] for n in range(20)]
+
+
+def test_merge():
+    first, second = Items(list(range(0, 20))), Items(list(range(100, 120)))
+    merge = Merge(first.output, second.output)
+    sink = Collect(merge.output)
+    asyncio.run(AsyncPipeline([first, second, merge, sink]).run())
+    assert sorted(sink.items) == list(range(0, 20)) + list(range(100, 120))
+    assert [i for i in sink.items if i < 100] == list(range(20))
+
+
+def test_failure_is_raised():
+    source = Items(list(range(10**6)))
+    fail = Fail(source.output)
+    with pytest.raises(ValueError, match='failed on 0'):
+        asyncio.run(AsyncPipeline([source, fail, Collect(fail.output)]).run())
+
+
+def test_channel_end_of_stream():
+    async def main():
+        channel = AsyncChannel()
+        await channel.put(1)
+        await channel.put(None)
+        return [await channel.get() for _ in range(3)], channel.closed
+
+    assert asyncio.run(main()) == ([1, None, None], True)
@@ -0,0 +1,157 @@
+import os
+import multiprocessing
+
+import numpy as np
+import pytest
+
+from processing.cache import StageCache, CacheLoader, CacheWriter
+from processing.operation import Operation
+from processing.pipeline import Pipeline, cached_stages
+from processing.queues import make_queue
+
+
+class Source(Operation):
+
+    def __init__(self, elements):
+        super().__init__()
+        self.elements = elements
+        self.output = make_queue()
+
+    def run(self):
+        for elem in self.elements:
+            self.output.put(elem)
+        self.output.put(None)
+
+
+class Sink(Operation):
+
+    def __init__(self, input):
+        super().__init__()
+        self.input = input
+        self.items = []
+
+    def run(self):
+        while True:
+            elem = self.input.get()
+            if elem is None:
+                return
+            self.items.append(elem)
+
+
+def collect(operations, output):
+    sink = Sink(output)
+    Pipeline(operations + [sink]).run()
+    return sink.items
+
+
+def store(cache, key, elements):
+    source = Source(elements)
+    Pipeline([source, CacheWriter(source.output, cache, key)]).run()
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return StageCache(str(tmp_path / 'cache'))
+
+
+@pytest.fixture
+def video(tmp_path):
+    path = tmp_path / 'video.avi'
+    path.write_bytes(b'frames')
+    return str(path)
+
+
+def test_key_depends_on_contents_and_params(cache, video):
+    key = cache.key([video], stage='resize', size=[32, 24])
+    assert cache.key([video], stage='resize', size=[32, 24]) == key
+    assert cache.key([video], stage='resize', size=[64, 48]) != key
+
+    # A changed input file invalidates its entries
+    with open(video, 'wb') as f:
+        f.write(b'other frames')
+    assert cache.key([video], stage='resize', size=[32, 24]) != key
+
+
+def hash_file(path, video):
+    return StageCache(path).file_hash(video)
+
+
+def test_hashes_from_concurrent_processes(cache, tmp_path):
+    videos = []
+    for i in range(8):
+        videos.append(str(tmp_path / 'video{}.avi'.format(i)))
+        with open(videos[-1], 'wb') as f:
+            f.write(bytes([i])*1000)
+
+    with multiprocessing.Pool(4) as pool:
+        digests = pool.starmap(hash_file, [(cache.path, video) for video in videos*4])
+
+    assert len(set(digests)) == len(videos)
+    assert [cache.file_hash(video) for video in videos] == digests[:len(videos)]
+
+
+def test_hit_and_miss(cache):
+    frames = [np.full((4, 4), i, np.uint8) for i in range(10)]
+    built = []
+
+    def build():
+        built.append(True)
+        source = Source(frames)
+        return [source]
+
+    operations, output = cached_stages(build, cache, 'key')
+    assert all(np.array_equal(a, b) for a, b in zip(collect(operations, output), frames))
+    assert len(built) == 1 and 'key' in cache
+
+    operations, output = cached_stages(build, cache, 'key', start=3)
+    replayed = collect(operations, output)
+    assert len(built) == 1
+    assert all(np.array_equal(a, b) for a, b in zip(replayed, frames[3:])) and len(replayed) == 7
+
+
+def test_missing_entry_is_a_miss(cache):
+    with pytest.raises(KeyError):
+        CacheLoader(cache, 'missing')
+    with pytest.raises(KeyError):
+        cache.replay('missing')
+
+    operations, output = cached_stages(lambda: [Source([1, 2, 3])], cache, 'missing')
+    assert collect(operations, output) == [1, 2, 3]
+
+
+def test_replay_survives_eviction(cache):
+    store(cache, 'key', list(range(100)))
+    loader = CacheLoader(cache, 'key')
+    cache.clear()
+
+    assert 'key' not in cache
+    assert list(loader.iterate()) == list(range(100))
+
+
+def test_interrupted_entry_isnt_added(cache):
+    class Failing(Source):
+        def run(self):
+            self.output.put(1)
+            raise RuntimeError('interrupted')
+
+    source = Failing([])
+    with pytest.raises(RuntimeError):
+        Pipeline([source, CacheWriter(source.output, cache, 'key')]).run()
+
+    assert 'key' not in cache
+    assert not [name for name in os.listdir(cache.path) if name.startswith('.tmp-')]
+
+
+def test_eviction_removes_least_recently_used(cache):
+    element = np.zeros(1000, np.uint8)
+    for key in 'abc':
+        store(cache, key, [element])
+    os.utime(os.path.join(cache.path, 'a.pkl'), (1, 1))
+    os.utime(os.path.join(cache.path, 'b.pkl'), (2, 2))
+    # Replaying an entry marks it as used
+    cache.open('a').close()
+
+    cache.max_bytes = 2*cache.size//3 + 1
+    cache.evict()
+
+    assert 'a' in cache and 'b' not in cache and 'c' in cache
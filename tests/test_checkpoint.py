@@ -0,0 +1,120 @@
+import os
+import glob
+import json
+import hashlib
+
+import cv2 as cv
+import numpy as np
+import pytest
+
+from processing.checkpoint import Checkpoint, write_atomic
+from processing.pipeline import image_sequence_pipeline
+from processing.queues import make_queue
+from processing.transformers import split_counts, split_resume_point
+from processing.writers import ArraySequenceToJsonWriter
+
+
+def test_write_atomic(tmp_path):
+    path = str(tmp_path / 'file.json')
+    write_atomic(path, 'first')
+    write_atomic(path, 'second')
+
+    with open(path) as f:
+        assert f.read() == 'second'
+    assert os.listdir(str(tmp_path)) == ['file.json']
+
+
+def test_checkpoint_is_saved(tmp_path):
+    path = str(tmp_path / 'checkpoint.json')
+    checkpoint = Checkpoint(path, interval=3600)
+    checkpoint.update('a', 10)
+    checkpoint.complete('b')
+
+    loaded = Checkpoint(path)
+    assert loaded.is_completed('b') and not loaded.is_completed('a')
+    # Completing saves right away, progress updates only every interval
+    checkpoint.update('a', 20)
+    assert Checkpoint(path).written('a') == 10
+    checkpoint.save()
+    assert Checkpoint(path).written('a') == 20
+
+    checkpoint.complete('a')
+    assert Checkpoint(path).written('a') == 0
+
+
+def test_checkpoints_merge(tmp_path):
+    path = str(tmp_path / 'checkpoint.json')
+    first, second = Checkpoint(path), Checkpoint(path)
+    first.update('a', 5)
+    first.complete('b')
+    second.update('a', 3)
+    second.update('c', 7)
+    second.save()
+
+    merged = Checkpoint(path)
+    assert merged.written('a') == 5 and merged.written('c') == 7 and merged.is_completed('b')
+
+
+@pytest.mark.parametrize('split', [(60, 20, 20), (50, 50), (30, 50, 20), (0, 100)])
+def test_split_resume_point(split):
+    for n in range(0, 450, 7):
+        counts = split_counts(split, n)
+        assert sum(counts) == n
+        # Resuming from an earlier element would write elements twice, a later one would skip some
+        resume = split_resume_point(split, counts)
+        assert resume >= n and split_counts(split, resume) == counts
+
+    # Writers that got further than others write the elements they miss again
+    for counts in [[100] + [0]*(len(split) - 1), [3]*len(split), list(range(len(split)))]:
+        largest = max(n for n in range(500) if all(a <= b for a, b in zip(split_counts(split, n), counts)))
+        assert split_resume_point(split, counts) == largest
+
+
+def test_completed_writer_skips_its_input(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint.json'))
+    ArraySequenceToJsonWriter(make_queue(), str(tmp_path), 'list.json', checkpoint=checkpoint).consume([('a', 1)])
+    ArraySequenceToJsonWriter(make_queue(), str(tmp_path), 'list.json', checkpoint=checkpoint).consume([('b', 1)])
+
+    with open(str(tmp_path / 'list.json')) as f:
+        assert json.load(f)['elements'] == [['a', 1]]
+    # Without a checkpoint there is no telling whether an existing file is complete
+    with pytest.raises(RuntimeError):
+        ArraySequenceToJsonWriter(make_queue(), str(tmp_path), 'list.json').consume([('c', 1)])
+
+
+@pytest.fixture
+def video(tmp_path):
+    path = str(tmp_path / 'v.avi')
+    writer = cv.VideoWriter(path, cv.VideoWriter_fourcc(*'MJPG'), 25, (64, 48))
+    for i in range(157):
+        frame = np.full((48, 64, 3), i % 256, np.uint8)
+        cv.putText(frame, str(i), (5, 30), cv.FONT_HERSHEY_SIMPLEX, 0.8, (255, 0, 0), 2)
+        writer.write(frame)
+    writer.release()
+    return path
+
+
+def digests(path):
+    return {os.path.relpath(fname, path): hashlib.md5(open(fname, 'rb').read()).hexdigest()
+            for fname in glob.glob(os.path.join(path, '*', '*.png'))}
+
+
+def test_interrupted_run_resumes(video, tmp_path):
+    reference, out = str(tmp_path / 'reference'), str(tmp_path / 'out')
+    image_sequence_pipeline(video, reference, (32, 32))
+    image_sequence_pipeline(video, out, (32, 32), checkpoint=True)
+    assert digests(out) == digests(reference)
+
+    # Interrupt the run: drop the last frames of every writer and record how many were written
+    written = {'train': 41, 'test': 9, 'val': 20}
+    for dir, n in written.items():
+        for fname in glob.glob(os.path.join(out, dir, '*.png')):
+            if int(os.path.basename(fname)[1:-4]) >= n:
+                os.remove(fname)
+    with open(os.path.join(out, '.checkpoint-v.json'), 'w') as f:
+        json.dump({'completed': [], 'written': {os.path.join(out, dir, 'v'): n for dir, n in written.items()}}, f)
+
+    image_sequence_pipeline(video, out, (32, 32), checkpoint=True)
+    assert digests(out) == digests(reference)
+    checkpoint = Checkpoint(os.path.join(out, '.checkpoint-v.json'))
+    assert all(checkpoint.is_completed(os.path.join(out, dir, 'v')) for dir in written)
@@ -0,0 +1,79 @@
+import threading
+
+import numpy as np
+import pytest
+
+from processing.helpers import batch_queue_generator, BatchRing
+from processing.operation import Chunk
+from processing.queues import make_queue
+
+
+def filled_queue(elements):
+    queue = make_queue()
+    for elem in elements:
+        queue.put(elem)
+    queue.put(None)
+    return queue
+
+
+@pytest.mark.parametrize('chunked', [False, True])
+def test_batches(chunked):
+    elements = [np.full((2, 3), i, np.int16) for i in range(10)]
+    queue = filled_queue([Chunk(elements[:4]), Chunk(elements[4:])] if chunked else elements)
+    batches = [batch.copy() for batch in batch_queue_generator(queue, batch_size=4)]
+    assert [len(batch) for batch in batches] == [4, 4, 2]
+    assert all(batch.dtype == np.int16 for batch in batches)
+    np.testing.assert_array_equal(np.concatenate(batches), np.stack(elements))
+
+
+def test_batches_reuse_the_ring():
+    queue = filled_queue([np.full(2, i) for i in range(6)])
+    batches = list(batch_queue_generator(queue, batch_size=2, ring_size=2))
+    # The third batch was written into the buffer of the first one
+    assert np.shares_memory(batches[0], batches[2])
+    np.testing.assert_array_equal(batches[0], [[4, 4], [5, 5]])
+    np.testing.assert_array_equal(batches[1], [[2, 2], [3, 3]])
+
+
+def test_pinned_batches_wait_for_release():
+    queue = filled_queue([np.full(2, i) for i in range(6)])
+    batches = batch_queue_generator(queue, batch_size=2, ring_size=2, pinned=True)
+    first, release_first = next(batches)
+    second, release_second = next(batches)
+    taken = []
+    thread = threading.Thread(target=lambda: taken.append(next(batches)))
+    thread.start()
+    thread.join(0.1)
+    assert thread.is_alive() and not taken
+    np.testing.assert_array_equal(first, [[0, 0], [1, 1]])
+
+    threading.Thread(target=release_first).start()
+    thread.join(5)
+    assert not thread.is_alive()
+    third, release_third = taken[0]
+    np.testing.assert_array_equal(third, [[4, 4], [5, 5]])
+    release_second()
+    release_third()
+
+
+def test_pinned_ring_raises_instead_of_deadlocking():
+    ring = BatchRing(2, (2,), np.int64, size=2, pinned=True)
+    ring.acquire()
+    ring.acquire()
+    with pytest.raises(RuntimeError):
+        ring.acquire()
+
+
+def test_release_is_idempotent():
+    queue = filled_queue([np.full(2, i) for i in range(10)])
+    batches = batch_queue_generator(queue, batch_size=2, ring_size=2, pinned=True)
+    _, release_first = next(batches)
+    _, release_second = next(batches)
+    release_first()
+    _, release_third = next(batches)
+    # Releasing the first batch again must not free the buffer of the third one
+    release_first()
+    release_second()
+    next(batches)
+    with pytest.raises(RuntimeError):
+        next(batches)
@@ -0,0 +1,327 @@
+import cv2 as cv
+import numpy as np
+import pytest
+
+from processing.loaders import ArraySequenceLoader
+from processing.operation import Chunk
+from processing.queues import make_queue
+from processing.transformers.image import WindowGenerator, RandomNegativeWindowGenerator, PositiveWindowGenerator, \
+    RegionExtractor, Preprocess, PositionMapGenerator
+from processing.writers import ArraySequenceWriter
+
+
+def window_generator(**options):
+    return WindowGenerator(make_queue(), make_queue(), **options)
+
+
+WINDOW_CASES = [
+    (('point', {'x': 40, 'y': 30}), dict(window_size=(16, 16), stride=1, radius=5)),
+    (('rectangle_region', {'x': 20, 'y': 10, 'width': 20, 'height': 14}), dict(window_size=(16, 12), stride=2)),
+    (('rectangle_region', {'x': 20, 'y': 10, 'width': 10, 'height': 14}), dict(window_size=(10, 14), stride=2,
+                                                                              radius=4)),
+    (('point', {'x': 40, 'y': 30}), dict(window_size=(16, 16), stride=3)),
+    # No window within the radius fits in the frame
+    (('point', {'x': 2, 'y': 2}), dict(window_size=(16, 16), stride=1, radius=1)),
+    # The region is larger than the frame
+    (('rectangle_region', {'x': 0, 'y': 0, 'width': 100, 'height': 70}), dict(window_size=(16, 16), stride=1)),
+]
+
+
+@pytest.mark.parametrize('channels', [3, 1])
+@pytest.mark.parametrize('track, options', WINDOW_CASES)
+def test_vectorized_windows_equal_separate_windows(channels, track, options):
+    frame = np.random.default_rng(0).integers(0, 256, (60, 80, channels), dtype=np.uint8)
+
+    separate = list(window_generator(scaling=(1, 1), **options)._expand((frame, [track])))
+    (dists, windows), = window_generator(scaling=(1, 1), vectorized=True, **options)._expand((frame, [track]))
+
+    width, height = options['window_size']
+    assert windows.shape == (len(separate), height, width) + ((channels,) if channels > 1 else ())
+    assert windows.dtype == frame.dtype
+    assert dists.tolist() == [dist for dist, _ in separate]
+    for (_, expected), window in zip(separate, windows):
+        assert np.array_equal(expected, window)
+
+
+def negative_generator(*args, **options):
+    return RandomNegativeWindowGenerator(make_queue(), make_queue(), *args, **options)
+
+
+def positions(image, windows):
+    """
+    :return: the (y, x) position in the image of every window, read from its first pixel
+    """
+    return [divmod(int(window[0, 0, 0]) // image.shape[2], image.shape[1]) for window in windows]
+
+
+def test_negative_windows_avoid_the_centers():
+    image = np.arange(120*160*3).reshape(120, 160, 3)
+    centers = [(60, 80), (0, 0), (20, 30)]
+    windows = list(negative_generator((16, 24), 10, 500, seed=1)._expand((image, centers)))
+
+    assert len(windows) == 500
+    for (y, x), window in zip(positions(image, windows), windows):
+        assert np.array_equal(window, image[y:y+16, x:x+24])
+        cy, cx = y + 8, x + 12
+        # (0, 0) centers are ignored
+        assert all(abs(ty - cy) > 10 or abs(tx - cx) > 10 for ty, tx in centers if (ty, tx) != (0, 0))
+    # Positions are sampled over the whole image, the top left included
+    assert min(positions(image, windows)) < (10, 10)
+
+
+def test_negative_windows_are_reproducible():
+    image = np.arange(120*160*3).reshape(120, 160, 3)
+    centers = [(60, 80)]
+    separate = list(negative_generator((16, 24), 10, 50, seed=3)._expand((image, centers)))
+    (batch,) = negative_generator((16, 24), 10, 50, seed=3, vectorized=True)._expand((image, centers))
+
+    assert batch.shape == (50, 16, 24, 3)
+    assert np.array_equal(batch, np.stack(separate))
+    assert np.array_equal(np.stack(list(negative_generator((16, 24), 10, 50, seed=3)._expand((image, centers)))),
+                          batch)
+
+
+def test_negative_windows_of_gray_images():
+    image = np.zeros((120, 160), np.uint8)
+    (batch,) = negative_generator((16, 24), 10, 5, vectorized=True)._expand((image, [(60, 80)]))
+    assert batch.shape == (5, 16, 24)
+
+
+def test_no_negative_position():
+    image = np.zeros((120, 160, 3), np.uint8)
+    with pytest.raises(ValueError):
+        list(negative_generator((16, 24), 1000, 3)._expand((image, [(60, 80)])))
+
+
+def positive_generator(*args, **options):
+    return PositiveWindowGenerator(make_queue(), make_queue(), *args, **options)
+
+
+def positive_windows(image, centers, window_size, radius):
+    """
+    Every window around every center, one at a time.
+    """
+    for cy, cx in centers:
+        if cy == 0 and cx == 0:
+            continue
+        top, left = int(cy) - window_size[0]//2, int(cx) - window_size[1]//2
+        for y in range(top - radius, top + radius + 1):
+            for x in range(left - radius, left + radius + 1):
+                yield image[y:y+window_size[0], x:x+window_size[1]]
+
+
+@pytest.mark.parametrize('gray', [False, True])
+def test_positive_windows(gray):
+    image = np.random.default_rng(0).integers(0, 256, (120, 160, 3), dtype=np.uint8)
+    image = image[..., 0] if gray else image
+    centers = [(60, 80), (0, 0), (40.7, 50.2)]
+    expected = list(positive_windows(image, centers, (16, 24), 3))
+
+    separate = list(positive_generator((16, 24), 3)._expand((image, centers)))
+    batches = list(positive_generator((16, 24), 3, vectorized=True)._expand((image, centers)))
+
+    assert len(separate) == len(expected) == 2*49
+    assert all(np.array_equal(a, b) for a, b in zip(separate, expected))
+    assert [batch.shape for batch in batches] == [(49, 16, 24) + image.shape[2:]]*2
+    assert np.array_equal(np.concatenate(batches), np.stack(expected))
+
+
+def test_positive_windows_subsampled():
+    image = np.random.default_rng(0).integers(0, 256, (120, 160, 3), dtype=np.uint8)
+    centers = [(60, 80), (40, 50)]
+    expected = [window.tobytes() for window in positive_windows(image, centers, (16, 24), 3)]
+
+    first = list(positive_generator((16, 24), 3, max_n=5, seed=3, vectorized=True)._expand((image, centers)))
+    second = list(positive_generator((16, 24), 3, max_n=5, seed=3, vectorized=True)._expand((image, centers)))
+
+    assert [batch.shape[0] for batch in first] == [5, 5]
+    assert all(np.array_equal(a, b) for a, b in zip(first, second))
+    assert all(window.tobytes() in expected for batch in first for window in batch)
+
+
+def test_positive_windows_at_the_border():
+    image = np.random.default_rng(0).integers(0, 256, (120, 160, 3), dtype=np.uint8)
+    centers = [(5, 5)]
+    with pytest.raises(ValueError):
+        list(positive_generator((16, 24), 3)._expand((image, centers)))
+
+    (clamped,) = positive_generator((16, 24), 3, border='clamp', vectorized=True)._expand((image, centers))
+    assert clamped.shape == (49, 16, 24, 3)
+    assert all(np.array_equal(window, image[:16, :24]) for window in clamped)
+
+    assert list(positive_generator((16, 24), 3, border='skip')._expand((image, centers))) == []
+    (skipped,) = positive_generator((16, 24), 3, border='skip', vectorized=True)._expand((image, [(10, 14)]))
+    # Only the offsets keeping the window in the image, 6 of 7 on both axes
+    assert len(skipped) == 6*6
+
+
+@pytest.mark.parametrize('border', ['raise', 'clamp', 'skip'])
+def test_positive_windows_larger_than_the_image(border):
+    image = np.zeros((10, 10, 3), np.uint8)
+    with pytest.raises(ValueError, match='outside image boundaries'):
+        list(positive_generator((16, 24), 3, border=border)._expand((image, [(5, 5)])))
+
+
+REGIONS = [
+    ('rectangle_region', {'x': 10, 'y': 20, 'width': 30, 'height': 15}),
+    ('inscribed_circle', {'cx': 80, 'cy': 60, 'width': 20, 'height': 10, 'angle': 0}),
+    # Partly and completely outside the image
+    ('point', {'x': 155, 'y': 5}),
+    ('point', {'x': 500, 'y': 500}),
+]
+
+
+def region_extractor(**options):
+    return RegionExtractor(make_queue(), make_queue(), **options)
+
+
+def test_regions_are_cropped():
+    image = np.random.default_rng(0).integers(0, 256, (120, 160, 3), dtype=np.uint8)
+    crops = region_extractor(box=(16, 10))._transform((image, REGIONS))
+
+    assert [(position, crop.shape) for position, crop in crops] == [
+        ((20, 10), (16, 31, 3)),
+        ((55, 70), (11, 21, 3)),
+        ((0, 147), (10, 13, 3)),
+        ((120, 160), (0, 0, 3)),
+    ]
+    assert np.array_equal(crops[0][1], image[20:36, 10:41])
+
+
+@pytest.mark.parametrize('channels', [3, 1])
+def test_regions_are_resized_to_width_and_height(channels):
+    image = np.random.default_rng(0).integers(0, 256, (120, 160, channels), dtype=np.uint8)
+    boxes, crops = region_extractor(size=(32, 24), box=(16, 10))._transform((image, REGIONS))
+
+    assert boxes.tolist() == [[20, 10, 16, 31], [55, 70, 11, 21], [0, 147, 10, 13], [120, 160, 0, 0]]
+    assert crops.shape == (4, 24, 32, channels)
+    for (y, x, height, width), crop in zip(boxes[:3], crops):
+        expected = cv.resize(image[y:y+height, x:x+width], (32, 24), interpolation=cv.INTER_AREA)
+        assert np.array_equal(crop, expected.reshape(crop.shape))
+    # A region outside the image gives a black crop
+    assert not crops[3].any()
+
+
+def test_region_padding():
+    image = np.zeros((120, 160, 3), np.uint8)
+    boxes, _ = region_extractor(size=(8, 8), padding=2)._transform((image, REGIONS[:1]))
+    assert boxes.tolist() == [[18, 8, 20, 35]]
+
+
+def test_regions_without_regions():
+    image = np.zeros((120, 160, 3), np.uint8)
+    boxes, crops = region_extractor(size=(8, 6))._transform((image, []))
+    assert boxes.shape == (0, 4) and crops.shape == (0, 6, 8, 3)
+
+
+def test_points_need_a_box():
+    image = np.zeros((120, 160, 3), np.uint8)
+    with pytest.raises(ValueError):
+        region_extractor(size=(8, 8))._transform((image, REGIONS))
+
+
+def preprocess_reference(image, crop=None, size=None, color=None, mean=None, std=None, dtype=None):
+    if crop is not None:
+        y, x, height, width = crop
+        image = image[y:y + height, x:x + width]
+    if size is not None:
+        image = cv.resize(image, size)
+    if color is not None:
+        image = cv.cvtColor(image, color)
+    if mean is not None or std is not None:
+        image = image.astype(np.float32) - np.float32(0 if mean is None else mean)
+        image = (image*(1/np.asarray(1 if std is None else std, np.float32))).astype(dtype or np.float32)
+    return image
+
+
+PREPROCESS_CASES = [
+    dict(size=(56, 40)),
+    dict(size=(56, 40), color=cv.COLOR_BGR2RGB, mean=0, std=255),
+    dict(crop=(5, 10, 40, 50), size=(16, 16), color=cv.COLOR_BGR2GRAY),
+    dict(color=cv.COLOR_BGR2RGB, mean=[100, 110, 120], std=[50, 60, 70]),
+    dict(size=(8, 8), mean=128, std=1, dtype=np.int8),
+    dict(crop=(0, 0, 20, 20)),
+]
+
+
+@pytest.mark.parametrize('options', PREPROCESS_CASES)
+def test_preprocess_matches_separate_steps(options):
+    rng = np.random.default_rng(0)
+    images = [rng.integers(0, 256, (60, 80, 3), dtype=np.uint8) for _ in range(4)]
+    preprocess = Preprocess(make_queue(), **options)
+    single = [preprocess._transform(image) for image in images]
+    chunk = preprocess._expand_chunk(Chunk(images))
+    for image, out, chunked in zip(images, single, chunk):
+        expected = preprocess_reference(image, **options)
+        assert out.dtype == expected.dtype
+        np.testing.assert_allclose(out, expected, atol=1e-5)
+        np.testing.assert_array_equal(chunked, out)
+
+
+def test_preprocess_results_dont_share_buffers():
+    images = [np.full((20, 20, 3), i, np.uint8) for i in range(3)]
+    preprocess = Preprocess(make_queue(), size=(10, 10), mean=0, std=1)
+    single = [preprocess._transform(image) for image in images]
+    assert [out[0, 0, 0] for out in single] == [0, 1, 2]
+
+
+def test_preprocess_chunk_of_different_sizes():
+    images = [np.zeros((30, 40, 3), np.uint8), np.zeros((20, 10, 3), np.uint8)]
+    out = Preprocess(make_queue(), color=cv.COLOR_BGR2GRAY)._expand_chunk(Chunk(images))
+    assert [o.shape for o in out] == [(30, 40), (20, 10)]
+
+
+def position_maps(elements, **options):
+    generator = PositionMapGenerator(make_queue(), (20, 30), (0.5, 0.5), **options)
+    return [generator._transform(elem) for elem in elements], generator._expand_chunk(Chunk(elements))
+
+
+def region(x, y, width=2, height=2):
+    return 0, {'x': x, 'y': y, 'width': width, 'height': height}
+
+
+POSITION_FRAMES = [[region(9, 9), region(39, 19)], [], [region(-10, 5), region(100, 5), region(3, 37)]]
+
+
+def test_dense_and_sparse_position_maps():
+    dense, dense_chunk = position_maps(POSITION_FRAMES, dtype=np.bool_)
+    sparse, sparse_chunk = position_maps(POSITION_FRAMES, mode='sparse')
+    # Positions outside the map are dropped
+    assert [pixels.tolist() for pixels in sparse] == [[[5, 5], [10, 20]], [], [[19, 2]]]
+    for positions, pixels in zip(dense, sparse):
+        assert positions.dtype == np.bool_ and positions.shape == (20, 30)
+        assert np.argwhere(positions).tolist() == sorted(pixels.tolist())
+    for a, b in zip(dense + sparse, dense_chunk + sparse_chunk):
+        np.testing.assert_array_equal(a, b)
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.uint8, np.bool_])
+def test_heatmaps(dtype):
+    sigma = 1.5
+    heatmaps, chunk = position_maps(POSITION_FRAMES, mode='heatmap', dtype=dtype, sigma=sigma)
+    y, x = np.mgrid[:20, :30]
+    for heatmap, chunked, elem in zip(heatmaps, chunk, POSITION_FRAMES):
+        expected = np.zeros((20, 30))
+        for _, data in elem:
+            cy, cx = (data['y'] + data['height']/2)*0.5, (data['x'] + data['width']/2)*0.5
+            expected = np.maximum(expected, np.exp(-((y - cy)**2 + (x - cx)**2)/(2*sigma**2)))
+        if dtype == np.uint8:
+            expected = np.round(expected*255)
+        elif dtype == np.bool_:
+            expected = expected >= 0.5
+        assert heatmap.dtype == dtype and heatmap.shape == (20, 30)
+        np.testing.assert_allclose(heatmap.astype(np.float64), expected, atol=1 if dtype == np.uint8 else 1e-5)
+        np.testing.assert_array_equal(chunked, heatmap)
+
+
+@pytest.mark.parametrize('compressed', [False, True])
+def test_array_sequences_round_trip(tmp_path, compressed):
+    arrays = [np.arange(12).reshape(3, 4) % (i + 2) == 0 for i in range(3)]
+    ArraySequenceWriter(make_queue(), str(tmp_path), 'map', compressed=compressed).consume(arrays)
+    extension = 'npz' if compressed else 'npy'
+    assert len(list(tmp_path.glob('*.' + extension))) == 3
+    loaded = list(ArraySequenceLoader(str(tmp_path), '*.' + extension).iterate())
+    assert len(loaded) == 3
+    for a, b in zip(arrays, loaded):
+        assert b.dtype == np.bool_
+        np.testing.assert_array_equal(a, b)
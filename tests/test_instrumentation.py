@@ -0,0 +1,90 @@
+import json
+import time
+
+from processing.instrumentation import Monitor
+from processing.operation import Operation, Chunk
+from processing.pipeline import run
+from processing.queues import make_queue
+from processing.transformers import Transformer
+
+
+class Source(Operation):
+
+    def __init__(self, n, chunk_size=1):
+        super().__init__()
+        self.n = n
+        self.chunk_size = chunk_size
+        self.output = make_queue(maxsize=2)
+
+    def run(self):
+        for i in range(0, self.n, self.chunk_size):
+            self.output.put(Chunk(range(i, i + self.chunk_size)) if self.chunk_size > 1 else i)
+        self.output.put(None)
+
+
+class Slow(Transformer):
+
+    def __init__(self, input, delay):
+        super().__init__(input, make_queue(maxsize=2))
+        self._delay = delay
+
+    def _transform(self, elem):
+        time.sleep(self._delay)
+        return elem
+
+
+class Sink(Operation):
+
+    def __init__(self, input):
+        super().__init__()
+        self.input = input
+        self.items = []
+
+    def run(self):
+        while True:
+            elem = self.input.get()
+            if elem is None:
+                return
+            self.items.append(elem)
+
+
+def test_stage_statistics(tmp_path):
+    source = Source(40)
+    slow = Slow(source.output, 0.01)
+    sink = Sink(slow.output)
+    path = str(tmp_path / 'stats.json')
+    monitor = Monitor(interval=0.05, path=path)
+    run([source, slow, sink], monitor)
+
+    source_stats, slow_stats, sink_stats = monitor.stages
+    assert [stats.name for stats in monitor.stages] == ['0:Source', '1:Slow', '2:Sink']
+    assert (source_stats.items_out, slow_stats.items_in, slow_stats.items_out, sink_stats.items_in) == (40,)*4
+    # The slow stage is the bottleneck: busy most of the time, the source waits for room and the sink for input
+    assert slow_stats.processing > 0.5*slow_stats.elapsed
+    assert source_stats.put_wait > 0.5*source_stats.elapsed
+    assert sink_stats.get_wait > 0.5*sink_stats.elapsed
+    assert monitor.queue_depths()['0:Source.0'][1] == 2
+
+    with open(path) as f:
+        saved = json.load(f)
+    assert [stage['items_in'] for stage in saved['stages']] == [0, 40, 40]
+    assert set(saved['queues']) == {'0:Source.0', '1:Slow.0'}
+    assert len(saved['samples']['time']) == len(saved['samples']['depth']['1:Slow.0']) > 0
+
+
+def test_chunks_count_as_their_elements():
+    source = Source(40, chunk_size=8)
+    sink = Sink(source.output)
+    monitor = Monitor(interval=0.05)
+    run([source, sink], monitor)
+    assert [stats.items_out for stats in monitor.stages] == [40, 0]
+    assert monitor.stages[1].items_in == 40
+
+
+def test_detach_restores_the_queues():
+    source = Source(5)
+    sink = Sink(source.output)
+    monitor = Monitor(interval=0.05)
+    run([source, sink], monitor)
+    assert 'put' not in vars(source.output) and 'get' not in vars(source.output)
+    assert monitor.report().splitlines()[0].split()[:3] == ['stage', 'in', 'out']
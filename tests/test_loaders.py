@@ -0,0 +1,166 @@
+import itertools
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2 as cv
+import numpy as np
+import pytest
+
+import processing.loaders
+from processing.loaders import FrameSelection, TrackFileLoader, VideoLoader, ArraySequenceLoader, ImageSequenceLoader
+from processing.operation import ordered_map
+from processing.queues import make_queue
+from processing.writers import ArraySequenceWriter, ImageSequenceWriter
+
+
+def track_file(path, order=('name', 'type', 'data')):
+    tracks = [
+        {'name': 'face', 'type': 'rectangle_region',
+         'data': [{'x': i, 'y': 2*i, 'width': 10.5, 'height': 12} for i in range(50)]},
+        {'name': 'eye_left', 'type': 'point', 'data': [{'x': i, 'y': -i} for i in range(50)]},
+        {'name': 'pupil', 'type': 'inscribed_circle', 'data': [{'cx': i, 'cy': i, 'width': 3, 'height': 4}
+                                                               for i in range(50)]},
+    ]
+    tracks = [{key: track[key] for key in order} for track in tracks]
+    with open(path, 'w') as f:
+        json.dump({'tracks': tracks, 'length': 50, 'video_resolution': {'width': 640, 'height': 480}}, f)
+    return str(path)
+
+
+@pytest.mark.parametrize('order', [('name', 'type', 'data'), ('data', 'type', 'name'), ('type', 'data', 'name')])
+@pytest.mark.parametrize('options', [
+    {},
+    {'track_names': ['eye_left']},
+    {'track_names': ['pupil', 'face'], 'keep_names': True},
+    {'skip_pattern': (1, 2), 'stop': 40},
+    {'ranges': [(5, 10), (30, None)], 'chunk_size': 4},
+])
+def test_streaming_equals_eager(tmp_path, order, options):
+    path = track_file(tmp_path / 'tracks.json', order)
+
+    eager = list(TrackFileLoader(path, **options).iterate())
+    streamed = list(TrackFileLoader(path, streaming=True, **options).iterate())
+
+    assert streamed == eager
+    assert len(eager) > 0
+
+
+@pytest.fixture(scope='module')
+def video(tmp_path_factory):
+    """
+    :return: path of a short video and its frames, decoded one after the other
+    """
+    path = str(tmp_path_factory.mktemp('video') / 'video.avi')
+    writer = cv.VideoWriter(path, cv.VideoWriter_fourcc(*'MJPG'), 25, (64, 48))
+    for i in range(120):
+        frame = np.full((48, 64, 3), i*2 % 256, np.uint8)
+        cv.putText(frame, str(i), (5, 30), cv.FONT_HERSHEY_SIMPLEX, 0.8, (255, 0, 0), 2)
+        writer.write(frame)
+    writer.release()
+
+    capture = cv.VideoCapture(path)
+    frames = []
+    while True:
+        ok, frame = capture.read()
+        if not ok:
+            break
+        frames.append(frame)
+    return path, frames
+
+
+VIDEO_OPTIONS = [
+    {},
+    {'workers': 3, 'segment_size': 16},
+    {'workers': 3, 'segment_size': 16, 'skip_pattern': (2, 1)},
+    {'workers': 3, 'segment_size': 16, 'ranges': [(10, 30), (100, None)]},
+    {'ranges': [(5, 8), (90, 95)], 'seek_threshold': 4},
+    {'workers': 2, 'segment_size': 16, 'stop': 70, 'chunk_size': 8},
+]
+
+
+def expected_frames(frames, options):
+    selection = FrameSelection(options.get('skip_pattern'), options.get('stop'), options.get('ranges'))
+    return [frame for i, frame in enumerate(frames) if i in selection]
+
+
+def decoded(loader):
+    out = []
+    for item in loader.iterate():
+        out += item if isinstance(item, list) else [item]
+    return out
+
+
+@pytest.mark.parametrize('options', VIDEO_OPTIONS)
+def test_video_ranges_and_workers(video, options):
+    path, frames = video
+    out = decoded(VideoLoader(path, **options))
+    expected = expected_frames(frames, options)
+
+    assert len(out) == len(expected)
+    assert all(np.array_equal(a, b) for a, b in zip(out, expected))
+
+
+@pytest.mark.parametrize('options', VIDEO_OPTIONS[1:4])
+def test_video_decoded_past_underestimated_frame_count(video, options, monkeypatch):
+    path, frames = video
+    capture = cv.VideoCapture
+
+    class Underestimated:
+        def __init__(self, path):
+            self._capture = capture(path)
+
+        def get(self, prop):
+            return 50 if prop == cv.CAP_PROP_FRAME_COUNT else self._capture.get(prop)
+
+        def __getattr__(self, name):
+            return getattr(self._capture, name)
+
+    monkeypatch.setattr(processing.loaders.cv, 'VideoCapture', Underestimated)
+    out = decoded(VideoLoader(path, **options))
+    expected = expected_frames(frames, options)
+
+    assert len(out) == len(expected)
+    assert all(np.array_equal(a, b) for a, b in zip(out, expected))
+
+
+@pytest.mark.parametrize('write_workers, load_workers', [(1, 1), (4, 1), (1, 4), (3, 5)])
+def test_sequences_with_workers(tmp_path, write_workers, load_workers):
+    images = [np.random.default_rng(i).integers(0, 256, (12, 16, 3), dtype=np.uint8) for i in range(9)]
+    ImageSequenceWriter(make_queue(), str(tmp_path / 'images'), 'frame', workers=write_workers).consume(images)
+    ArraySequenceWriter(make_queue(), str(tmp_path / 'arrays'), 'frame', workers=write_workers).consume(images)
+
+    assert sorted(p.name for p in (tmp_path / 'images').iterdir()) == ['frame{}.png'.format(i) for i in range(9)]
+    loaded_images = list(ImageSequenceLoader(str(tmp_path / 'images'), '*.png', workers=load_workers).iterate())
+    loaded_arrays = list(ArraySequenceLoader(str(tmp_path / 'arrays'), '*.npy', workers=load_workers).iterate())
+    assert len(loaded_images) == len(loaded_arrays) == 9
+    for image, loaded_image, loaded_array in zip(images, loaded_images, loaded_arrays):
+        np.testing.assert_array_equal(image, loaded_image)
+        np.testing.assert_array_equal(image, loaded_array)
+
+
+def test_failed_write_is_raised(tmp_path):
+    class Failing(ArraySequenceWriter):
+        def _write(self, fname, elem):
+            if elem == 3:
+                raise OSError('disk full')
+            super()._write(fname, elem)
+
+    with pytest.raises(OSError, match='disk full'):
+        Failing(make_queue(), str(tmp_path), 'a', workers=4).consume([np.int64(i) for i in range(10)])
+
+
+def test_ordered_map_keeps_order_and_bounds_pending_calls():
+    running = []
+    lock = threading.Lock()
+
+    def call(i):
+        with lock:
+            running.append(i)
+        return i*i
+
+    with ThreadPoolExecutor(4) as executor:
+        results = ordered_map(executor, call, itertools.count(), 3)
+        assert [next(results) for _ in range(10)] == [i*i for i in range(10)]
+        # Calls are only submitted as results are taken, even for an endless input
+        assert len(running) <= 12
@@ -0,0 +1,74 @@
+import os
+import time
+import signal
+
+import pytest
+
+from processing.multiprocessing import create_multiprocessing_job
+
+
+def record(name, log):
+    with open(log, 'a') as f:
+        f.write(os.path.basename(name) + '\n')
+
+
+def succeed(name, log):
+    record(name, log)
+
+
+def fail_once(name, log):
+    record(name, log)
+    with open(log) as f:
+        if f.read().split().count(os.path.basename(name)) == 1:
+            raise ValueError('first attempt')
+
+
+def kill_worker(name, log, sig=signal.SIGTERM):
+    record(name, log)
+    time.sleep(0.2)
+    if os.path.basename(name) == 'bad':
+        os.kill(os.getpid(), sig)
+    time.sleep(0.2)
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    directory = tmp_path / 'inputs'
+    directory.mkdir()
+    for name in ['a', 'b', 'bad', 'c', 'd', 'e']:
+        (directory / name).touch()
+    return str(directory), {'log': str(tmp_path / 'log')}
+
+
+def attempts(summary):
+    return {os.path.basename(result.kwargs['name']): (result.attempts, result.ok) for result in summary.results}
+
+
+def test_jobs_succeed(inputs):
+    directory, arguments = inputs
+    summary = create_multiprocessing_job(succeed, directory, {'name': '*'}, arguments, workers=2, progress=False)
+    assert len(summary.succeeded) == 6 and not summary.failed
+
+
+@pytest.mark.parametrize('retries', [0, 1])
+def test_failed_jobs_are_retried(inputs, retries):
+    directory, arguments = inputs
+    summary = create_multiprocessing_job(fail_once, directory, {'name': '*'}, arguments, workers=2,
+                                         retries=retries, progress=False)
+    assert set(attempts(summary).values()) == {(retries + 1, retries > 0)}
+
+
+@pytest.mark.parametrize('sig', [signal.SIGTERM, signal.SIGKILL])
+@pytest.mark.parametrize('retries', [0, 2])
+def test_crashing_worker(inputs, sig, retries):
+    directory, arguments = inputs
+    summary = create_multiprocessing_job(kill_worker, directory, {'name': '*'}, dict(arguments, sig=sig),
+                                         workers=3, retries=retries, progress=False)
+    results = attempts(summary)
+
+    # The crashing job is charged every attempt and gives up after its retries
+    assert len(results) == 6
+    assert results['bad'] == (retries + 1, False)
+    assert all(n <= retries + 1 for n, _ in results.values())
+    # Jobs that never ran alongside it aren't charged
+    assert sum(ok for _, ok in results.values()) >= 2
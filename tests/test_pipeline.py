@@ -0,0 +1,261 @@
+import time
+from queue import Queue
+
+import pytest
+
+from processing.loaders import Loader
+from processing.operation import Operation
+from processing.pipeline import Pipeline, run, run_inline, fuse
+from processing.queues import make_queue
+from processing.transformers import Transformer, Chain, Duplicate, Split, Zip
+from processing.writers import Writer
+
+
+class Source(Operation):
+
+    def __init__(self, n=None, output=None):
+        super().__init__()
+        self.n = n
+        self.output = make_queue(maxsize=4) if output is None else output
+
+    def run(self):
+        i = 0
+        while self.n is None or i < self.n:
+            self.output.put(i)
+            i += 1
+        self.output.put(None)
+
+
+class Double(Transformer):
+
+    def _transform(self, elem):
+        return 2*elem
+
+
+class Fail(Transformer):
+
+    def __init__(self, input, after):
+        super().__init__(input, make_queue(maxsize=4))
+        self._after = after
+        self._seen = 0
+
+    def _transform(self, elem):
+        self._seen += 1
+        if self._seen > self._after:
+            raise ValueError('failed on {}'.format(elem))
+        return elem
+
+
+class Sink(Operation):
+
+    def __init__(self, input, delay=0.0):
+        super().__init__()
+        self.input = input
+        self.delay = delay
+        self.items = []
+
+    def run(self):
+        while True:
+            elem = self.input.get()
+            if elem is None:
+                return
+            self.items.append(elem)
+            time.sleep(self.delay)
+
+
+def test_run():
+    source = Source(100)
+    double = Double(source.output)
+    sink = Sink(double.output)
+    run([source, double, sink])
+
+    assert sink.items == [2*i for i in range(100)]
+
+
+def test_failure_is_raised_and_stops_the_other_operations():
+    # An endless source keeps producing until the pipeline is cancelled
+    source = Source()
+    fail = Fail(source.output, 10)
+    sink = Sink(fail.output)
+    pipeline = Pipeline([source, fail, sink], shutdown_timeout=5.0)
+
+    start = time.perf_counter()
+    with pytest.raises(ValueError, match='failed on 10'):
+        pipeline.run()
+
+    assert time.perf_counter() - start < 5.0
+    assert not any(operation.is_alive() for operation in pipeline.operations)
+    # Elements still in the queues when the pipeline was cancelled are discarded
+    assert sink.items == list(range(len(sink.items)))
+    assert all(queue.cancelled for queue in pipeline.queues)
+
+
+def test_plain_queues_are_rejected():
+    source = Source(output=Queue(4))
+    pipeline = Pipeline([source, Sink(source.output)])
+
+    with pytest.raises(TypeError):
+        pipeline.start()
+    assert not source.is_alive()
+
+
+def test_run_doesnt_fuse_by_default():
+    source = Source(10)
+    double = Double(source.output)
+    twice = Double(double.output)
+    sink = Sink(twice.output)
+    operations = [source, double, twice, sink]
+
+    pipeline = Pipeline(operations)
+    pipeline.run()
+    assert pipeline.operations == operations
+    assert sink.items == [4*i for i in range(10)]
+
+    source = Source(10)
+    double = Double(source.output)
+    twice = Double(double.output)
+    sink = Sink(twice.output)
+    pipeline = Pipeline([source, double, twice, sink], fuse=True)
+    pipeline.run()
+    assert len(pipeline.operations) == 3
+    assert sink.items == [4*i for i in range(10)]
+
+
+def test_failure_of_a_writer_is_raised():
+    source = Source(100)
+
+    class FailingSink(Sink):
+        def run(self):
+            raise RuntimeError('sink failed')
+
+    with pytest.raises(RuntimeError, match='sink failed'):
+        run([source, FailingSink(source.output)])
+
+
+def test_cancel():
+    source = Source()
+    double = Double(source.output)
+    sink = Sink(double.output, delay=0.01)
+    pipeline = Pipeline([source, double, sink])
+    pipeline.start()
+    time.sleep(0.1)
+
+    pipeline.cancel()
+
+    assert not any(operation.is_alive() for operation in pipeline.operations)
+    assert all(queue.cancelled for queue in pipeline.queues)
+    # Cancelling isn't a failure
+    pipeline.wait()
+
+
+def test_operations_cannot_be_added_once_started():
+    source = Source(10)
+    sink = Sink(source.output)
+    pipeline = Pipeline([source, sink])
+    pipeline.start()
+    pipeline.wait()
+
+    with pytest.raises(RuntimeError):
+        pipeline.add(Sink(source.output))
+
+
+class Items(Loader):
+
+    def __init__(self, items, chunk_size=None):
+        super().__init__(None, chunk_size=chunk_size)
+        self.items = items
+
+    def _iterate(self):
+        return iter(self.items)
+
+
+class Collect(Writer):
+
+    def __init__(self, input):
+        super().__init__(input, None)
+        self.items = []
+        self.finished = False
+
+    def _consume(self, elem):
+        self.items.append(elem)
+
+    def _finish(self):
+        self.finished = True
+
+
+class Repeat(Transformer):
+
+    def _expand(self, elem):
+        return [elem]*(elem % 3)
+
+
+def graph(chunk_size):
+    numbers = Items(list(range(50)), chunk_size)
+    letters = Items([chr(ord('a') + i % 26) for i in range(50)], chunk_size)
+    double = Double(numbers.output)
+    zipped = Zip(double.output, letters.output)
+    duplicate = Duplicate(zipped.output)
+    split = Split(duplicate.nth(0), (30, 70))
+    first, second, third = Collect(split.output[0]), Collect(split.output[1]), Collect(duplicate.nth(1))
+    return [numbers, letters, double, zipped, duplicate, split, first, second, third], [first, second, third]
+
+
+@pytest.mark.parametrize('chunk_size', [None, 7])
+def test_run_inline_equals_threaded(chunk_size):
+    operations, writers = graph(chunk_size)
+    run(operations)
+    threaded = [writer.items for writer in writers]
+
+    operations, writers = graph(chunk_size)
+    run_inline(operations)
+    assert [writer.items for writer in writers] == threaded
+    assert all(writer.finished for writer in writers)
+    assert not any(operation.is_alive() for operation in operations)
+    # The split takes the first 30 of every 100 elements
+    assert [len(items) for items in threaded] == [30, 20, 50]
+
+
+def chained_pipeline(chunk_size, fused):
+    source = Items(list(range(30)), chunk_size)
+    double = Double(source.output)
+    repeat = Repeat(double.output)
+    twice = Double(repeat.output)
+    sink = Collect(twice.output)
+    operations = [source, double, repeat, twice, sink]
+    return (fuse(operations) if fused else operations), sink
+
+
+@pytest.mark.parametrize('chunk_size', [None, 4])
+def test_fused_chain_equals_separate_transformers(chunk_size):
+    operations, sink = chained_pipeline(chunk_size, fused=False)
+    run(operations)
+    separate = sink.items
+
+    operations, sink = chained_pipeline(chunk_size, fused=True)
+    chains = [operation for operation in operations if isinstance(operation, Chain)]
+    assert len(operations) == 3 and len(chains) == 1 and len(chains[0].stages) == 3
+    run(operations)
+    assert sink.items == separate == [4*i for i in range(30) for _ in range(2*i % 3)]
+
+
+def test_fuse_keeps_queues_read_by_several_operations():
+    source = Items(list(range(10)))
+    double = Double(source.output)
+    twice = Double(double.output)
+    other = Collect(double.output)
+    operations = fuse([source, double, twice, Collect(twice.output), other])
+    assert not any(isinstance(operation, Chain) for operation in operations)
+
+    duplicate = Duplicate(source.output)
+    operations = fuse([duplicate, Double(duplicate.nth(0))])
+    assert not any(isinstance(operation, Chain) for operation in operations)
+
+
+def test_chain_only_takes_linked_elementwise_transformers():
+    source = Items(list(range(10)))
+    with pytest.raises(ValueError):
+        Chain(Double(source.output), Double(source.output))
+    with pytest.raises(ValueError):
+        Chain(Duplicate(source.output))
+    with pytest.raises(ValueError):
+        Chain()
@@ -0,0 +1,137 @@
+import os
+import time
+
+import numpy as np
+import pytest
+
+from processing.loaders import Loader
+from processing.operation import Chunk
+from processing.pipeline import Pipeline, run, with_backends
+from processing.process import SharedArrayQueue, ProcessOperation
+from processing.transformers import Transformer
+from processing.writers import Writer
+
+
+class Frames(Loader):
+
+    def __init__(self, n=None, chunk_size=None):
+        super().__init__(None, chunk_size=chunk_size)
+        self.n = n
+
+    def _iterate(self):
+        i = 0
+        while self.n is None or i < self.n:
+            yield np.full((4, 5), i, np.int32)
+            i += 1
+
+
+class Tag(Transformer):
+    """
+    Doubles the frames and tags them with the process they were doubled in.
+    """
+
+    def _transform(self, elem):
+        return 2*elem, os.getpid()
+
+
+class Fail(Transformer):
+
+    def _transform(self, elem):
+        raise ValueError('failed in the process')
+
+
+class Collect(Writer):
+
+    def __init__(self, input):
+        super().__init__(input, None)
+        self.items = []
+
+    def _consume(self, elem):
+        self.items.append(elem)
+
+
+def shared_memory_files():
+    return set(os.listdir('/dev/shm')) if os.path.isdir('/dev/shm') else set()
+
+
+def test_shared_array_queue_round_trip():
+    shared = SharedArrayQueue(slot_size=1024, slots=2)
+    try:
+        small = np.arange(12, dtype=np.float32).reshape(3, 4)
+        large = np.zeros(2048, np.uint8)
+        objects = np.array([{'a': 1}, None], dtype=object)
+        elems = [small, (small, 'x', small), Chunk([small, 3]), large, objects, 'text']
+        for elem in elems:
+            shared.put(elem)
+            out = shared.get()
+            assert type(out) is type(elem)
+            if isinstance(elem, np.ndarray):
+                assert out.dtype == elem.dtype
+                np.testing.assert_array_equal(out, elem)
+            elif isinstance(elem, (tuple, Chunk)):
+                assert [type(part) for part in out] == [type(part) for part in elem]
+        # Every slot is free again once the arrays were taken out
+        assert list(shared._used.get_obj()) == [0, 0]
+    finally:
+        shared.close()
+
+
+def test_shared_array_queue_pickles_when_slots_are_taken():
+    shared = SharedArrayQueue(slot_size=1024, slots=1)
+    try:
+        for i in range(3):
+            shared.put(np.full(10, i))
+        assert [shared.get()[0] for _ in range(3)] == [0, 1, 2]
+    finally:
+        shared.close()
+
+
+def tagged(n=20, chunk_size=None, backends=None):
+    frames = Frames(n, chunk_size)
+    tag = Tag(frames.output)
+    sink = Collect(tag.output)
+    return with_backends([frames, tag, sink], backends), sink
+
+
+@pytest.mark.parametrize('chunk_size', [None, 6])
+def test_process_backend_equals_threads(chunk_size):
+    operations, sink = tagged(chunk_size=chunk_size)
+    run(operations)
+    threaded = sink.items
+
+    before = shared_memory_files()
+    operations, sink = tagged(chunk_size=chunk_size, backends={'Tag': 'process'})
+    assert isinstance(operations[1], ProcessOperation)
+    run(operations)
+
+    assert len(sink.items) == len(threaded) == 20
+    for (frame, pid), (expected, threaded_pid) in zip(sink.items, threaded):
+        np.testing.assert_array_equal(frame, expected)
+        assert threaded_pid == os.getpid() != pid
+    assert operations[1].exitcode == 0
+    assert shared_memory_files() <= before
+
+
+def test_failure_in_a_process_is_raised():
+    frames = Frames(10)
+    fail = ProcessOperation(Fail(frames.output))
+    with pytest.raises(RuntimeError, match='failed in the process'):
+        run([frames, fail, Collect(fail.output)])
+
+
+def test_cancel_terminates_processes():
+    before = shared_memory_files()
+    operations, sink = tagged(n=None, backends={'Tag': 'process'})
+    pipeline = Pipeline(operations, shutdown_timeout=5.0)
+    pipeline.start()
+    time.sleep(0.2)
+
+    pipeline.cancel()
+    assert not any(operation.is_alive() for operation in operations)
+    assert sink.items
+    assert shared_memory_files() <= before
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        tagged(backends={'Tag': 'gpu'})
@@ -0,0 +1,219 @@
+import time
+from queue import Queue, Empty, Full
+from threading import Thread, Timer
+
+import numpy as np
+import pytest
+
+from processing.operation import Cancelled, Chunk
+from processing.queues import Channel, BoundedQueue, wait_any, make_queue, queue_defaults, nbytes
+
+
+def in_thread(fn, *args):
+    result = {}
+
+    def run():
+        try:
+            result['value'] = fn(*args)
+        except BaseException as e:
+            result['error'] = e
+
+    thread = Thread(target=run, daemon=True)
+    thread.start()
+    return thread, result
+
+
+def test_close_keeps_elements_then_ends_repeatedly():
+    channel = Channel()
+    channel.put(1)
+    channel.put(None)
+
+    assert channel.closed
+    assert channel.get() == 1
+    assert channel.get() is None
+    assert channel.get() is None
+
+
+def test_put_on_closed_channel_raises():
+    channel = Channel()
+    channel.close()
+    with pytest.raises(ValueError):
+        channel.put(1)
+
+
+def test_close_wakes_up_blocked_get():
+    channel = Channel()
+    thread, result = in_thread(channel.get)
+    time.sleep(0.05)
+    channel.close()
+    thread.join(1)
+
+    assert not thread.is_alive()
+    assert result == {'value': None}
+
+
+def test_cancel_discards_elements_and_raises():
+    channel = Channel()
+    channel.put(1)
+    channel.cancel()
+
+    assert channel.cancelled
+    with pytest.raises(Cancelled):
+        channel.get()
+    with pytest.raises(Cancelled):
+        channel.put(2)
+    with pytest.raises(Cancelled):
+        channel.put(None)
+
+
+@pytest.mark.parametrize('blocked', ['get', 'put'])
+def test_cancel_wakes_up_blocked_get_and_put(blocked):
+    channel = Channel(1)
+    if blocked == 'get':
+        thread, result = in_thread(channel.get)
+    else:
+        channel.put(1)
+        thread, result = in_thread(channel.put, 2)
+    time.sleep(0.05)
+    assert thread.is_alive()
+
+    channel.cancel()
+    thread.join(1)
+
+    assert not thread.is_alive()
+    assert isinstance(result['error'], Cancelled)
+
+
+def test_timeouts():
+    channel = Channel(1)
+    with pytest.raises(Empty):
+        channel.get(timeout=0.01)
+    channel.put(1)
+    with pytest.raises(Full):
+        channel.put(2, timeout=0.01)
+    with pytest.raises(Full):
+        channel.put(2, block=False)
+
+
+def test_wait_any_returns_ready_channels_in_order():
+    a, b, c = Channel(), Channel(), Channel()
+    c.put(1)
+    a.close()
+
+    assert wait_any([a, b, c]) == [a, c]
+
+
+@pytest.mark.parametrize('wake', ['put', 'close', 'cancel'])
+def test_wait_any_wakes_up(wake):
+    a, b = Channel(), Channel()
+    thread, result = in_thread(wait_any, [a, b])
+    time.sleep(0.05)
+    assert thread.is_alive()
+
+    if wake == 'put':
+        b.put(1)
+    elif wake == 'close':
+        b.close()
+    else:
+        b.cancel()
+    thread.join(1)
+
+    assert not thread.is_alive()
+    assert result == {'value': [b]}
+    # The waiter is removed from the channels once wait_any returns
+    assert not a._waiters and not b._waiters
+
+
+def test_wait_any_only_takes_channels():
+    with pytest.raises(TypeError):
+        wait_any([Channel(), Queue()])
+
+
+def test_bounded_queue_bytes():
+    queue = BoundedQueue(max_bytes=100)
+    big = np.zeros(80, np.uint8)
+    queue.put(big)
+    with pytest.raises(Full):
+        queue.put(big, block=False)
+
+    assert queue.bytes == 80
+    queue.get()
+    assert queue.bytes == 0
+
+
+def test_bounded_queue_admits_large_element_when_empty():
+    queue = BoundedQueue(max_bytes=10)
+    queue.put(np.zeros(100, np.uint8))
+    assert queue.qsize() == 1
+
+
+def test_wait_any_time_is_not_service_time():
+    queue = BoundedQueue(adaptive=True, min_size=1)
+    other = Channel()
+    queue.put(0)
+    queue.get()
+
+    # Waiting for another input of the consumer isn't time spent on the element taken out
+    timer = Timer(0.3, other.put, [1])
+    timer.start()
+    assert wait_any([queue, other]) == [other]
+    queue.put(1)
+    queue.get()
+
+    assert queue._service_time < 0.1
+
+
+def test_bytes_of_chunks_and_tuples():
+    frame = np.zeros((10, 10, 3), np.uint8)
+    assert nbytes(Chunk([frame, frame])) == 600
+    assert nbytes((frame, 'abc', (frame, b'xy'))) == 605
+
+    queue = BoundedQueue(max_bytes=1000)
+    queue.put(Chunk([frame, frame]))
+    assert queue.bytes == 600
+    with pytest.raises(Full):
+        queue.put((frame, frame), block=False)
+
+
+def test_queue_defaults():
+    assert make_queue().maxsize == 1000
+    with queue_defaults(maxsize=5, max_bytes=100):
+        queue = make_queue(adaptive=True)
+        with queue_defaults(maxsize=7):
+            assert make_queue().maxsize == 7
+        assert make_queue().maxsize == 5
+    assert (queue.maxsize, queue.max_bytes, queue.adaptive) == (5, 100, True)
+    assert make_queue().maxsize == 1000
+
+    with pytest.raises(ValueError):
+        with queue_defaults(size=5):
+            pass
+
+
+def test_resize_wakes_up_blocked_put():
+    queue = BoundedQueue(maxsize=1)
+    queue.put(0)
+    thread, result = in_thread(queue.put, 1)
+    thread.join(0.1)
+    assert thread.is_alive()
+
+    queue.resize(maxsize=2)
+    thread.join(5)
+    assert not thread.is_alive() and 'error' not in result
+    assert queue.qsize() == 2
+
+
+def test_adaptive_capacity_follows_the_consumer():
+    queue = BoundedQueue(maxsize=100, adaptive=True, target_latency=0.1, min_size=2)
+    for i in range(5):
+        queue.put(i)
+        queue.get()
+        time.sleep(0.02)
+    # The consumer takes about 50 elements out per second, so 0.1s of them are about 5
+    assert 2 <= queue.capacity <= 5
+
+    for i in range(100):
+        queue.put(i)
+        queue.get()
+    # A faster consumer raises the capacity again, up to maxsize
+    assert queue.capacity == 100
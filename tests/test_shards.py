@@ -0,0 +1,93 @@
+import os
+
+import numpy as np
+import pytest
+
+from processing.loaders import ShardLoader
+from processing.operation import Operation
+from processing.pipeline import Pipeline
+from processing.queues import make_queue
+from processing.shards import ShardAppender, ShardReader
+from processing.writers import ShardWriter
+
+
+def samples():
+    rng = np.random.default_rng(0)
+    return [rng.integers(0, 256, shape, dtype=np.uint8)
+            for shape in [(16, 16, 3), (8, 4), (100,), (), (2, 3, 4, 5), (0, 3)]*5]
+
+
+def test_append_and_read(tmp_path):
+    path = str(tmp_path / 'shards')
+    with ShardAppender(path, shard_size=2000) as appender:
+        for sample in samples():
+            appender.append(sample)
+        assert len(appender) == 30
+
+    reader = ShardReader(path)
+    assert len(reader) == 30 and reader.dtype == np.uint8
+    assert len([name for name in os.listdir(path) if name.endswith('.bin')]) > 1
+    for expected, sample in zip(samples(), reader):
+        assert sample.shape == expected.shape
+        assert np.array_equal(sample, expected)
+    # Samples are read-only views of the shards
+    assert not reader[0].flags.writeable
+    assert np.array_equal(reader[-1], samples()[-1])
+    with pytest.raises(IndexError):
+        reader[30]
+
+
+def test_sample_larger_than_shard(tmp_path):
+    path = str(tmp_path / 'shards')
+    big = np.arange(1000, dtype=np.float32)
+    with ShardAppender(path, shard_size=100) as appender:
+        appender.append(big[:10])
+        appender.append(big)
+        appender.append(big[:10])
+
+    reader = ShardReader(path)
+    assert [len(sample) for sample in reader] == [10, 1000, 10]
+    assert np.array_equal(reader[1], big)
+
+
+def test_samples_must_share_dtype(tmp_path):
+    with ShardAppender(str(tmp_path / 'shards')) as appender:
+        appender.append(np.zeros(3, np.uint8))
+        with pytest.raises(ValueError):
+            appender.append(np.zeros(3, np.float32))
+        with pytest.raises(ValueError):
+            appender.append(np.zeros((1,)*5, np.uint8))
+
+
+def test_empty_set(tmp_path):
+    path = str(tmp_path / 'shards')
+    ShardAppender(path).close()
+    assert len(ShardReader(path)) == 0
+
+
+class Source(Operation):
+
+    def __init__(self, elements):
+        super().__init__()
+        self.elements = elements
+        self.output = make_queue()
+
+    def run(self):
+        for elem in self.elements:
+            self.output.put(elem)
+        self.output.put(None)
+
+
+@pytest.mark.parametrize('chunk_size', [None, 4])
+def test_writer_and_loader(tmp_path, chunk_size):
+    path = str(tmp_path / 'shards')
+    source = Source(samples())
+    Pipeline([source, ShardWriter(source.output, path, shard_size=2000)]).run()
+
+    loaded = []
+    for item in ShardLoader(path, chunk_size=chunk_size).iterate():
+        loaded += item if chunk_size else [item]
+
+    assert len(loaded) == 30
+    assert all(np.array_equal(a, b) for a, b in zip(loaded, samples()))
+    assert all(sample.flags.writeable for sample in loaded)
@@ -0,0 +1,137 @@
+import json
+
+import numpy as np
+import pytest
+
+from processing.loaders import TrackFileLoader, TrackArrayLoader
+from processing.pipeline import Pipeline
+from processing.queues import make_queue
+from processing.tracks import convert_json_tracks, read_tracks, to_array, to_dicts, track_dtype
+from processing.transformers.track import DiscardEmpty, Translate, Scale, CenterExtractor, RoundToInt
+from processing.writers import TrackArrayWriter
+
+
+@pytest.fixture
+def json_tracks(tmp_path):
+    rng = np.random.default_rng(0)
+    tracks = [
+        {'name': 'face', 'type': 'rectangle_region',
+         'data': [{'x': x, 'y': y, 'width': 20.5, 'height': 30.0} for x, y in rng.uniform(0, 100, (40, 2)).tolist()]},
+        {'name': 'eye_left', 'type': 'point', 'data': [{'x': float(i), 'y': -1.5*i} for i in range(40)]},
+        {'name': 'pupil', 'type': 'inscribed_circle',
+         'data': [{'cx': float(i), 'cy': 2.0*i, 'width': 3.0, 'height': 4.0, 'angle': 0.5} for i in range(40)]},
+    ]
+    path = tmp_path / 'tracks.json'
+    with open(path, 'w') as f:
+        json.dump({'tracks': tracks, 'length': 40, 'video_resolution': {'width': 640, 'height': 480}}, f)
+    return str(path)
+
+
+def test_array_conversion_round_trip():
+    data = [{'x': 1.5, 'y': 2.0}, {'x': -3.0, 'y': 4.25}]
+    array = to_array('point', data)
+
+    assert array.dtype == track_dtype('point')
+    assert to_dicts('point', array) == data
+    with pytest.raises(ValueError):
+        track_dtype('polygon')
+
+
+@pytest.mark.parametrize('options', [
+    {},
+    {'track_names': ['pupil', 'face'], 'keep_names': True},
+    {'skip_pattern': (1, 2), 'stop': 30},
+    {'ranges': [(3, 8), (20, None)], 'chunk_size': 4},
+])
+def test_converted_tracks_load_like_json(json_tracks, tmp_path, options):
+    convert_json_tracks(json_tracks, str(tmp_path / 'columnar'))
+
+    expected = list(TrackFileLoader(json_tracks, **options).iterate())
+    assert list(TrackArrayLoader(str(tmp_path / 'columnar'), **options).iterate()) == expected
+
+
+def test_read_tracks_is_memory_mapped(json_tracks, tmp_path):
+    convert_json_tracks(json_tracks, str(tmp_path / 'columnar'))
+    meta = read_tracks(str(tmp_path / 'columnar'))
+
+    assert meta['length'] == 40
+    assert meta['video_resolution'] == {'width': 640, 'height': 480}
+    assert [track['name'] for track in meta['tracks']] == ['face', 'eye_left', 'pupil']
+    assert all(isinstance(track['data'], np.memmap) for track in meta['tracks'])
+
+
+@pytest.mark.parametrize('block_size', [None, 7])
+def test_writer_round_trip(json_tracks, tmp_path, block_size):
+    convert_json_tracks(json_tracks, str(tmp_path / 'columnar'))
+
+    loader = TrackArrayLoader(str(tmp_path / 'columnar'), keep_names=True, block_size=block_size)
+    writer = TrackArrayWriter(loader.output, str(tmp_path / 'written'), (480, 640))
+    Pipeline([loader, writer]).run()
+
+    original = read_tracks(str(tmp_path / 'columnar'))
+    written = read_tracks(str(tmp_path / 'written'))
+    assert written['length'] == original['length']
+    assert written['video_resolution'] == original['video_resolution']
+    for a, b in zip(original['tracks'], written['tracks']):
+        assert (a['name'], a['type']) == (b['name'], b['type'])
+        assert np.array_equal(a['data'], b['data'])
+
+
+def rows_and_blocks():
+    rng = np.random.default_rng(1)
+    columns = {
+        'point': to_array('point', [{'x': x, 'y': y} for x, y in rng.uniform(-50, 50, (30, 2)).tolist()]),
+        'rectangle_region': to_array('rectangle_region', [{'x': x, 'y': y, 'width': w, 'height': h}
+                                                          for x, y, w, h in rng.uniform(0, 50, (30, 4)).tolist()]),
+        'inscribed_circle': to_array('inscribed_circle', [{'cx': x, 'cy': y, 'width': w, 'height': h, 'angle': a}
+                                                          for x, y, w, h, a in rng.uniform(0, 50, (30, 5)).tolist()]),
+    }
+    # Empty elements, which DiscardEmpty removes
+    columns['point'][[3, 17]] = 0
+    columns['inscribed_circle'][25] = 0
+
+    rows = [[(type, to_dicts(type, data[i:i+1])[0]) for type, data in columns.items()] for i in range(30)]
+    blocks = [[(type, data[start:start+8]) for type, data in columns.items()] for start in range(0, 30, 8)]
+    return rows, blocks
+
+
+def unblock(blocks):
+    """
+    :return: the rows of the blocks, with dicts as data
+    """
+    rows = []
+    for block in blocks:
+        columns = [(type, to_dicts(type, data)) for type, data in block]
+        rows += [[(type, data[i]) for type, data in columns] for i in range(len(block[0][1]))]
+    return rows
+
+
+@pytest.mark.parametrize('transformer', [
+    lambda queue: Translate(queue, (2.5, -4)),
+    lambda queue: Scale(queue, 0.5),
+    RoundToInt,
+])
+def test_block_transforms_equal_row_transforms(transformer):
+    rows, blocks = rows_and_blocks()
+    transformer = transformer(make_queue())
+
+    expected = [transformer._transform(row) for row in rows]
+    assert unblock(transformer._transform(block) for block in blocks) == expected
+
+
+def test_block_centers_equal_row_centers():
+    rows, blocks = rows_and_blocks()
+    extractor = CenterExtractor(make_queue())
+
+    expected = np.array([extractor._transform(row) for row in rows])
+    centers = np.concatenate([np.stack(extractor._transform(block), axis=1) for block in blocks])
+    assert np.allclose(centers, expected)
+
+
+def test_discard_empty_blocks_equal_rows():
+    rows, blocks = rows_and_blocks()
+    discard = DiscardEmpty(make_queue())
+
+    expected = [out for row in rows for out in discard._expand(row)]
+    assert len(expected) == 27
+    assert unblock(out for block in blocks for out in discard._expand(block)) == expected
@@ -0,0 +1,126 @@
+import pytest
+
+from processing.loaders import Loader
+from processing.operation import Operation, Chunk
+from processing.pipeline import run
+from processing.queues import make_queue
+from processing.transformers import Transformer, Duplicate, Split, Zip
+from processing.writers import Writer
+
+
+class Items(Loader):
+
+    def __init__(self, items, chunk_size=None):
+        super().__init__(None, chunk_size=chunk_size)
+        self.items = items
+
+    def _iterate(self):
+        return iter(self.items)
+
+
+class Double(Transformer):
+
+    def _transform(self, elem):
+        return 2*elem
+
+
+class Even(Transformer):
+
+    def _expand(self, elem):
+        return [elem] if elem % 2 == 0 else []
+
+
+class Collect(Writer):
+    """
+    Collects the elements of its input, taking chunks apart.
+    """
+
+    def __init__(self, input):
+        super().__init__(input, None)
+        self.elements = []
+
+    def _consume(self, elem):
+        self.elements.append(elem)
+
+
+class Sink(Operation):
+    """
+    Collects the items of its input as they are, chunks included.
+    """
+
+    def __init__(self, input):
+        super().__init__()
+        self.input = input
+        self.items = []
+
+    def run(self):
+        while True:
+            item = self.input.get()
+            if item is None:
+                return
+            self.items.append(item)
+
+
+def test_loader_chunks():
+    assert list(Items(list(range(7)), chunk_size=3).iterate()) == [[0, 1, 2], [3, 4, 5], [6]]
+    assert all(isinstance(chunk, Chunk) for chunk in Items(list(range(7)), chunk_size=3).iterate())
+    assert list(Items(list(range(3))).iterate()) == [0, 1, 2]
+
+
+@pytest.mark.parametrize('chunk_size', [None, 1, 4, 100])
+def test_chunks_pass_through_transformers_and_writers(chunk_size):
+    source = Items(list(range(10)), chunk_size)
+    even = Even(source.output)
+    double = Double(even.output)
+    duplicate = Duplicate(double.output)
+    sink, writer = Sink(duplicate.nth(0)), Collect(duplicate.nth(1))
+    run([source, even, double, duplicate, sink, writer])
+
+    assert writer.elements == [0, 4, 8, 12, 16]
+    if chunk_size is None:
+        assert sink.items == writer.elements
+    else:
+        # Chunks keep their grouping, chunks left empty by a filter are dropped
+        assert all(isinstance(item, Chunk) and item for item in sink.items)
+        expected = [[2*i for i in range(start, min(start + chunk_size, 10)) if i % 2 == 0]
+                    for start in range(0, 10, chunk_size)]
+        assert sink.items == [chunk for chunk in expected if chunk]
+
+
+def test_chunked_inputs_are_zipped_chunk_by_chunk():
+    numbers, letters = Items(list(range(5)), 2), Items(list('abcde'), 2)
+    zipped = Zip(numbers.output, letters.output)
+    sink = Sink(zipped.output)
+    run([numbers, letters, zipped, sink])
+    assert sink.items == [[(0, 'a'), (1, 'b')], [(2, 'c'), (3, 'd')], [(4, 'e')]]
+
+
+@pytest.mark.parametrize('chunk_sizes', [(2, None), (2, 3)])
+def test_differently_chunked_inputs_raise(chunk_sizes):
+    numbers, letters = Items(list(range(6)), chunk_sizes[0]), Items(list('abcdef'), chunk_sizes[1])
+    zipped = Zip(numbers.output, letters.output)
+    with pytest.raises(BlockingIOError):
+        run([numbers, letters, zipped, Collect(zipped.output)])
+
+
+def test_chunks_are_split_over_outputs():
+    source = Items(list(range(100)), 30)
+    split = Split(source.output, (50, 50))
+    duplicate = Duplicate(split.output[1])
+    first, second, third = Sink(split.output[0]), Sink(duplicate.nth(0)), Sink(duplicate.nth(1))
+    run([source, split, duplicate, first, second, third])
+
+    assert first.items == [list(range(30)), list(range(30, 50))]
+    assert second.items == third.items == [list(range(50, 60)), list(range(60, 90)), list(range(90, 100))]
+
+
+def test_iterate():
+    assert list(Double(make_queue()).iterate(iter([1, Chunk([2, 3]), 4]))) == [2, [4, 6], 8]
+    assert list(Zip(make_queue(), make_queue()).iterate([1, 2], 'ab')) == [(1, 'a'), (2, 'b')]
+
+    low, high = Split(make_queue(), (50, 50)).iterate(range(100))
+    assert list(high) == list(range(50, 100))
+    assert list(low) == list(range(50))
+
+    with pytest.raises(ValueError):
+        list(Double(make_queue()).iterate([1], [2]))